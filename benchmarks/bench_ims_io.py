@@ -0,0 +1,192 @@
+"""Benchmarks of the IMS read path on synthetic videos of moving particles.
+
+Requires pytest-benchmark. The file is not collected by the normal test run, run it with::
+
+    pytest benchmarks/bench_ims_io.py
+
+Besides the timings, each benchmark stores the throughput (frames/s and MB/s), the peak
+memory allocated by Python and numpy during one call and the increase of the peak resident
+set size (RSS) during another call in the ``extra_info`` of the benchmark. Only the RSS
+includes the buffers that HDF5 and zlib allocate in C. It is measured by resetting the
+peak RSS of the process, which needs Linux, and is None on other systems. Memory that the
+allocator kept from earlier calls is reused without increasing the RSS, so small
+allocations may not show up in it.
+Use ``--benchmark-json`` to save them, or ``--benchmark-autosave`` and
+``--benchmark-compare`` to catch regressions.
+"""
+import tracemalloc
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pytest
+
+from confocal_microscopy.files import ims, synthetic
+
+pytest.importorskip("pytest_benchmark")
+
+
+VIDEOS = {
+    "small-gzip": dict(
+        num_timesteps=50, shape=(1, 64, 64), width=60, height=60, chunks=(1, 32, 32)
+    ),
+    "medium-uncompressed": dict(
+        num_timesteps=100, shape=(1, 256, 256), width=250, height=240, chunks=(1, 128, 128),
+        compression=None,
+    ),
+    "medium-gzip+shuffle": dict(
+        num_timesteps=100, shape=(1, 256, 256), width=250, height=240, chunks=(1, 128, 128),
+        shuffle=True,
+    ),
+    "large-gzip": dict(
+        num_timesteps=100, shape=(1, 512, 512), width=500, height=500, chunks=(1, 256, 256),
+        compression_opts=2,
+    ),
+}
+
+
+class NoPreprocessingLoader(ims.LazyIMSVideoLoader):
+    def _preprocess(self, frame):
+        return frame
+
+
+@pytest.fixture(scope="module", params=list(VIDEOS))
+def ims_path(request, tmp_path_factory):
+    path = tmp_path_factory.mktemp(request.param) / "synthetic red ch_1.ims"
+    return synthetic.write_synthetic_ims_file(
+        path, num_particles=100, seed=0, **VIDEOS[request.param]
+    )
+
+
+def _get_frame_size(path):
+    metadata = ims.get_metadata(path)
+    dtype = ims.load_image_stack(path).dtype
+    return metadata.height * metadata.width * dtype.itemsize
+
+
+def _read_memory_status(field):
+    """Read a memory size (e.g. ``"VmRSS"`` or ``"VmHWM"``) of this process in bytes.
+    """
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith(f"{field}:"):
+            return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def _measure_peak_rss_increase(function, *args, **kwargs):
+    """Increase of the peak RSS during a call of ``function`` in bytes, None if not on Linux.
+    """
+    try:
+        # Writing 5 to clear_refs resets the peak RSS (VmHWM) to the current RSS
+        Path("/proc/self/clear_refs").write_text("5")
+        rss_before = _read_memory_status("VmRSS")
+    except (OSError, KeyError):
+        return None
+    function(*args, **kwargs)
+    return _read_memory_status("VmHWM") - rss_before
+
+
+def _run_benchmark(benchmark, num_frames, num_bytes, function, *args, **kwargs):
+    """Benchmark ``function`` and store the throughput and peak memory usage in ``extra_info``.
+    """
+    result = benchmark(function, *args, **kwargs)
+
+    tracemalloc.start()
+    function(*args, **kwargs)
+    _, peak_allocated = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_rss_increase = _measure_peak_rss_increase(function, *args, **kwargs)
+
+    benchmark.extra_info["peak_allocated__MB"] = peak_allocated / 1e6
+    benchmark.extra_info["peak_rss_increase__MB"] = (
+        None if peak_rss_increase is None else peak_rss_increase / 1e6
+    )
+    if benchmark.stats is not None:
+        duration__s = benchmark.stats.stats.mean
+        benchmark.extra_info["frames_per_s"] = num_frames / duration__s
+        benchmark.extra_info["MB_per_s"] = num_bytes / duration__s / 1e6
+    return result
+
+
+def test_load_image_stack(benchmark, ims_path):
+    _run_benchmark(benchmark, 1, _get_frame_size(ims_path), ims.load_image_stack, ims_path)
+
+
+def load_video_stack_with_list(path, num_timesteps):
+    """The list-and-stack implementation ``load_video_stack`` used before preallocation.
+    """
+    metadata = ims.get_metadata(path)
+    with h5py.File(path, "r") as h5:
+        resolution_group = h5["DataSet/ResolutionLevel 0"]
+        frames = [
+            resolution_group[f"TimePoint {time_point}/Channel 0/Data"][
+                :, :metadata.height, :metadata.width
+            ]
+            for time_point in range(num_timesteps)
+        ]
+    return np.stack(frames, axis=0)
+
+
+def test_load_video_stack_with_list(benchmark, ims_path):
+    num_timesteps = ims.get_metadata(ims_path).num_timesteps
+    _run_benchmark(
+        benchmark,
+        num_timesteps,
+        num_timesteps * _get_frame_size(ims_path),
+        load_video_stack_with_list,
+        ims_path,
+        num_timesteps,
+    )
+
+
+@pytest.mark.parametrize("num_workers", [1, 2, 4, 8])
+def test_load_video_stack(benchmark, ims_path, num_workers):
+    num_timesteps = ims.get_metadata(ims_path).num_timesteps
+    _run_benchmark(
+        benchmark,
+        num_timesteps,
+        num_timesteps * _get_frame_size(ims_path),
+        ims.load_video_stack,
+        ims_path,
+        num_workers=num_workers,
+        use_cache=False,
+    )
+
+
+@pytest.mark.parametrize("prefetch", [0, 8])
+def test_loader_iteration(benchmark, ims_path, prefetch):
+    def iterate():
+        loader = NoPreprocessingLoader(
+            ims_path, limits=(0, 1), progress=False, use_cache=False, prefetch=prefetch
+        )
+        with loader:
+            for _ in loader:
+                pass
+
+    num_timesteps = ims.get_metadata(ims_path).num_timesteps
+    _run_benchmark(benchmark, num_timesteps, num_timesteps * _get_frame_size(ims_path), iterate)
+
+
+def test_loader_getitem(benchmark, ims_path):
+    num_timesteps = ims.get_metadata(ims_path).num_timesteps
+    time_points = np.random.RandomState(0).randint(0, num_timesteps, size=20)
+    loader = NoPreprocessingLoader(ims_path, limits=(0, 1), progress=False, use_cache=False)
+
+    def get_frames():
+        for time_point in time_points:
+            loader[int(time_point)]
+
+    with loader:
+        _run_benchmark(
+            benchmark, len(time_points), len(time_points) * _get_frame_size(ims_path), get_frames
+        )
+
+
+def test_parse_config(benchmark, ims_path):
+    config_path = ims_path.parent / f"{ims_path.stem}_metadata.txt"
+    config_size = config_path.stat().st_size
+    _run_benchmark(benchmark, 0, config_size, ims.parse_config, config_path)
+
+
+def test_load_ims_metadata(benchmark, ims_path):
+    _run_benchmark(benchmark, 0, 0, ims.load_ims_metadata, ims_path)
@@ -0,0 +1,89 @@
+"""Benchmarks of ``filters.FramePreprocessor`` against the frame by frame preprocessing
+that the ``IMSLoader`` in ``scripts/track_particles.py`` used to do.
+
+Requires pytest-benchmark, run with::
+
+    pytest benchmarks/bench_preprocessing.py
+"""
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from confocal_microscopy.files import synthetic
+from confocal_microscopy.filters import FramePreprocessor, morphology
+
+pytest.importorskip("pytest_benchmark")
+
+
+LIMITS = (2, 50)
+
+
+def preprocess_frame(frame, background, limits):
+    frame = frame.astype(float)
+    frame = frame - background
+    frame[frame < 0] = 0
+    frame = ndimage.grey_opening(frame, 3)
+    frame = ndimage.grey_closing(frame, 5)
+    frame -= limits[0]
+    frame /= limits[1]
+    frame *= 255
+    frame[frame > 255] = 255
+    frame[frame < 0] = 0
+    return frame
+
+
+@pytest.fixture(scope="module", params=[(32, 256), (32, 512)], ids=["256x256", "512x512"])
+def frames(request):
+    num_frames, size = request.param
+    return synthetic.make_particle_video(
+        num_frames, shape=(1, size, size), num_particles=100, seed=0
+    )[:, 0]
+
+
+def _store_throughput(benchmark, frames):
+    if benchmark.stats is not None:
+        duration__s = benchmark.stats.stats.mean
+        benchmark.extra_info["frames_per_s"] = len(frames) / duration__s
+        benchmark.extra_info["MB_per_s"] = frames.nbytes / duration__s / 1e6
+
+
+def test_frame_by_frame(benchmark, frames):
+    background = frames.mean(axis=0)
+
+    def preprocess():
+        return [preprocess_frame(frame, background, LIMITS) for frame in frames]
+
+    benchmark(preprocess)
+    _store_throughput(benchmark, frames)
+
+
+@pytest.mark.parametrize("block_size", [1, 8, 32])
+@pytest.mark.parametrize("dtype", [np.float32, np.uint8])
+def test_frame_preprocessor(benchmark, frames, block_size, dtype):
+    background = frames.mean(axis=0)
+    preprocessor = FramePreprocessor(opening_size=3, closing_size=5)
+    out = np.empty(frames.shape, dtype=dtype)
+
+    def preprocess():
+        for start in range(0, len(frames), block_size):
+            block = slice(start, start + block_size)
+            preprocessor(frames[block], background, LIMITS, out=out[block])
+
+    benchmark(preprocess)
+    _store_throughput(benchmark, frames)
+
+
+@pytest.mark.parametrize("size", [3, 5, 15])
+def test_ndimage_closing(benchmark, frames, size):
+    work = frames.astype(np.float32)
+    benchmark(ndimage.grey_closing, work, size=(1, size, size))
+    _store_throughput(benchmark, frames)
+
+
+@pytest.mark.parametrize("size", [3, 5, 15])
+def test_morphology_closing(benchmark, frames, size):
+    work = frames.astype(np.float32)
+    out = np.empty_like(work)
+    morphology.grey_closing(work, size, out=out)
+    benchmark(morphology.grey_closing, work, size, out=out)
+    _store_throughput(benchmark, frames)
@@ -1,10 +1,13 @@
 """Discontinued methodology.
 """
 
+from confocal_microscopy.files.catalogue import Catalogue
 from confocal_microscopy.tracking import estimate_piv
 import h5py
 from pathlib import Path
 
+CATALOGUE_PATH = Path.home() / "fish_catalogue.sqlite"
+
 
 def find_and_store_profiles(
     data_path,
@@ -52,8 +55,13 @@ def find_and_store_profiles(
 
 
 if __name__ == "__main__":
-    parent = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/7 DAY OLD Fish without tumors/Fish **")
-    files = list(parent.glob("**/*red ch_*.ims"))
+    parent = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/7 DAY OLD Fish without tumors")
+    with Catalogue(CATALOGUE_PATH) as catalogue:
+        catalogue.refresh(parent)
+        files = [
+            recording.path for recording in catalogue.recordings(root=parent)
+            if recording.path.relative_to(parent).parts[0].startswith("Fish ")
+        ]
     failed = []
     
     for i, data_path in enumerate(files):
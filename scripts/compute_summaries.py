@@ -4,20 +4,19 @@ from subprocess import run
 import multiprocessing
 from functools import partial
 
+from confocal_microscopy.files.catalogue import Catalogue
+
+CATALOGUE_PATH = Path.home() / "fish_catalogue.sqlite"
+
 
 def run_summary(params, N):
-    i, image_parent = params
+    i, (image_parent, bg_path) = params
     print("Vessel: ", i, "of", N)
 
-    try:
-        bg_path = next(image_parent.parent.glob("*Snap*.ims"))
-    except StopIteration:
-        try:
-            bg_path = next(image_parent.glob("*Snap*.ims"))
-        except StopIteration:
-            print("No background")
-            return
-    
+    if bg_path is None:
+        print("No background")
+        return
+
 
     filename = image_parent / f"summary.ipynb"
 
@@ -35,7 +34,11 @@ def run_summary(params, N):
         pass
 
 parent = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/")
-vessels = sorted({p.parent for p in parent.glob("**/*red ch_*.ims")})
+with Catalogue(CATALOGUE_PATH) as catalogue:
+    catalogue.refresh(parent)
+    vessels = sorted({
+        (recording.path.parent, recording.snapshot) for recording in catalogue.recordings(root=parent)
+    }, key=lambda vessel: vessel[0])
 for data in enumerate(vessels):
     run_summary(data, N=len(vessels))
 
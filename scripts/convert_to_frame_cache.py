@@ -0,0 +1,22 @@
+"""Convert all videos in file tree to uncompressed frame caches.
+
+The frame caches are stored next to the videos and are picked up automatically
+by ``ims.load_video_stack`` and ``ims.LazyIMSVideoLoader``.
+"""
+import argparse
+from pathlib import Path
+
+from confocal_microscopy.files import ims
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    parent = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/")
+    files = sorted(parent.glob("**/*red ch_*.ims"))
+    for i, path in enumerate(files):
+        print(f"Converting {i+1} out of {len(files)}: {path}", flush=True)
+        ims.convert_to_frame_cache(path, progress=True, num_workers=args.num_workers, overwrite=args.overwrite)
@@ -0,0 +1,34 @@
+"""Convert the track CSV files in file tree to Parquet files.
+
+The Parquet files are stored next to the CSV files, with the pixel size and frame
+interval of the recording, and are read with ``confocal_microscopy.files.tracks.read_tracks``.
+"""
+import argparse
+from pathlib import Path
+
+from confocal_microscopy.files import tracks
+from confocal_microscopy.files.metadata import get_metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--delete-csv", action="store_true")
+    args = parser.parse_args()
+
+    parent = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/")
+    files = sorted(parent.glob("**/*red ch_*.csv"))
+    for i, csv_path in enumerate(files):
+        out_path = csv_path.with_suffix(".parquet")
+        if out_path.is_file() and not args.overwrite:
+            print(f"Already converted {i+1} out of {len(files)}: {csv_path}", flush=True)
+            continue
+
+        print(f"Converting {i+1} out of {len(files)}: {csv_path}", flush=True)
+        ims_path = csv_path.with_suffix(".ims")
+        metadata = None
+        if ims_path.is_file():
+            metadata = tracks.get_recording_metadata(get_metadata(ims_path))
+        tracks.convert_csv(csv_path, out_path, metadata)
+        if args.delete_csv:
+            csv_path.unlink()
@@ -1,8 +1,16 @@
 from pathlib import Path
 
+from confocal_microscopy.files.catalogue import Catalogue
+
+CATALOGUE_PATH = Path.home() / "fish_catalogue.sqlite"
+
 
 fish_path = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/7 DAY OLD Fish without tumors")
-for background_path in (sorted(fish_path.glob("**/*Snap*.ims"))):
-    vertex_file = background_path.parent/f"{background_path.stem}_vertices.json"
+with Catalogue(CATALOGUE_PATH) as catalogue:
+    catalogue.refresh(fish_path)
+    snapshots = catalogue.snapshots(root=fish_path, with_vertices=True)
+
+for snapshot in snapshots:
+    vertex_file = snapshot.path.parent/f"{snapshot.path.stem}_vertices.json"
     if vertex_file.is_file():
         vertex_file.unlink()
@@ -13,8 +13,11 @@ from scipy import ndimage
 from tqdm import tqdm
 
 import confocal_microscopy.roi_tools.centerline as centerline_tools
+from confocal_microscopy.files.catalogue import Catalogue
 from confocal_microscopy.tracking.utils import load_background
 
+CATALOGUE_PATH = Path.home() / "fish_catalogue.sqlite"
+
 
 class ROIExtractor(QtWidgets.QWidget):
     def __init__(self, background_path, parent=None):
@@ -155,10 +158,18 @@ if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
     fish_path = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/7 DAY OLD Fish without tumors/")
 
-    for background_path in tqdm(sorted(fish_path.glob("Fish */**/*Snap*.ims"))):
+    with Catalogue(CATALOGUE_PATH) as catalogue:
+        catalogue.refresh(fish_path)
+        snapshots = [
+            snapshot for snapshot in catalogue.snapshots(root=fish_path)
+            if snapshot.path.relative_to(fish_path).parts[0].startswith("Fish ")
+        ]
+
+    for snapshot in tqdm(snapshots):
         print(fish_path)
+        background_path = snapshot.path
         vertex_file = background_path.parent/f"{background_path.stem}_vertices.json"
-        if vertex_file.is_file():
+        if snapshot.vertices is not None:
             skip = "aaa"
             while skip.lower().strip() not in {"y", "n", ""}:
 
@@ -1,165 +1,215 @@
 """Iterate over all video-files in file tree and track particles.
 
-
+The recordings are tracked largest first, and recordings whose tracks are newer than the
+recording are skipped. Recordings with tracks in the CSV files of earlier versions of
+this script are also skipped, convert them with ``scripts/convert_tracks.py``. A
+recording that fails for another reason than an I/O error gets a ``{stem}_failed`` file
+with the traceback, and is skipped by later runs unless ``--retry-failed`` is given. A
+summary with the wall time of each recording is written to the dataset directory.
 """
 
-import re
 import argparse
+import os
+import shutil
 import time
+import traceback
 import warnings
 from pathlib import Path
 
 import trackpy as tp
-from scipy import ndimage
-import docx
 
-from confocal_microscopy.files import ims
+from confocal_microscopy.files import ims, tracks
+from confocal_microscopy.files.catalogue import Catalogue
+from confocal_microscopy.filters import FramePreprocessor
+from confocal_microscopy.tracking import particle_tracking
+from confocal_microscopy.utils import scheduler
+
+CATALOGUE_PATH = Path.home() / "fish_catalogue.sqlite"
 
 tp.enable_numba()
 tp.quiet()
 
 
-class IMSLoader(ims.LazyIMSVideoLoader):
-    def _preprocess(self, frame):
-        frame = frame.astype(float)
-        
-        # Remove background signal
-        frame = frame - self.background_signal
-        frame[frame < 0] = 0
-
-        # Morphological denoising
-        frame = ndimage.grey_opening(frame, 3)
-        frame = ndimage.grey_closing(frame, 5)
-
-        # Clip dynamic range
-        frame -= self._limits[0]
-        frame /= self._limits[1]
-        frame *= 255
-        frame[frame > 255] = 255
-        frame[frame < 0] = 0
-
-        return frame
+def track_particles(path, out_path, wavelength, workers=1, checkpoint_dir=None):
+    """Find particles, link tracks and remove particles that are only present for one frame
 
+    The background and limits are computed with ``workers`` threads, and then the frames
+    are read, preprocessed and located by ``workers`` processes. The particles are linked
+    frame by frame, and the finished tracks are written to the Parquet file ``out_path``
+    in chunks, so the whole video is never kept in memory. The chunks are written to a
+    temporary file that is renamed when the tracking is finished.
 
-def track_particles(path):
-    """Find particles, link tracks and remove particles that are only present for one frame
+    The located particles are stored in ``checkpoint_dir``, so a run that crashes only
+    locates the remaining frames when it is started again. The checkpoints are removed
+    when the tracking is finished. Frames that can't be linked are linked again with more
+    robust parameters, which are stored in the metadata of the tracks.
     """
     path = Path(path)
+    out_path = Path(out_path)
+    partial_path = out_path.with_name(f"{out_path.name}.partial")
+    if checkpoint_dir is None:
+        checkpoint_dir = path.parent / f"{path.stem}_checkpoints"
+    num_tracks = 0
+    segments = []
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=UserWarning)
-        with IMSLoader(path, limits=(2, 50)) as imsloader:
-            print("Finding blobs...", flush=True)
-            features = tp.batch(imsloader, 5, minmass=50, preprocess=False)
-
-    print("Linking blobs between frames...", flush=True)
-    features = tp.link(features, 16, memory=2, adaptive_step=1)
-
-    print("Filtering out blobs that didn't stay for long...", flush=True)
-    features = tp.filter_stubs(features, 2)
-    print(f"Found {len(features['particle'].unique())} tracks.")
-
-    return features
+        imsloader = ims.LazyIMSVideoLoader(
+            path,
+            limits=(2, 50),
+            prefetch=16,
+            preprocessor=FramePreprocessor(opening_size=3, closing_size=5),
+            workers=workers,
+        )
+        metadata = tracks.get_recording_metadata(imsloader.metadata)
+        with imsloader, tracks.TrackWriter(partial_path, metadata, wavelength) as writer:
+            print("Finding, linking and filtering blobs...", flush=True)
+            chunks = particle_tracking.iter_tracks(
+                imsloader,
+                diameter=5,
+                minmass=50,
+                search_range=16,
+                memory=2,
+                min_track_length=2,
+                link_kwargs={"adaptive_step": 1},
+                workers=workers,
+                checkpoint_dir=checkpoint_dir,
+                segments=segments,
+            )
+            for chunk in chunks:
+                writer.write(chunk)
+                num_tracks += chunk["particle"].nunique()
+            writer.metadata["linking_segments"] = [segment._asdict() for segment in segments]
+            timings = imsloader.stage_timings()
+    partial_path.replace(out_path)
+    shutil.rmtree(checkpoint_dir)
+
+    for segment in segments[1:]:
+        print(
+            f"Linked frames {segment.start_frame} to {segment.stop_frame} with "
+            f"{segment.parameters}",
+            flush=True,
+        )
+    if workers <= 1:
+        # With several workers, the frames are read by the worker processes' own loaders
+        print(
+            f"Reading took {timings.read__s:.0f} s, preprocessing took "
+            f"{timings.preprocess__s:.0f} s and waiting for frames took {timings.wait__s:.0f} s",
+            flush=True,
+        )
+    # Tracks can be split over several chunks, so this is an upper bound
+    print(f"Found at most {num_tracks} tracks.")
+    return out_path
+
+
+def track_recording(path, out_path, failed_path, wavelength, workers=1):
+    """Track a recording with ``track_particles``, and mark recordings that can't be tracked.
+
+    I/O errors can be caused by e.g. a disconnected drive, and the recording is tried again
+    by the next run. Other errors, e.g. frames that can't be linked with any of the retry
+    parameters, will happen again, so the traceback is stored in ``failed_path``.
+    """
+    try:
+        track_particles(path, out_path, wavelength, workers=workers)
+    except OSError:
+        raise
+    except Exception:
+        failed_path.write_text(traceback.format_exc())
+        raise
+    if failed_path.is_file():
+        failed_path.unlink()
+    return out_path
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("task_id", type=int)
-    parser.add_argument("num_tasks", type=int)
+    parser = argparse.ArgumentParser(
+        description=(
+            "Track the particles of all recordings, largest first. Several processes, e.g. "
+            "one per node, can be started with different task ids, and they share the "
+            "recordings through lock files in the dataset directory."
+        )
+    )
+    parser.add_argument("task_id", type=int, nargs="?", default=0)
+    parser.add_argument("num_tasks", type=int, nargs="?", default=1)
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="Recordings that are tracked at the same time"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes used to locate particles in each recording",
+    )
+    parser.add_argument(
+        "--lock-timeout",
+        type=float,
+        default=0.5,
+        help=(
+            "Hours after which a lock that is not refreshed is assumed to be left by a crash, "
+            "the locks are refreshed every minute while the recordings are tracked"
+        ),
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Also track the recordings that failed before, which have a _failed file",
+    )
     args = parser.parse_args()
     task_id = args.task_id
     num_tasks = args.num_tasks
     assert 0 <= task_id and task_id < num_tasks
+    workers = args.workers
+    if workers is None:
+        workers = max(1, os.cpu_count() // args.jobs)
 
     parent = Path("/home/yngve/Documents/Fish 1 complete/")
     parent = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/7 DAY OLD Fish without tumors/")
     parent = Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/")
-    files = list(parent.glob("**/*red ch_*.ims"))
-    num_digits = len(str(len(files)))
-    failed = {}
-
-    for i, path in enumerate(files):
-        if i % num_tasks != task_id:
+    with Catalogue(CATALOGUE_PATH) as catalogue:
+        catalogue.refresh(parent)
+        recordings = catalogue.recordings(root=parent)
+
+    jobs = []
+    for recording in recordings:
+        path = recording.path
+        # Wavelength of current track, found from the folder name or legend file by the catalogue
+        wavelength = recording.wavelength
+        if wavelength is None:
+            print(f"Unknown wavelength for {path}: {recording.error}")
             continue
-        message = f"Track {i+1:{num_digits}d} out of {len(files):{num_digits}d}:"
-        print(message)
-        print("="*len(message))
-
-        # Extract wavelength of current track
-        wavelength = None
-        if "1000" in path.parent.name:
-            wavelength = 1000
-        elif "400" in path.parent.name:
-            wavelength = 400
-        else:
-            # If the wavelength is not in the parent folder name, we need a legend file
-            if (path.parent / "legend.docx").is_file():
-                legend_file = path.parent / "legend.docx"
-            elif (path.parent / "Legend.docx").is_file():
-                legend_file = path.parent / "Legend.docx"
-            else:
-                print(f"No legend for {path}")
-                continue
-
-            document = docx.Document(legend_file)
-            for paragraph in document.paragraphs:
-                # Search for file IDs
-                matches = re.findall(r"\d\d[.]\d\d[.]\d\d", paragraph.text)
-                if len(matches) == 0:
-                    # If no file marker is in the current paragraph, then continue
-                    continue
-                elif len(matches) > 1:
-                    # We should not have more than one file id per paragraph
-                    warnings.warn("More than one legend match")
-                    print(matches, paragraph.text)
-                    #raise ValueError("More than one legend match")
-                
-                if "400" in paragraph.text and "1000" in paragraph.text:
-                    raise ValueError(f"Both 400 and 1000 matches legend file: {legend_file}")
-                elif "400" in paragraph.text:
-                    wavelength = 400
-                elif "1000" in paragraph.text:
-                    wavelength = 1000
-                else:
-                    raise ValueError(f"Unknown wavelength for {legend_file}:\n {paragraph.text}")
-
-                should_break = False
-                for match in matches:
-                    if match in path.name:
-                        should_break = True
-
-                if should_break:
-                    break
-            else:
-                warnings.warn(f"File {path.name} not in legend")
-                continue
-
-        # Track particles
-        out_path = path.parent / f"{path.stem}.csv"
+
+        out_path = path.parent / f"{path.stem}.parquet"
+        csv_path = path.parent / f"{path.stem}.csv"
         failed_path = path.parent / f"{path.stem}_failed"
-        start_time = time.time()
-        if out_path.is_file() or failed_path.is_file():
-            print("Already completed")
-            #continue
-
-        try:
-            tracks = track_particles(path,)
-        except OSError:
-            print(f"Failed opening file at {path}!")
-            failed[path] = "OSError"
-        except tp.linking.utils.SubnetOversizeException:
-            print(f"Failed linking at {path}!")
-            with failed_path.open("w") as f:
-                f.write("")
-            failed[path] = "SubnetOversizeException"
-        else:
-            stop_time = time.time()
-            duration = stop_time - start_time
-            print(f"Finished tracking, took {duration:.0f} s")
-            tracks["Wavelength"] = wavelength
-            tracks.to_csv(out_path)
-            print(f"Saved tracks: {out_path}")
+        if csv_path.is_file():
+            print(f"Already tracked {path}, convert {csv_path.name} with convert_tracks.py")
+            continue
+        if failed_path.is_file() and not args.retry_failed:
+            print(f"Skipping {path}, which failed before (see {failed_path.name})")
+            continue
+        jobs.append(
+            scheduler.Job(
+                name=str(path),
+                inputs=[path],
+                outputs=[out_path],
+                size=recording.size,
+                arguments=(path, out_path, failed_path, wavelength, workers),
+            )
+        )
+
+    start_time = time.time()
+    results = scheduler.run_jobs(
+        track_recording,
+        jobs,
+        workers=args.jobs,
+        lock_dir=parent / ".track_particles_locks",
+        lock_timeout__s=args.lock_timeout*3600,
+        summary_path=parent / f"track_particles_summary_task{task_id}.json",
+    )
+    print(f"Finished in {time.time() - start_time:.0f} s")
 
     print("These files were corrupt or failed:")
-    for path, reason in failed.items():
-        print(f"Failed {path} as consequence of {reason}")
+    for result in results:
+        if result.status == "failed":
+            reason = result.error.strip().splitlines()[-1]
+            print(f"Failed {result.name} as consequence of {reason}")
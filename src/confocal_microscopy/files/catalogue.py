@@ -0,0 +1,447 @@
+"""Catalogue of the recordings, snapshots and ROIs in a dataset.
+
+The catalogue is an SQLite database with one row per recording (``*red ch_*.ims``) and
+one row per snapshot (``*Snap*.ims``). Each recording row contains the size, modification
+time and a summary of the metadata of the recording, the excitation wavelength, the
+matching snapshot, the ROI vertices drawn on that snapshot and the output files that
+have been created for the recording.
+
+Refreshing the catalogue only lists the directories whose modification time has
+changed since the last refresh. The modification time of a directory changes when files
+are created, deleted or renamed in it, but not when an existing file is overwritten.
+Use ``refresh(root, full=True)`` to rescan all directories.
+
+Example
+-------
+
+>>> catalogue = Catalogue(Path.home() / "fish_catalogue.sqlite")
+>>> catalogue.refresh(Path("/media/yngve/TOSHIBA EXT (YNGVE)/fish_data/organised/"))
+>>> for recording in catalogue.recordings(wavelength=1000):
+...     print(recording.path, recording.snapshot)
+"""
+import fnmatch
+import json
+import os
+import re
+import sqlite3
+import warnings
+from collections import namedtuple
+from pathlib import Path
+
+from .metadata import get_metadata
+
+__all__ = ["Catalogue", "Recording", "Snapshot", "find_wavelength"]
+
+
+RECORDING_PATTERN = "*red ch_*.ims"
+SNAPSHOT_PATTERN = "*Snap*.ims"
+FILE_ID_PATTERN = r"\d\d[.]\d\d[.]\d\d"
+
+Recording = namedtuple(
+    "Recording",
+    [
+        "path", "size", "mtime_ns", "metadata", "wavelength", "snapshot", "vertices", "outputs",
+        "error",
+    ],
+)
+Snapshot = namedtuple("Snapshot", ["path", "size", "mtime_ns", "vertices"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirectories TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS recordings (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    metadata TEXT,
+    wavelength INTEGER,
+    snapshot TEXT,
+    outputs TEXT NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS recordings_directory ON recordings (directory);
+CREATE TABLE IF NOT EXISTS snapshots (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    vertices TEXT
+);
+CREATE INDEX IF NOT EXISTS snapshots_directory ON snapshots (directory);
+"""
+
+
+def _read_legend(legend_file):
+    import docx
+
+    document = docx.Document(legend_file)
+    return [paragraph.text for paragraph in document.paragraphs]
+
+
+def find_wavelength(path, legends=None):
+    """Find the wavelength of a recording from the name of its directory or from a legend file.
+
+    If the directory name contains neither 400 nor 1000, then the wavelength is found in the
+    paragraph of ``legend.docx`` that contains the file ID (e.g. ``12.34.56``) of the recording.
+
+    Arguments
+    ---------
+    path : pathlib.Path
+        Path to the recording.
+    legends : dict or None
+        Dictionary used to store parsed legend files, so each legend is only read once.
+
+    Returns
+    -------
+    int or None
+        The wavelength, or None if there is no legend or the recording is not in the legend.
+    """
+    if "1000" in path.parent.name:
+        return 1000
+    elif "400" in path.parent.name:
+        return 400
+
+    # If the wavelength is not in the parent folder name, we need a legend file
+    if (path.parent / "legend.docx").is_file():
+        legend_file = path.parent / "legend.docx"
+    elif (path.parent / "Legend.docx").is_file():
+        legend_file = path.parent / "Legend.docx"
+    else:
+        warnings.warn(f"No legend for {path}")
+        return None
+
+    if legends is None:
+        legends = {}
+    if legend_file not in legends:
+        legends[legend_file] = _read_legend(legend_file)
+
+    for paragraph in legends[legend_file]:
+        # Search for file IDs
+        matches = re.findall(FILE_ID_PATTERN, paragraph)
+        if len(matches) == 0:
+            # If no file marker is in the current paragraph, then continue
+            continue
+        elif len(matches) > 1:
+            # We should not have more than one file id per paragraph
+            warnings.warn(f"More than one legend match: {matches}")
+
+        if "400" in paragraph and "1000" in paragraph:
+            raise ValueError(f"Both 400 and 1000 matches legend file: {legend_file}")
+        elif "400" in paragraph:
+            wavelength = 400
+        elif "1000" in paragraph:
+            wavelength = 1000
+        else:
+            raise ValueError(f"Unknown wavelength for {legend_file}:\n {paragraph}")
+
+        if any(match in path.name for match in matches):
+            return wavelength
+
+    warnings.warn(f"File {path.name} not in legend")
+    return None
+
+
+def _summarise_metadata(path):
+    metadata = get_metadata(path)
+    return {
+        "shape": list(metadata.shape),
+        "extents__µm": metadata.extents__µm.tolist(),
+        "pixel_size__µm": metadata.pixel_size__µm.tolist(),
+        "frame_interval__s": metadata.frame_interval__s,
+    }
+
+
+def _read_vertices(snapshot_path):
+    vertex_file = snapshot_path.parent / f"{snapshot_path.stem}_vertices.json"
+    if not vertex_file.is_file():
+        return None
+    with vertex_file.open("r") as f:
+        return f.read()
+
+
+def _find_outputs(recording_path, entries):
+    """Find files (other than the metadata file) that start with the name of the recording.
+    """
+    stem = recording_path.stem
+    ignored = {recording_path.name, f"{stem}_metadata.txt"}
+    return {
+        entry.name: entry.stat().st_mtime_ns
+        for entry in entries
+        if entry.name.startswith(stem) and entry.name not in ignored
+    }
+
+
+class Catalogue:
+    """SQLite catalogue of a dataset, see the module docstring for details.
+
+    Arguments
+    ---------
+    database_path : pathlib.Path or str
+        Where to store the catalogue. Store it on a local disk, so queries don't touch the
+        (slow) disk the dataset is stored on.
+    recording_pattern : str
+        Glob pattern for recording file names.
+    snapshot_pattern : str
+        Glob pattern for snapshot file names.
+    """
+    def __init__(
+        self, database_path, recording_pattern=RECORDING_PATTERN, snapshot_pattern=SNAPSHOT_PATTERN
+    ):
+        self.database_path = database_path
+        self.recording_pattern = recording_pattern
+        self.snapshot_pattern = snapshot_pattern
+        self.connection = sqlite3.connect(str(database_path))
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def refresh(self, root, full=False):
+        """Update the catalogue with all changes in the directory tree under ``root``.
+
+        Arguments
+        ---------
+        root : pathlib.Path
+        full : bool
+            If True, then all directories are listed, not only the modified ones.
+
+        Returns
+        -------
+        list[pathlib.Path]
+            The directories that were listed.
+        """
+        listed_directories = []
+        legends = {}
+        directories = [Path(root)]
+        with self.connection:
+            while directories:
+                directory = directories.pop()
+                try:
+                    mtime_ns = directory.stat().st_mtime_ns
+                except FileNotFoundError:
+                    self._forget_directory(directory)
+                    continue
+
+                row = self.connection.execute(
+                    "SELECT mtime_ns, subdirectories FROM directories WHERE path = ?",
+                    (str(directory),),
+                ).fetchone()
+                if not full and row is not None and row[0] == mtime_ns:
+                    subdirectories = json.loads(row[1])
+                else:
+                    subdirectories = self._scan_directory(directory, mtime_ns, legends)
+                    listed_directories.append(directory)
+                directories.extend(directory / name for name in reversed(subdirectories))
+
+            self._link_snapshots()
+        return listed_directories
+
+    def _forget_directory(self, directory):
+        prefix = os.path.join(str(directory), "")
+        for table in ["directories", "recordings", "snapshots"]:
+            column = "path" if table == "directories" else "directory"
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE {column} = ? OR substr({column}, 1, ?) = ?",
+                (str(directory), len(prefix), prefix),
+            )
+
+    def _scan_directory(self, directory, mtime_ns, legends):
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        subdirectories = [entry.name for entry in entries if entry.is_dir()]
+        files = [entry for entry in entries if entry.is_file()]
+
+        # Remove deleted subdirectories
+        known_subdirectories = self.connection.execute(
+            "SELECT subdirectories FROM directories WHERE path = ?", (str(directory),)
+        ).fetchone()
+        if known_subdirectories is not None:
+            for name in set(json.loads(known_subdirectories[0])) - set(subdirectories):
+                self._forget_directory(directory / name)
+
+        recordings = [
+            entry for entry in files if fnmatch.fnmatch(entry.name, self.recording_pattern)
+        ]
+        snapshots = [
+            entry for entry in files if fnmatch.fnmatch(entry.name, self.snapshot_pattern)
+        ]
+        self._update_recordings(directory, recordings, files, legends)
+        self._update_snapshots(directory, snapshots)
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO directories (path, mtime_ns, subdirectories) VALUES (?, ?, ?)",
+            (str(directory), mtime_ns, json.dumps(subdirectories)),
+        )
+        return subdirectories
+
+    def _update_recordings(self, directory, recordings, files, legends):
+        known_recordings = {
+            path: (size, mtime_ns, metadata, error)
+            for path, size, mtime_ns, metadata, error in self.connection.execute(
+                "SELECT path, size, mtime_ns, metadata, error FROM recordings WHERE directory = ?",
+                (str(directory),)
+            )
+        }
+        for path in set(known_recordings) - {entry.path for entry in recordings}:
+            self.connection.execute("DELETE FROM recordings WHERE path = ?", (path,))
+
+        for entry in recordings:
+            path = Path(entry.path)
+            stat = entry.stat()
+            known_recording = known_recordings.get(entry.path)
+            is_unchanged = (
+                known_recording is not None
+                and known_recording[:2] == (stat.st_size, stat.st_mtime_ns)
+            )
+            if is_unchanged:
+                metadata, error = known_recording[2:]
+            else:
+                metadata, error = None, None
+                try:
+                    metadata = json.dumps(_summarise_metadata(path))
+                except Exception as e:
+                    error = f"Failed reading metadata: {e!r}"
+
+            try:
+                wavelength = find_wavelength(path, legends)
+            except (ValueError, OSError) as e:
+                wavelength = None
+                error = f"Failed finding wavelength: {e!r}"
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO recordings "
+                "(path, directory, size, mtime_ns, metadata, wavelength, outputs, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry.path,
+                    str(directory),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    metadata,
+                    wavelength,
+                    json.dumps(_find_outputs(path, files)),
+                    error,
+                ),
+            )
+
+    def _update_snapshots(self, directory, snapshots):
+        self.connection.execute("DELETE FROM snapshots WHERE directory = ?", (str(directory),))
+        for entry in snapshots:
+            stat = entry.stat()
+            self.connection.execute(
+                "INSERT INTO snapshots (path, directory, size, mtime_ns, vertices) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    entry.path,
+                    str(directory),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    _read_vertices(Path(entry.path)),
+                ),
+            )
+
+    def _link_snapshots(self):
+        """Match recordings with the first snapshot in the parent directory or the same directory.
+        """
+        snapshots = {}
+        query = "SELECT path, directory FROM snapshots ORDER BY path"
+        for path, directory in self.connection.execute(query):
+            snapshots.setdefault(directory, path)
+
+        recordings = self.connection.execute("SELECT path, directory FROM recordings").fetchall()
+        for path, directory in recordings:
+            snapshot = snapshots.get(str(Path(directory).parent), snapshots.get(directory))
+            self.connection.execute(
+                "UPDATE recordings SET snapshot = ? WHERE path = ?", (snapshot, path)
+            )
+
+    def _make_recording(self, row):
+        path, size, mtime_ns, metadata, wavelength, snapshot, vertices, outputs, error = row
+        return Recording(
+            path=Path(path),
+            size=size,
+            mtime_ns=mtime_ns,
+            metadata=None if metadata is None else json.loads(metadata),
+            wavelength=wavelength,
+            snapshot=None if snapshot is None else Path(snapshot),
+            vertices=None if vertices is None else json.loads(vertices),
+            outputs=json.loads(outputs),
+            error=error,
+        )
+
+    def recordings(self, root=None, wavelength=None, with_vertices=None):
+        """List the recordings in the catalogue, sorted by path.
+
+        Arguments
+        ---------
+        root : pathlib.Path or None
+            If given, then only recordings under this directory are listed.
+        wavelength : int or None
+            If given, then only recordings with this wavelength are listed.
+        with_vertices : bool or None
+            If True (False), then only recordings with (without) ROI vertices are listed.
+
+        Returns
+        -------
+        list[Recording]
+        """
+        conditions = []
+        parameters = []
+        if root is not None:
+            prefix = os.path.join(str(root), "")
+            conditions.append("substr(recordings.path, 1, ?) = ?")
+            parameters.extend([len(prefix), prefix])
+        if wavelength is not None:
+            conditions.append("recordings.wavelength = ?")
+            parameters.append(wavelength)
+        if with_vertices is not None:
+            conditions.append(f"snapshots.vertices IS {'NOT ' if with_vertices else ''}NULL")
+
+        query = (
+            "SELECT recordings.path, recordings.size, recordings.mtime_ns, recordings.metadata, "
+            "recordings.wavelength, recordings.snapshot, snapshots.vertices, recordings.outputs, "
+            "recordings.error "
+            "FROM recordings LEFT JOIN snapshots ON recordings.snapshot = snapshots.path"
+        )
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY recordings.path"
+        return [self._make_recording(row) for row in self.connection.execute(query, parameters)]
+
+    def find_recording(self, path):
+        """Get the catalogue entry of a recording, returns None if it is not in the catalogue.
+        """
+        for recording in self.recordings(root=Path(path).parent):
+            if recording.path == Path(path):
+                return recording
+        return None
+
+    def snapshots(self, root=None, with_vertices=None):
+        """List the snapshots in the catalogue, sorted by path.
+        """
+        conditions = []
+        parameters = []
+        if root is not None:
+            prefix = os.path.join(str(root), "")
+            conditions.append("substr(path, 1, ?) = ?")
+            parameters.extend([len(prefix), prefix])
+        if with_vertices is not None:
+            conditions.append(f"vertices IS {'NOT ' if with_vertices else ''}NULL")
+
+        query = "SELECT path, size, mtime_ns, vertices FROM snapshots"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY path"
+        return [
+            Snapshot(Path(path), size, mtime_ns, None if vertices is None else json.loads(vertices))
+            for path, size, mtime_ns, vertices in self.connection.execute(query, parameters)
+        ]
@@ -0,0 +1,131 @@
+"""Uncompressed, memory mapped copies of IMS videos.
+
+A frame cache is a ``.npy`` file with the cropped ``(T, H, W)`` video of one channel and
+resolution level, and a JSON sidecar with the parsed metadata. The cache is stored next
+to the IMS file and is only used as long as the IMS file is unchanged. Slicing the
+memory map is zero-copy, so analysis runs that use the cache do no decompression and
+no HDF5 group lookups.
+
+Use ``ims.convert_to_frame_cache`` to create the cache.
+"""
+import json
+import os
+
+import numpy as np
+
+
+def get_source_stamp(path):
+    """Information used to check if a file has changed since a cache was made from it.
+
+    The size and modification time of the ``{path.stem}_metadata.txt`` file are included
+    (None if there is no such file), since the videos are cropped to the size in it.
+    """
+    stat = path.stat()
+    metadata_path = path.parent / f"{path.stem}_metadata.txt"
+    try:
+        metadata_stat = metadata_path.stat()
+    except FileNotFoundError:
+        metadata_size, metadata_mtime_ns = None, None
+    else:
+        metadata_size, metadata_mtime_ns = metadata_stat.st_size, metadata_stat.st_mtime_ns
+    return {
+        "path": str(path.resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "metadata_size": metadata_size,
+        "metadata_mtime_ns": metadata_mtime_ns,
+    }
+
+
+def is_up_to_date(source_stamp, path):
+    try:
+        current_stamp = get_source_stamp(path)
+    except FileNotFoundError:
+        return False
+    # Stamps written before the metadata file was included have no metadata keys
+    return all(
+        source_stamp.get(key) == current_stamp[key]
+        for key in ["size", "mtime_ns", "metadata_size", "metadata_mtime_ns"]
+    )
+
+
+def get_frame_cache_paths(path, channel=0, resolution_level=0):
+    """Returns the path of the frame file and the path of the JSON sidecar.
+    """
+    stem = f"{path.stem}_frames_ch{channel}_rl{resolution_level}"
+    return path.parent / f"{stem}.npy", path.parent / f"{stem}.json"
+
+
+def load_frame_cache_metadata(path, channel=0, resolution_level=0):
+    """Load the sidecar of the frame cache, returns None if there is no up-to-date cache.
+    """
+    frames_path, sidecar_path = get_frame_cache_paths(path, channel, resolution_level)
+    if not frames_path.is_file() or not sidecar_path.is_file():
+        return None
+
+    with sidecar_path.open("r") as f:
+        sidecar = json.load(f)
+    if not is_up_to_date(sidecar["source"], path):
+        return None
+    return sidecar
+
+
+def open_frame_cache(path, channel=0, resolution_level=0, mode="r"):
+    """Memory map the cached ``(T, H, W)`` video, returns None if there is no up-to-date cache.
+
+    Arguments
+    ---------
+    path : pathlib.Path
+        Path to the IMS file (not the cache).
+    channel : int
+    resolution_level : int
+    mode : str
+        Memory map mode, ``"r"`` for read-only and ``"c"`` for copy-on-write.
+
+    Returns
+    -------
+    np.memmap(shape=(T, H, W)) or None
+    """
+    if load_frame_cache_metadata(path, channel, resolution_level) is None:
+        return None
+    frames_path, _ = get_frame_cache_paths(path, channel, resolution_level)
+    return np.load(frames_path, mmap_mode=mode)
+
+
+def create_frame_cache(path, shape, dtype, channel=0, resolution_level=0):
+    """Create a writable memory map for the frame cache.
+
+    The memory map is stored at a temporary path, which is moved into place
+    by ``finish_frame_cache`` once all frames are written.
+    """
+    frames_path, _ = get_frame_cache_paths(path, channel, resolution_level)
+    temporary_path = frames_path.parent / f"{frames_path.name}.tmp"
+    return np.lib.format.open_memmap(temporary_path, mode="w+", dtype=dtype, shape=shape)
+
+
+def finish_frame_cache(
+    path, frames, source_stamp, metadata, channel=0, resolution_level=0, chunks=None
+):
+    """Flush the frames created with ``create_frame_cache`` and write the sidecar.
+
+    The sidecar is written last, so interrupted conversions never leave a cache that looks valid.
+    ``chunks`` is the ``(H, W)`` shape of the HDF5 chunks of the IMS file, which is used
+    to crop the cache the same way as the IMS file.
+    """
+    frames_path, sidecar_path = get_frame_cache_paths(path, channel, resolution_level)
+    frames.flush()
+    temporary_path = frames.filename
+    del frames
+    os.replace(temporary_path, frames_path)
+
+    sidecar = {
+        "source": source_stamp,
+        "channel": channel,
+        "resolution_level": resolution_level,
+        "chunks": None if chunks is None else list(chunks),
+        "metadata": metadata,
+    }
+    temporary_path = sidecar_path.parent / f"{sidecar_path.name}.tmp"
+    with temporary_path.open("w") as f:
+        json.dump(sidecar, f)
+    os.replace(temporary_path, sidecar_path)
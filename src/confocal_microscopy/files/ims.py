@@ -1,8 +1,30 @@
-from abc import ABC, abstractmethod
+import contextlib
+import itertools
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
 
 import h5py
 import numpy as np
-from tqdm import trange
+from tqdm import tqdm, trange
+
+from ..filters import background as background_estimators
+from ..filters import exposure
+from . import frame_cache, statistics_cache
+from .metadata import IMSMetadata, decode_attribute, get_metadata, parse_config
+
+# Filter pipelines (shuffle, then gzip) that ``_decode_chunk`` can undo
+_DECOMPRESSABLE_PIPELINES = {
+    (),
+    (h5py.h5z.FILTER_DEFLATE,),
+    (h5py.h5z.FILTER_SHUFFLE,),
+    (h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE),
+}
 
 
 def load_image_stack(path, resolution_level=0, time_point=0, channel=0):
@@ -16,33 +38,572 @@ def load_image_stack(path, resolution_level=0, time_point=0, channel=0):
     return image
 
 
-def load_video_stack(path, resolution_level=0, channel=0, progress=False, num_timesteps=None):
-    metadata_path = path.parent / f"{path.stem}_metadata.txt"
-    metadata = parse_config(metadata_path)
+def _get_filter_pipeline(dataset):
+    plist = dataset.id.get_create_plist()
+    return tuple(plist.get_filter(i)[0] for i in range(plist.get_nfilters()))
+
+
+def _supports_chunk_decompression(dataset):
+    """Check if we can decompress the chunks of ``dataset`` ourselves (gzip with optional shuffle).
+    """
+    if dataset.chunks is None:
+        return False
+    return _get_filter_pipeline(dataset) in _DECOMPRESSABLE_PIPELINES
+
+
+def _decode_chunk(raw_chunk, filter_mask, pipeline, dtype, chunk_shape):
+    for filter_idx in reversed(range(len(pipeline))):
+        if filter_mask & (1 << filter_idx):
+            continue
+        if pipeline[filter_idx] == h5py.h5z.FILTER_DEFLATE:
+            raw_chunk = zlib.decompress(raw_chunk)
+        elif pipeline[filter_idx] == h5py.h5z.FILTER_SHUFFLE and dtype.itemsize > 1:
+            shuffled = np.frombuffer(raw_chunk, dtype=np.uint8).reshape(dtype.itemsize, -1)
+            raw_chunk = shuffled.T.tobytes()
+    return np.frombuffer(raw_chunk, dtype=dtype).reshape(chunk_shape)
+
+
+def _open_raw_file(h5):
+    """Open a file descriptor used to read compressed chunks without going through HDF5.
+
+    Returns None if the chunks cannot be read directly from the file.
+    """
+    if h5.driver != "sec2" or not hasattr(os, "pread"):
+        return None
+    return os.open(h5.filename, os.O_RDONLY)
+
 
-    width = int(metadata["Width"])
-    height = int(metadata["Height"])
+def _read_chunks_into(dataset, out, start=None, file_descriptor=None):
+    """Read the hyperslab of ``dataset`` starting at ``start`` into ``out``, one chunk at a time.
 
-    if progress:
-        range_ = trange
+    The compressed chunks are decompressed with zlib, which releases the GIL. Several
+    threads calling this function will therefore decompress their datasets in parallel,
+    even though h5py serialises all HDF5 calls. If a ``file_descriptor`` from
+    ``_open_raw_file`` is given, then the compressed chunks are also read with
+    ``os.pread`` instead of HDF5, so waiting for the disk doesn't hold the GIL either.
+    """
+    if start is None:
+        start = (0,)*out.ndim
+    stop = tuple(first + size for first, size in zip(start, out.shape))
+    pipeline = _get_filter_pipeline(dataset)
+    chunk_shape = dataset.chunks
+    chunk_starts = itertools.product(
+        *(range(first - first % chunk_size, last, chunk_size)
+          for first, last, chunk_size in zip(start, stop, chunk_shape))
+    )
+    for chunk_start in chunk_starts:
+        overlap = [
+            (max(first, chunk_first), min(last, chunk_first + chunk_size))
+            for first, last, chunk_first, chunk_size in zip(start, stop, chunk_start, chunk_shape)
+        ]
+        target = tuple(slice(low - first, high - first) for (low, high), first in zip(overlap, start))
+        chunk_info = dataset.id.get_chunk_info_by_coord(chunk_start)
+        if chunk_info.byte_offset is None:
+            out[target] = dataset.fillvalue
+            continue
+
+        if file_descriptor is None:
+            filter_mask, raw_chunk = dataset.id.read_direct_chunk(chunk_start)
+        else:
+            filter_mask = chunk_info.filter_mask
+            raw_chunk = os.pread(file_descriptor, chunk_info.size, chunk_info.byte_offset)
+        chunk = _decode_chunk(raw_chunk, filter_mask, pipeline, dataset.dtype, chunk_shape)
+        source = tuple(
+            slice(low - first, high - first) for (low, high), first in zip(overlap, chunk_start)
+        )
+        out[target] = chunk[source]
+
+
+def _read_cropped(dataset, out, start=None, decompress_chunks=False, file_descriptor=None):
+    """Read the hyperslab of ``dataset`` starting at ``start`` into ``out`` without temporary copies.
+    """
+    if start is None:
+        start = (0,)*out.ndim
+    hyperslab = tuple(slice(first, first + size) for first, size in zip(start, out.shape))
+    if decompress_chunks and _supports_chunk_decompression(dataset):
+        _read_chunks_into(dataset, out, start=start, file_descriptor=file_descriptor)
+    elif out.flags.c_contiguous:
+        dataset.read_direct(out, hyperslab)
     else:
-        range_ = range
+        out[...] = dataset[hyperslab]
+
+
+BoundingBox = namedtuple("BoundingBox", ["y_start", "y_stop", "x_start", "x_stop"])
+
+
+def get_bounding_box(roi, frame_shape, chunk_shape=None):
+    """Find the bounding box of a ROI, optionally expanded outwards to HDF5 chunk boundaries.
+
+    Reading whole chunks costs the same as reading part of them, so the expanded box
+    is as cheap to load as the tight box.
+
+    Arguments
+    ---------
+    roi : dict[str, list[float]] or tuple[int]
+        Either a dictionary containing two vertex lists, one for the x coordinate
+        and one for the y coordinate of each vertex in a polygonal ROI, or a
+        bounding box ``(y_start, y_stop, x_start, x_stop)``.
+    frame_shape : tuple[int]
+        Height and width of the (cropped) frames.
+    chunk_shape : tuple[int] or None
+        Height and width of the HDF5 chunks. If None, then the box is not expanded.
+
+    Returns
+    -------
+    BoundingBox
+        The bounding box ``(y_start, y_stop, x_start, x_stop)``, in full-frame pixel coordinates.
+    """
+    if isinstance(roi, dict):
+        y_start, y_stop = int(np.floor(min(roi['y']))), int(np.floor(max(roi['y']))) + 1
+        x_start, x_stop = int(np.floor(min(roi['x']))), int(np.floor(max(roi['x']))) + 1
+    else:
+        y_start, y_stop, x_start, x_stop = (int(coordinate) for coordinate in roi)
+
+    height, width = frame_shape
+    y_start, y_stop = max(0, y_start), min(height, y_stop)
+    x_start, x_stop = max(0, x_start), min(width, x_stop)
+    if y_start >= y_stop or x_start >= x_stop:
+        raise ValueError(f"The ROI does not overlap with the {height}x{width} frame")
+
+    if chunk_shape is not None:
+        chunk_height, chunk_width = chunk_shape
+        y_start = y_start - y_start % chunk_height
+        y_stop = min(height, -(-y_stop // chunk_height) * chunk_height)
+        x_start = x_start - x_start % chunk_width
+        x_stop = min(width, -(-x_stop // chunk_width) * chunk_width)
+    return BoundingBox(y_start, y_stop, x_start, x_stop)
+
+
+class _FramePrefetcher:
+    """Read frames in a background thread, staying at most ``num_frames`` ahead of the consumer.
+
+    Frames are returned in the same order as ``time_points``. Exceptions raised while
+    reading are re-raised by ``get``.
+    """
+    _end = object()
+
+    def __init__(self, read_frame, time_points, num_frames):
+        self._queue = queue.Queue(maxsize=num_frames)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._read_frames, args=(read_frame, time_points), daemon=True
+        )
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _read_frames(self, read_frame, time_points):
+        try:
+            for time_point in time_points:
+                if not self._put((time_point, read_frame(time_point))):
+                    return
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(self._end)
+
+    def get(self):
+        item = self._queue.get()
+        if item is self._end:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self._stop_event.set()
+        self._thread.join()
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "num_frames", "num_bytes", "max_bytes"])
+
+
+class _LRUFrameCache:
+    """Least recently used cache of frames, bounded by the total number of bytes.
+
+    Cached frames are made read-only, since the same array is returned on every hit.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.num_bytes = 0
+        self._frames = OrderedDict()
+
+    def get(self, key):
+        frame = self._frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame):
+        if frame.nbytes > self.max_bytes:
+            return
+        if key in self._frames:
+            self.num_bytes -= self._frames.pop(key).nbytes
+
+        frame.flags.writeable = False
+        self._frames[key] = frame
+        self.num_bytes += frame.nbytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted_frame = self._frames.popitem(last=False)
+            self.num_bytes -= evicted_frame.nbytes
+
+    def clear(self):
+        self._frames.clear()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, len(self._frames), self.num_bytes, self.max_bytes)
+
+
+StageTimings = namedtuple("StageTimings", ["read__s", "preprocess__s", "wait__s"])
+
+
+def _get_cropped_video_shape(resolution_group, channel, num_timesteps, width, height):
+    first_frame = resolution_group[f"TimePoint 0/Channel {channel}/Data"]
+    depth, full_height, full_width = first_frame.shape
+    shape = (num_timesteps, depth, min(height, full_height), min(width, full_width))
+    return shape, first_frame.dtype
+
+
+def _get_frame_chunk_shape(resolution_group, channel):
+    chunks = resolution_group[f"TimePoint 0/Channel {channel}/Data"].chunks
+    return None if chunks is None else chunks[1:]
+
+
+def get_video_shape(path, resolution_level=0, channel=0):
+    """Get the ``(T, Z, H, W)`` shape and the data type of the cropped video without reading it.
+    """
+    metadata = get_metadata(path)
     with h5py.File(path, "r") as h5:
-        dataset = h5[f"DataSet/"]
-        resolution_group = dataset[f"ResolutionLevel {resolution_level}"]
-        if num_timesteps is None:
-            num_timesteps = len(resolution_group)
-        dataset_pattern = f"TimePoint {{time_point}}/Channel {channel}/Data"
+        resolution_group = h5[f"DataSet/ResolutionLevel {resolution_level}"]
+        return _get_cropped_video_shape(
+            resolution_group, channel, len(resolution_group), metadata.width, metadata.height
+        )
 
-        frames = [
-            resolution_group[dataset_pattern.format(time_point=time_point)][:, :height, :width]
-            for time_point in range_(num_timesteps)
-        ]
-    return np.stack(frames, axis=0)
+
+def _load_cached_video_stack(path, resolution_level, channel, num_timesteps, out, roi):
+    cache_metadata = frame_cache.load_frame_cache_metadata(path, channel, resolution_level)
+    cached_frames = frame_cache.open_frame_cache(path, channel, resolution_level, mode="c")
+    if cache_metadata is None or cached_frames is None:
+        return None, None
+
+    bounding_box = None
+    if roi is not None:
+        bounding_box = get_bounding_box(roi, cached_frames.shape[1:], cache_metadata.get("chunks"))
+        y_start, y_stop, x_start, x_stop = bounding_box
+        cached_frames = cached_frames[:, y_start:y_stop, x_start:x_stop]
+
+    if num_timesteps is not None and num_timesteps > len(cached_frames):
+        raise ValueError(
+            f"Cannot load {num_timesteps} time points, the video has {len(cached_frames)}"
+        )
+    cached_frames = cached_frames[:num_timesteps, np.newaxis]
+    if out is None:
+        return cached_frames, bounding_box
+    if out.shape != cached_frames.shape:
+        raise ValueError(
+            f"The output array has shape {out.shape}, but the video has shape {cached_frames.shape}"
+        )
+    out[...] = cached_frames
+    return out, bounding_box
+
+
+def load_video_stack(
+    path,
+    resolution_level=0,
+    channel=0,
+    progress=False,
+    num_timesteps=None,
+    out=None,
+    num_workers=1,
+    use_cache=True,
+    roi=None,
+    return_bounding_box=False,
+):
+    """Load a video as a ``(T, Z, H, W)`` array, cropped to the size in the metadata file.
+
+    The output array is allocated once (or supplied with ``out``, which can for example
+    be a memory map) and each time point is read directly into it. With ``num_workers > 1``,
+    the time points are decompressed in parallel by a thread pool.
+
+    If the video is converted with ``convert_to_frame_cache``, then a copy-on-write view
+    of the memory mapped frame cache is returned instead (unless ``out`` is given).
+
+    Arguments
+    ---------
+    path : pathlib.Path
+        Path to the IMS file. The metadata file ``{path.stem}_metadata.txt`` must be in the same directory.
+    resolution_level : int
+    channel : int
+    progress : bool
+        If True, then a progressbar is shown.
+    num_timesteps : int or None
+        Number of time points to load, all time points are loaded if None.
+    out : np.ndarray or None
+        Array of shape ``(T, Z, H, W)`` to store the video in.
+    num_workers : int
+        Number of threads used to decompress the video.
+    use_cache : bool
+        If True, then the frame cache is used if it exists and is up to date.
+    roi : dict[str, list[float]] or tuple[int] or None
+        If given, then only the bounding box of this ROI is read, expanded to
+        chunk boundaries. See ``get_bounding_box`` for the supported formats.
+    return_bounding_box : bool
+        If True, then the bounding box of the loaded region is also returned. Add its
+        ``y_start`` and ``x_start`` to coordinates found in the cropped video to get
+        full-frame coordinates. The bounding box is None if no ``roi`` is given.
+
+    Returns
+    -------
+    np.ndarray(shape=(T, Z, H, W))
+    BoundingBox or None
+        Only returned if ``return_bounding_box`` is True.
+    """
+    video = None
+    if use_cache:
+        video, bounding_box = _load_cached_video_stack(
+            path, resolution_level, channel, num_timesteps, out, roi
+        )
+    if video is None:
+        video, bounding_box = _load_ims_video_stack(
+            path, resolution_level, channel, progress, num_timesteps, out, num_workers, roi
+        )
+
+    if return_bounding_box:
+        return video, bounding_box
+    return video
+
+
+def _load_ims_video_stack(
+    path, resolution_level, channel, progress, num_timesteps, out, num_workers, roi
+):
+    time_points = None if num_timesteps is None else range(num_timesteps)
+    hyperstack, bounding_box = load_hyperstack(
+        path,
+        channels=[channel],
+        time_points=time_points,
+        resolution_level=resolution_level,
+        progress=progress,
+        out=None if out is None else out[:, np.newaxis],
+        num_workers=num_workers,
+        roi=roi,
+        return_bounding_box=True,
+    )
+    if out is None:
+        out = hyperstack[:, 0]
+    return out, bounding_box
+
+
+def load_hyperstack(
+    path,
+    channels=None,
+    time_points=None,
+    resolution_level=0,
+    progress=False,
+    out=None,
+    num_workers=1,
+    roi=None,
+    return_bounding_box=False,
+):
+    """Load several channels and time points as a ``(T, C, Z, H, W)`` array.
+
+    The file is opened once and each time point group is looked up once for all channels.
+    The output array is allocated once (or supplied with ``out``) and every channel of
+    every time point is read directly into it. With ``num_workers > 1``, the channels
+    and time points are decompressed in parallel by a thread pool.
+
+    Arguments
+    ---------
+    path : pathlib.Path
+        Path to the IMS file. The metadata file ``{path.stem}_metadata.txt`` must be in the same directory.
+    channels : list[int] or None
+        Channels to load, all channels are loaded if None.
+    time_points : iterable[int] or None
+        Time points to load (in the given order), all time points are loaded if None.
+    resolution_level : int
+    progress : bool
+        If True, then a progressbar is shown.
+    out : np.ndarray or None
+        Array of shape ``(T, C, Z, H, W)`` to store the video in.
+    num_workers : int
+        Number of threads used to decompress the video.
+    roi : dict[str, list[float]] or tuple[int] or None
+        If given, then only the bounding box of this ROI is read, expanded to
+        chunk boundaries. See ``get_bounding_box`` for the supported formats.
+    return_bounding_box : bool
+        If True, then the bounding box of the loaded region is also returned.
+        The bounding box is None if no ``roi`` is given.
+
+    Returns
+    -------
+    np.ndarray(shape=(T, C, Z, H, W))
+    BoundingBox or None
+        Only returned if ``return_bounding_box`` is True.
+    """
+    metadata = get_metadata(path)
+    width = metadata.width
+    height = metadata.height
+
+    with h5py.File(path, "r") as h5:
+        resolution_group = h5[f"DataSet/ResolutionLevel {resolution_level}"]
+        num_time_points = len(resolution_group)
+        if time_points is None:
+            time_points = range(num_time_points)
+        time_points = list(time_points)
+        invalid_time_points = [t for t in time_points if not 0 <= t < num_time_points]
+        if invalid_time_points:
+            raise ValueError(
+                f"Cannot load time points {invalid_time_points}, the video has {num_time_points}"
+            )
+        if channels is None:
+            channels = range(len(resolution_group["TimePoint 0"]))
+        channels = list(channels)
+
+        shape, dtype = _get_cropped_video_shape(
+            resolution_group, channels[0], len(time_points), width, height
+        )
+        for channel in channels[1:]:
+            channel_shape, channel_dtype = _get_cropped_video_shape(
+                resolution_group, channel, len(time_points), width, height
+            )
+            if channel_shape != shape or channel_dtype != dtype:
+                raise ValueError(
+                    f"Channel {channel} has shape {channel_shape} and dtype {channel_dtype}, but "
+                    f"channel {channels[0]} has shape {shape} and dtype {dtype}"
+                )
+
+        start = (0, 0, 0)
+        bounding_box = None
+        if roi is not None:
+            chunk_shape = _get_frame_chunk_shape(resolution_group, channels[0])
+            bounding_box = get_bounding_box(roi, shape[2:], chunk_shape)
+            y_start, y_stop, x_start, x_stop = bounding_box
+            start = (0, y_start, x_start)
+            shape = (shape[0], shape[1], y_stop - y_start, x_stop - x_start)
+        shape = (shape[0], len(channels), *shape[1:])
+
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError(f"The output array has shape {out.shape}, but the video has shape {shape}")
+
+        def get_datasets(time_point):
+            time_group = resolution_group[f"TimePoint {time_point}"]
+            return [time_group[f"Channel {channel}/Data"] for channel in channels]
+
+        if num_workers == 1:
+            for i, time_point in enumerate(tqdm(time_points, disable=not progress)):
+                for c, dataset in enumerate(get_datasets(time_point)):
+                    _read_cropped(dataset, out[i, c], start=start)
+        else:
+            file_descriptor = _open_raw_file(h5)
+            try:
+                with ThreadPoolExecutor(num_workers) as executor:
+                    futures = []
+                    for i, time_point in enumerate(time_points):
+                        futures.append([
+                            executor.submit(
+                                _read_cropped,
+                                dataset,
+                                out[i, c],
+                                start=start,
+                                decompress_chunks=True,
+                                file_descriptor=file_descriptor,
+                            )
+                            for c, dataset in enumerate(get_datasets(time_point))
+                        ])
+                    for time_point_futures in tqdm(futures, disable=not progress):
+                        for future in time_point_futures:
+                            future.result()
+            finally:
+                if file_descriptor is not None:
+                    os.close(file_descriptor)
+
+    if return_bounding_box:
+        return out, bounding_box
+    return out
+
+
+def convert_to_frame_cache(
+    path, resolution_level=0, channel=0, progress=False, num_workers=1, overwrite=False
+):
+    """Store the cropped video as an uncompressed ``(T, H, W)`` memory map next to the IMS file.
+
+    After conversion, ``load_video_stack`` and ``LazyIMSVideoLoader`` read frames from the
+    memory map instead of the IMS file, as long as the IMS file is not modified.
+
+    Arguments
+    ---------
+    path : pathlib.Path
+        Path to the IMS file. The metadata file ``{path.stem}_metadata.txt`` must be in the same directory.
+    resolution_level : int
+    channel : int
+    progress : bool
+        If True, then a progressbar is shown.
+    num_workers : int
+        Number of threads used to decompress the video.
+    overwrite : bool
+        If False, then up-to-date caches are not converted again.
+
+    Returns
+    -------
+    np.memmap(shape=(T, H, W))
+        Read-only memory map of the frame cache.
+    """
+    if not overwrite:
+        cached_frames = frame_cache.open_frame_cache(path, channel, resolution_level)
+        if cached_frames is not None:
+            return cached_frames
+
+    source_stamp = frame_cache.get_source_stamp(path)
+    metadata = get_metadata(path)
+    width = metadata.width
+    height = metadata.height
+
+    with h5py.File(path, "r") as h5:
+        resolution_group = h5[f"DataSet/ResolutionLevel {resolution_level}"]
+        num_timesteps = len(resolution_group)
+        shape, dtype = _get_cropped_video_shape(resolution_group, channel, num_timesteps, width, height)
+        chunk_shape = _get_frame_chunk_shape(resolution_group, channel)
+    if shape[1] != 1:
+        raise ValueError(f"Can only create frame caches for 2D videos, not videos of shape {shape}")
+
+    frames = frame_cache.create_frame_cache(
+        path, (shape[0], *shape[2:]), dtype, channel, resolution_level
+    )
+    load_video_stack(
+        path,
+        resolution_level=resolution_level,
+        channel=channel,
+        progress=progress,
+        out=frames[:, np.newaxis],
+        num_workers=num_workers,
+        use_cache=False,
+    )
+    metadata = {"config": metadata.config, "ims": load_ims_metadata(path)}
+    frame_cache.finish_frame_cache(
+        path, frames, source_stamp, metadata, channel, resolution_level, chunk_shape
+    )
+    return frame_cache.open_frame_cache(path, channel, resolution_level)
 
 
 def _stringify_bytes_array(bytes_array):
-    return ''.join(bytes_array.astype(str))
+    return decode_attribute(bytes_array)
 
 
 def load_ims_metadata(path):
@@ -63,37 +624,53 @@ def find_physical_image_size(attrs):
     return [max_val - min_val for max_val, min_val in zip(max_vals, min_vals)]
 
 
-def parse_config(file):
-    with open(file, "r") as f:
-        config_data = f.readlines()
-    data = {}
-    stack = [data]
-    curr_level = 0
-    prev_level = 0
-    for line in config_data:
-        while line.startswith("\t"):
-            curr_level += 1
-            line = line[1:]
-        if curr_level < prev_level:
-            num_levels_up = prev_level - curr_level
-            for level in range(num_levels_up):
-                stack.pop()
-        line = line.strip()
-        if line[0] == "[":
-            name = line.replace("[", "").replace("]", "")
-            data[name] = {}
-            stack.append(data[name])
-        elif line[0] == "{":
-            key = line.split("{DisplayName=")[1].split(", Value")[0]
-            value = line.split("Value=")[1][:-1]
-        else:
-            key, *value = line.split("=")
-            value = "=".join(value)
-        stack[-1][key] = value
-    return data
+class LazyIMSVideoLoader:
+    """Iterable and indexable video that reads and preprocesses one frame at a time.
+
+    Subclasses implement ``_preprocess``, or a ``preprocessor`` (e.g. a
+    ``filters.FramePreprocessor``) is given, which is called as
+    ``preprocessor(frames, background_signal, limits)``. Slices and lists of frames are
+    preprocessed as one ``(B, H, W)`` block by the ``preprocessor``.
 
+    The background signal is stored with the working data type ``dtype`` (float32 by
+    default), so subtracting it from the (uint16) frames gives ``dtype`` frames. It is
+    computed with the ``background`` estimator, the name of an estimator in
+    ``filters.background.BACKGROUND_ESTIMATORS`` or an estimator instance, and cached
+    with the other statistics. Time varying backgrounds (e.g. ``"running_median"``) are
+    given to the ``preprocessor`` frame by frame, while ``background_signal`` and
+    ``_preprocess`` use their temporal mean.
+
+    If ``limits`` is None, then they are the minimum and maximum of the background
+    subtracted frames, or the ``limit_percentiles`` of them if given. The percentiles
+    are computed from a histogram in an extra pass over the frames.
+
+    With ``workers > 1``, frames are read and preprocessed by a thread pool while the
+    frames are iterated over, and returned in order. The preprocessing must therefore
+    be thread safe. ``filters.FramePreprocessor`` is thread safe as long as no ``out``
+    array is given, and numpy, scipy and numba release the GIL for the heavy steps.
+    ``stage_timings`` reports the time spent reading, preprocessing and waiting for frames.
+
+    Loaders can be pickled, e.g. to send them to worker processes. The open file, the
+    thread pool and the cached frames are not pickled, and the file is opened again when
+    the first frame is read from the unpickled loader. Unpickled loaders use one worker,
+    since they are meant to be used by one of several processes. The background signal
+    and the limits are pickled, so they are not computed again.
+    """
+    # Open files, threads, locks, iterators and cached frames, which can't be pickled
+    _UNPICKLED_ATTRIBUTES = (
+        "h5",
+        "_resolution_group",
+        "_cached_frames",
+        "_file_descriptor",
+        "_executor",
+        "_pending_frames",
+        "_prefetcher",
+        "_stage_times_lock",
+        "_lru_cache",
+        "_time_point_iterator",
+        "_time_points_to_submit",
+    )
 
-class LazyIMSVideoLoader(ABC):
     def __init__(
         self,
         path,
@@ -103,94 +680,509 @@ class LazyIMSVideoLoader(ABC):
         limits=None,
         progress=True,
         compute_background=True,
+        use_cache=True,
+        prefetch=0,
+        lru_cache_bytes=0,
+        roi=None,
+        preprocessor=None,
+        dtype=np.float32,
+        workers=1,
+        background="mean",
+        limit_percentiles=None,
     ):
         self.path = path
-        metadata_path = path.parent / f"{path.stem}_metadata.txt"
-        metadata = parse_config(metadata_path)
+        self.metadata = get_metadata(path)
+        self.preprocessor = preprocessor
+        self.dtype = np.dtype(dtype)
+        self.roi = roi
+        self.bounding_box = None
 
-        self._width = int(metadata["Width"])
-        self._height = int(metadata["Height"])
+        self._width = self.metadata.width
+        self._height = self.metadata.height
         self._num_timesteps = num_timesteps
         self._resolution_level = resolution_level
+        self._channel = channel
+        self._use_cache = use_cache
+        self._prefetch = prefetch
+        self._prefetcher = None
+        self._workers = workers
+        self._executor = None
+        self._pending_frames = deque()
+        self._stage_times = {"read": 0.0, "preprocess": 0.0, "wait": 0.0}
+        self._stage_times_lock = threading.Lock()
+        self._file_descriptor = None
+        self._lru_cache = _LRUFrameCache(lru_cache_bytes)
+        self._is_open = False
         self._dataset_pattern = f"TimePoint {{time_point}}/Channel {channel}/Data"
         self._current_timepoint = 0
         self._limits = limits
+        self._limit_percentiles = limit_percentiles
 
         self.should_preprocess = True
         self.background_signal = None
+        self.background_estimator = background_estimators.get_background_estimator(background)
         self.should_compute_background = compute_background
+        self._background_statistics = None
 
         if progress:
             self._range = trange
         else:
             self._range = range
 
-    def _compute_background_signal(self):
-        background_signal = 0
-        print("Computing mean", flush=True)
-        for frame in self:
-            background_signal += frame.astype(float)
-        return background_signal / len(self)
+    def _compute_statistics(self):
+        """Compute the background signal and the per-pixel minimum and maximum of the video.
 
-    def _compute_limits(self):
-        print("Computing signal limits", flush=True)
-        limits = [np.inf, -np.inf]
-        for frame in self:
-            limits[1] = max(limits[1], np.max(frame - self.background_signal))
-            limits[0] = min(limits[0], np.min(frame - self.background_signal))
+        The frames are read one at a time, once for each pass of the background estimator.
+        """
+        print("Computing background signal and signal limits", flush=True)
+        return self.background_estimator.fit(
+            lambda: (frame[np.newaxis] for frame in self), len(self)
+        )
+
+    def _load_or_compute_statistics(self):
+        statistics = None
+        bounding_box = None if self.roi is None else self.bounding_box
+        estimator_name = self.background_estimator.name
+        if self._use_cache:
+            statistics = statistics_cache.load_statistics(
+                self.path,
+                self._channel,
+                self._resolution_level,
+                self._num_timesteps,
+                estimator=estimator_name,
+            )
+            if statistics is not None and bounding_box is not None:
+                # The statistics are per-pixel, so full-frame statistics can be cropped to the ROI
+                y_start, y_stop, x_start, x_stop = bounding_box
+                statistics = {
+                    name: value[..., y_start:y_stop, x_start:x_stop] if value.ndim >= 2 else value
+                    for name, value in statistics.items()
+                }
+            elif bounding_box is not None:
+                statistics = statistics_cache.load_statistics(
+                    self.path,
+                    self._channel,
+                    self._resolution_level,
+                    self._num_timesteps,
+                    bounding_box,
+                    estimator=estimator_name,
+                )
+        if statistics is None:
+            statistics = self._compute_statistics()
+            if self._use_cache:
+                statistics_cache.save_statistics(
+                    self.path,
+                    statistics,
+                    self._channel,
+                    self._resolution_level,
+                    self._num_timesteps,
+                    bounding_box,
+                    estimator=estimator_name,
+                )
+        return statistics
+
+    def get_background_signal(self, time_points=None):
+        """Background signal of a time point or a ``(B, H, W)`` stack for several time points.
+
+        The background is the same for all time points unless the background estimator
+        is time varying. ``background_signal`` is returned if ``time_points`` is None.
+        """
+        if time_points is None or not self.background_estimator.time_varying:
+            return self.background_signal
+        if self._background_statistics is None:
+            return self.background_signal
+        background_signal = self.background_estimator.get_background(
+            self._background_statistics, time_points
+        )
+        return background_signal.astype(self.dtype, copy=False)
+
+    def _compute_limits(self, statistics):
+        """Find the minimum and maximum of ``frame - background_signal`` over all frames.
+
+        The background signal is constant in time, so this is the same as subtracting
+        it from the per-pixel minimum and maximum. If ``limit_percentiles`` are given,
+        then they are computed from a histogram of the background subtracted frames
+        between the minimum and maximum.
+        """
+        background_signal = 0 if self.background_signal is None else self.background_signal
+        # For time varying backgrounds, this uses the temporal mean of the background
+        limits = [
+            np.min(statistics["min"] - background_signal),
+            np.max(statistics["max"] - background_signal),
+        ]
+        if self._limit_percentiles is not None:
+            limits = list(self._compute_percentile_limits(limits))
         limits[0] = max(0, limits[0])
         limits = tuple(limits)
         return limits
 
-    def __enter__(self):
-        self.h5 = h5py.File(self.path, "r")
-        try:
+    def _compute_percentile_limits(self, value_range):
+        print("Computing signal limits", flush=True)
+        histogram = exposure.StreamingHistogram(self.dtype, value_range=value_range)
+        for time_point, frame in enumerate(self):
+            background_signal = self.get_background_signal(time_point)
+            if background_signal is None:
+                histogram.update(frame)
+            else:
+                histogram.update(frame - background_signal)
+        return histogram.percentiles(self._limit_percentiles)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._UNPICKLED_ATTRIBUTES:
+            state.pop(name, None)
+        state["_lru_cache_bytes"] = self._lru_cache.max_bytes
+        state["_is_open"] = False
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        lru_cache_bytes = state.pop("_lru_cache_bytes")
+        self.__dict__.update(state)
+        self.h5 = None
+        self._cached_frames = None
+        self._file_descriptor = None
+        self._executor = None
+        self._pending_frames = deque()
+        self._prefetcher = None
+        self._stage_times_lock = threading.Lock()
+        self._lru_cache = _LRUFrameCache(lru_cache_bytes)
+        self._workers = 1
+
+    def _ensure_open(self):
+        """Open the file if it isn't open, e.g. after the loader is unpickled.
+        """
+        if not self._is_open:
+            self._open()
+
+    def _open(self):
+        self._is_open = True
+        self.h5 = None
+        self._cached_frames = None
+        if self._use_cache:
+            self._cached_frames = frame_cache.open_frame_cache(
+                self.path, self._channel, self._resolution_level, mode="c"
+            )
+
+        if self._cached_frames is not None:
+            total_timesteps = len(self._cached_frames)
+            frame_shape = self._cached_frames.shape[1:]
+            cache_metadata = frame_cache.load_frame_cache_metadata(
+                self.path, self._channel, self._resolution_level
+            )
+            chunk_shape = cache_metadata.get("chunks")
+        else:
+            self.h5 = h5py.File(self.path, "r")
             dataset = self.h5["DataSet/"]
             self._resolution_group = dataset[f"ResolutionLevel {self._resolution_level}"]
-            if self._num_timesteps is None:
-                self._num_timesteps = len(self._resolution_group)
+            total_timesteps = len(self._resolution_group)
+            video_shape, _ = _get_cropped_video_shape(
+                self._resolution_group, self._channel, total_timesteps, self._width, self._height
+            )
+            frame_shape = video_shape[2:]
+            chunk_shape = _get_frame_chunk_shape(self._resolution_group, self._channel)
+            if self._prefetch > 0 or self._workers > 1:
+                self._file_descriptor = _open_raw_file(self.h5)
+        if self._workers > 1:
+            self._executor = ThreadPoolExecutor(self._workers)
 
+        if self.roi is None:
+            self.bounding_box = BoundingBox(0, frame_shape[0], 0, frame_shape[1])
+        else:
+            self.bounding_box = get_bounding_box(self.roi, frame_shape, chunk_shape)
+        if self._cached_frames is not None:
+            y_start, y_stop, x_start, x_stop = self.bounding_box
+            self._cached_frames = self._cached_frames[:, y_start:y_stop, x_start:x_stop]
+
+        if self._num_timesteps is None:
+            self._num_timesteps = total_timesteps
+
+    def _close(self):
+        self._stop_prefetching()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._file_descriptor is not None:
+            os.close(self._file_descriptor)
+            self._file_descriptor = None
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+        self._cached_frames = None
+        self._lru_cache.clear()
+        self._is_open = False
+
+    @contextlib.contextmanager
+    def _time_stage(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            with self._stage_times_lock:
+                self._stage_times[stage] += duration
+
+    def stage_timings(self):
+        """Time spent reading, preprocessing and waiting for frames since the loader was opened.
+
+        With ``workers > 1`` or prefetching, reading and preprocessing are summed over
+        all threads, and the waiting time is the time the consumer of the frames waited
+        for them. If the waiting time is small, then the consumer is the bottleneck.
+        """
+        with self._stage_times_lock:
+            stage_times = self._stage_times
+            return StageTimings(
+                stage_times["read"], stage_times["preprocess"], stage_times["wait"]
+            )
+
+    def _reset_stage_timings(self):
+        with self._stage_times_lock:
+            for stage in self._stage_times:
+                self._stage_times[stage] = 0.0
+
+    def _read_frame(self, time_point):
+        with self._time_stage("read"):
+            if self._cached_frames is not None:
+                return self._cached_frames[time_point]
+            y_start, y_stop, x_start, x_stop = self.bounding_box
+            dataset = self._resolution_group[self._dataset_pattern.format(time_point=time_point)]
+            if self._file_descriptor is None:
+                return dataset[:, y_start:y_stop, x_start:x_stop].squeeze()
+
+            frame_shape = (dataset.shape[0], y_stop - y_start, x_stop - x_start)
+            frame = np.empty(frame_shape, dtype=dataset.dtype)
+            _read_cropped(
+                dataset,
+                frame,
+                start=(0, y_start, x_start),
+                decompress_chunks=True,
+                file_descriptor=self._file_descriptor,
+            )
+            return frame.squeeze()
+
+    def _read_frames(self, time_points):
+        """Read several frames, which should be sorted to read the file front to back.
+        """
+        if self._cached_frames is not None:
+            with self._time_stage("read"):
+                return self._cached_frames[time_points]
+        return (self._read_frame(time_point) for time_point in time_points)
+
+    def _read_frame_ahead(self, time_point):
+        frame = self._read_frame(time_point)
+        if self._cached_frames is not None:
+            # Copy the memory mapped frame, so the reader thread waits for the disk
+            frame = np.array(frame)
+        return frame
+
+    def _read_and_preprocess(self, time_point):
+        return self.preprocess(self._read_frame_ahead(time_point), time_point)
+
+    def _submit_frames(self):
+        """Keep enough frames in flight to keep the worker threads busy.
+        """
+        num_frames = max(self._prefetch, 2*self._workers)
+        while len(self._pending_frames) < num_frames:
+            time_point = next(self._time_points_to_submit, None)
+            if time_point is None:
+                return
+            frame = self._lru_cache.get((time_point, self.should_preprocess))
+            if frame is None:
+                future = self._executor.submit(self._read_and_preprocess, time_point)
+            else:
+                future = Future()
+                future.set_result(frame)
+            self._pending_frames.append(future)
+
+    def _stop_prefetching(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+        for future in self._pending_frames:
+            future.cancel()
+        self._pending_frames.clear()
+
+    def __enter__(self):
+        self._open()
+        try:
             should_preprocess = self.should_preprocess
             self.should_preprocess = False
-            if self.background_signal is None and self.should_compute_background:
-                self.background_signal = self._compute_background_signal()
+            should_compute_background = (
+                self.background_signal is None and self.should_compute_background
+            )
+            if should_compute_background or self._limits is None:
+                statistics = self._load_or_compute_statistics()
+            if should_compute_background:
+                background_signal = self.background_estimator.get_background(statistics)
+                self.background_signal = background_signal.astype(self.dtype)
+                self._background_statistics = statistics
             if self._limits is None:
-                self._limits = self._compute_limits()
+                self._limits = self._compute_limits(statistics)
 
             self.should_preprocess = should_preprocess
+            self._lru_cache.clear()
+            self._reset_stage_timings()
         except Exception as e:
-            self.h5.close()
+            self._close()
             raise e
 
         return self
 
     def __iter__(self):
+        self._ensure_open()
+        self._stop_prefetching()
         self._time_point_iterator = iter(self._range(self._num_timesteps))
+        if self._executor is not None:
+            self._time_points_to_submit = iter(range(self._num_timesteps))
+            self._submit_frames()
+        elif self._prefetch > 0:
+            self._prefetcher = _FramePrefetcher(
+                self._read_frame_ahead, range(self._num_timesteps), self._prefetch
+            )
         return self
 
     def __len__(self):
         return self._num_timesteps
 
     def __next__(self):
-        time_point = next(self._time_point_iterator)
-        dataset_name = self._dataset_pattern.format(time_point=time_point)
+        try:
+            time_point = next(self._time_point_iterator)
+        except StopIteration:
+            self._stop_prefetching()
+            raise
+
         self._current_timepoint += 1
-        frame = self._resolution_group[dataset_name][:, :self._height, :self._width]
-        return self.preprocess(frame.squeeze())
+        if self._executor is not None:
+            future = self._pending_frames.popleft()
+            with self._time_stage("wait"):
+                frame = future.result()
+            self._submit_frames()
+            self._lru_cache.put((time_point, self.should_preprocess), frame)
+            return frame
+        if self._prefetcher is not None:
+            with self._time_stage("wait"):
+                _, frame = self._prefetcher.get()
+            return self._preprocess_and_cache(time_point, frame)
+        return self._get_frames([time_point])[0]
 
     def __exit__(self, type, value, traceback):
-        self.h5.close()
+        self._close()
+
+    def _normalise_time_point(self, time_point):
+        if time_point < -len(self) or time_point >= len(self):
+            raise IndexError(f"Time point {time_point} is out of bounds for {len(self)} time points")
+        return int(time_point) % len(self)
+
+    def _preprocess_and_cache(self, time_point, frame):
+        frame = self.preprocess(frame, time_point)
+        self._lru_cache.put((time_point, self.should_preprocess), frame)
+        return frame
+
+    def _get_frames(self, time_points):
+        self._ensure_open()
+        frames = {}
+        missing_time_points = []
+        for time_point in sorted(set(time_points)):
+            frame = self._lru_cache.get((time_point, self.should_preprocess))
+            if frame is None:
+                missing_time_points.append(time_point)
+            else:
+                frames[time_point] = frame
+
+        raw_frames = self._read_frames(missing_time_points)
+        if self.preprocessor is not None and self.should_preprocess and len(missing_time_points) > 1:
+            if not isinstance(raw_frames, np.ndarray):
+                raw_frames = np.stack(list(raw_frames), axis=0)
+            preprocessed_frames = self.preprocessor(
+                raw_frames, self.get_background_signal(missing_time_points), self._limits
+            )
+            for time_point, frame in zip(missing_time_points, preprocessed_frames):
+                self._lru_cache.put((time_point, True), frame)
+                frames[time_point] = frame
+        elif self._executor is not None and self.should_preprocess:
+            preprocessed_frames = self._executor.map(
+                self.preprocess, raw_frames, missing_time_points
+            )
+            for time_point, frame in zip(missing_time_points, preprocessed_frames):
+                self._lru_cache.put((time_point, True), frame)
+                frames[time_point] = frame
+        else:
+            for time_point, frame in zip(missing_time_points, raw_frames):
+                frames[time_point] = self._preprocess_and_cache(time_point, frame)
+        return [frames[time_point] for time_point in time_points]
+
+    def __getitem__(self, index):
+        """Get preprocessed frames, indexed by an integer, a slice or a list of integers.
+
+        Slices and lists of time points return the frames stacked along the first axis.
+        """
+        if isinstance(index, (int, np.integer)):
+            return self._get_frames([self._normalise_time_point(index)])[0]
+
+        if isinstance(index, slice):
+            time_points = list(range(*index.indices(len(self))))
+        else:
+            time_points = [self._normalise_time_point(time_point) for time_point in index]
+        if len(time_points) == 0:
+            self._ensure_open()
+            y_start, y_stop, x_start, x_stop = self.bounding_box
+            return np.empty((0, y_stop - y_start, x_stop - x_start), dtype=self.dtype)
+        return np.stack(self._get_frames(time_points), axis=0)
+
+    def to_full_frame(self, features):
+        """Convert the ``x`` and ``y`` columns of located features from ROI to full-frame coordinates.
+        """
+        features = features.copy()
+        features["y"] += self.bounding_box.y_start
+        features["x"] += self.bounding_box.x_start
+        return features
+
+    def cache_key(self):
+        """The video and the settings that change the preprocessed frames, as a JSON dict.
+
+        Results computed from the frames, e.g. located features, can be stored with this key,
+        and are stale if the key changes. The loader must be open, so the bounding box and
+        the limits are known.
+        """
+        preprocessor = self.preprocessor
+        if preprocessor is not None:
+            # The public attributes are the settings, e.g. of a ``filters.FramePreprocessor``
+            settings = {
+                name: value for name, value in getattr(preprocessor, "__dict__", {}).items()
+                if not name.startswith("_")
+            }
+            preprocessor = {"type": type(preprocessor).__qualname__, **settings}
+        return {
+            "loader": type(self).__qualname__,
+            "source": frame_cache.get_source_stamp(Path(self.path)),
+            "channel": self._channel,
+            "resolution_level": self._resolution_level,
+            "num_frames": len(self),
+            "bounding_box": [int(value) for value in self.bounding_box],
+            "dtype": self.dtype.str,
+            "background": self.background_estimator.name,
+            "compute_background": self.should_compute_background,
+            "limits": None if self._limits is None else [float(value) for value in self._limits],
+            "limit_percentiles": self._limit_percentiles,
+            "preprocessor": preprocessor,
+        }
+
+    def cache_info(self):
+        """Hits, misses and size of the LRU cache of preprocessed frames.
+        """
+        return self._lru_cache.info()
 
-    def __getitem__(self, time_point):
-        dataset_name = self._dataset_pattern.format(time_point=time_point)
-        frame = self._resolution_group[dataset_name][:, :self._height, :self._width]
-        return self.preprocess(frame.squeeze())
+    def clear_cache(self):
+        self._lru_cache.clear()
 
-    def preprocess(self, frame):
+    def preprocess(self, frame, time_point=None):
         if not self.should_preprocess:
             return frame
-        return self._preprocess(frame)
+        with self._time_stage("preprocess"):
+            if self.preprocessor is not None:
+                background_signal = self.get_background_signal(time_point)
+                return self.preprocessor(frame, background_signal, self._limits)
+            return self._preprocess(frame)
 
-    @abstractmethod
     def _preprocess(self, frame):
         return frame
@@ -0,0 +1,201 @@
+"""Metadata of IMS files.
+
+``get_metadata`` returns an ``IMSMetadata`` object, which reads the attribute groups of
+``DataSetInfo`` one at a time, and only decodes the attributes that are used. The
+objects are cached for the whole process, keyed by the path and modification time
+of the IMS file and its ``_metadata.txt`` file.
+"""
+from collections.abc import Mapping
+from functools import lru_cache
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+
+def parse_config(file):
+    with open(file, "r") as f:
+        config_data = f.readlines()
+    data = {}
+    stack = [data]
+    curr_level = 0
+    prev_level = 0
+    for line in config_data:
+        while line.startswith("\t"):
+            curr_level += 1
+            line = line[1:]
+        if curr_level < prev_level:
+            num_levels_up = prev_level - curr_level
+            for level in range(num_levels_up):
+                stack.pop()
+        line = line.strip()
+        if line[0] == "[":
+            name = line.replace("[", "").replace("]", "")
+            data[name] = {}
+            stack.append(data[name])
+        elif line[0] == "{":
+            key = line.split("{DisplayName=")[1].split(", Value")[0]
+            value = line.split("Value=")[1][:-1]
+        else:
+            key, *value = line.split("=")
+            value = "=".join(value)
+        stack[-1][key] = value
+    return data
+
+
+def decode_attribute(bytes_array):
+    """Imaris stores attributes as arrays of characters, this function joins them to a string.
+    """
+    return bytes_array.tobytes().replace(b"\0", b"").decode("ascii")
+
+
+class LazyAttributes(Mapping):
+    """Read-only mapping of raw attribute arrays, which are decoded when they are accessed.
+    """
+    def __init__(self, raw_attributes):
+        self._raw_attributes = raw_attributes
+        self._decoded = {}
+
+    def __getitem__(self, key):
+        if key not in self._decoded:
+            self._decoded[key] = decode_attribute(self._raw_attributes[key])
+        return self._decoded[key]
+
+    def __iter__(self):
+        return iter(self._raw_attributes)
+
+    def __len__(self):
+        return len(self._raw_attributes)
+
+
+class IMSMetadata(Mapping):
+    """Metadata of an IMS file and its ``_metadata.txt`` file.
+
+    Indexing the object with a ``DataSetInfo`` group name (e.g. ``metadata["TimeInfo"]``)
+    returns the decoded attributes of that group, the same way as the dictionary
+    returned by ``ims.load_ims_metadata``. Groups are only read from the file when
+    they are accessed.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._groups = {}
+        self._group_names = None
+        self._config = None
+        self._timestamps = None
+
+    @property
+    def config_path(self):
+        return self.path.parent / f"{self.path.stem}_metadata.txt"
+
+    @property
+    def config(self):
+        """The parsed ``_metadata.txt`` file.
+        """
+        if self._config is None:
+            self._config = parse_config(self.config_path)
+        return self._config
+
+    def _read_group(self, group):
+        with h5py.File(self.path, "r") as h5:
+            info = h5["DataSetInfo"]
+            if self._group_names is None:
+                self._group_names = list(info)
+            attributes = info[group].attrs
+            return LazyAttributes({name: attributes[name] for name in attributes})
+
+    def __getitem__(self, group):
+        if group not in self._groups:
+            self._groups[group] = self._read_group(group)
+        return self._groups[group]
+
+    def __iter__(self):
+        if self._group_names is None:
+            with h5py.File(self.path, "r") as h5:
+                self._group_names = list(h5["DataSetInfo"])
+        return iter(self._group_names)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    @property
+    def width(self):
+        return int(self.config["Width"])
+
+    @property
+    def height(self):
+        return int(self.config["Height"])
+
+    @property
+    def depth(self):
+        return int(self["Image"].get("Z", 1))
+
+    @property
+    def num_timesteps(self):
+        return len(self.timestamps)
+
+    @property
+    def shape(self):
+        """Shape of the video, ``(T, Z, H, W)``, cropped to the size in the ``_metadata.txt`` file.
+        """
+        return self.num_timesteps, self.depth, self.height, self.width
+
+    @property
+    def extents__µm(self):
+        """Physical size of the image along the ``(Z, Y, X)`` axes.
+        """
+        image_attrs = self["Image"]
+        max_vals = np.array([float(image_attrs[f"ExtMax{i}"]) for i in [2, 1, 0]])
+        min_vals = np.array([float(image_attrs[f"ExtMin{i}"]) for i in [2, 1, 0]])
+        return max_vals - min_vals
+
+    @property
+    def pixel_size__µm(self):
+        """Physical size of a pixel along the ``(Y, X)`` axes.
+        """
+        return self.extents__µm[1:] / np.array([self.height, self.width])
+
+    @property
+    def timestamps(self):
+        """Acquisition time of all frames as a ``datetime64[us]`` array.
+        """
+        if self._timestamps is None:
+            time_info = self["TimeInfo"]
+            time_points = sorted(
+                int(key[len("TimePoint"):]) for key in time_info
+                if key.startswith("TimePoint") and key[len("TimePoint"):].isdigit()
+            )
+            timestamps = [time_info[f"TimePoint{time_point}"] for time_point in time_points]
+            self._timestamps = np.array(timestamps, dtype="datetime64[us]")
+        return self._timestamps
+
+    @property
+    def relative_timestamps__s(self):
+        """Time since the first frame, in seconds.
+        """
+        return (self.timestamps - self.timestamps[0]) / np.timedelta64(1, "s")
+
+    @property
+    def frame_interval__s(self):
+        """Mean time between two consecutive frames, in seconds.
+        """
+        return self.relative_timestamps__s[-1] / (self.num_timesteps - 1)
+
+
+@lru_cache(maxsize=256)
+def _get_metadata(path, mtime_ns, config_mtime_ns):
+    return IMSMetadata(path)
+
+
+def _get_mtime_ns(path):
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_metadata(path):
+    """Get the metadata of the IMS file at ``path``, reusing it if the file is unchanged.
+    """
+    path = Path(path).resolve()
+    config_path = path.parent / f"{path.stem}_metadata.txt"
+    return _get_metadata(path, _get_mtime_ns(path), _get_mtime_ns(config_path))
@@ -0,0 +1,88 @@
+"""Persistent per-pixel statistics of IMS videos.
+
+The statistics are stored in a ``.npz`` sidecar next to the IMS file. The sidecar
+is keyed by the path and modification time of the IMS file, the channel, the resolution
+level, the number of time points and the bounding box of the ROI (if the statistics
+are only computed for a ROI), and is ignored if any of these change. Statistics from
+different background estimators (see ``filters.background``) are stored in separate
+sidecars, named after the estimator.
+"""
+import json
+import os
+
+import numpy as np
+
+from .frame_cache import get_source_stamp, is_up_to_date
+
+
+def get_statistics_path(path, channel=0, resolution_level=0, bounding_box=None, estimator=None):
+    stem = f"{path.stem}_statistics"
+    if estimator is not None:
+        stem = f"{stem}_{estimator}"
+    stem = f"{stem}_ch{channel}_rl{resolution_level}"
+    if bounding_box is not None:
+        y_start, y_stop, x_start, x_stop = bounding_box
+        stem = f"{stem}_y{y_start}-{y_stop}_x{x_start}-{x_stop}"
+    return path.parent / f"{stem}.npz"
+
+
+def _make_key(channel, resolution_level, num_timesteps, bounding_box, estimator):
+    return {
+        "estimator": estimator,
+        "channel": channel,
+        "resolution_level": resolution_level,
+        "num_timesteps": num_timesteps,
+        "bounding_box": None if bounding_box is None else [int(value) for value in bounding_box],
+    }
+
+
+def save_statistics(
+    path,
+    statistics,
+    channel=0,
+    resolution_level=0,
+    num_timesteps=None,
+    bounding_box=None,
+    estimator=None,
+):
+    """Store a dictionary of arrays computed from the video at ``path``.
+
+    ``estimator`` is the name of the background estimator the statistics are computed
+    with, None for the temporal mean.
+    """
+    key = _make_key(channel, resolution_level, num_timesteps, bounding_box, estimator)
+    key["source"] = get_source_stamp(path)
+    statistics_path = get_statistics_path(
+        path, channel, resolution_level, bounding_box, estimator
+    )
+    # Write to a temporary file first, so interrupted writes never leave a truncated sidecar
+    partial_path = statistics_path.parent / f"{statistics_path.name}.partial"
+    with partial_path.open("wb") as f:
+        np.savez(f, key=json.dumps(key), **statistics)
+    os.replace(partial_path, statistics_path)
+
+
+def load_statistics(
+    path, channel=0, resolution_level=0, num_timesteps=None, bounding_box=None, estimator=None
+):
+    """Load the statistics stored with ``save_statistics``.
+
+    Returns None if the statistics are missing or out of date.
+    """
+    statistics_path = get_statistics_path(
+        path, channel, resolution_level, bounding_box, estimator
+    )
+    if not statistics_path.is_file():
+        return None
+
+    with np.load(statistics_path) as statistics_file:
+        statistics = dict(statistics_file)
+    key = json.loads(str(statistics.pop("key")))
+    source_stamp = key.pop("source")
+    if key != _make_key(channel, resolution_level, num_timesteps, bounding_box, estimator):
+        return None
+    if source_stamp["path"] != str(path.resolve()):
+        return None
+    if not is_up_to_date(source_stamp, path):
+        return None
+    return statistics
@@ -0,0 +1,205 @@
+"""Synthetic videos of moving particles, stored with the same layout as Imaris IMS files.
+
+Used to test and benchmark the IMS readers without real recordings.
+
+Example
+-------
+
+>>> video = make_particle_video(100, shape=(1, 256, 256), num_particles=50, seed=0)
+>>> write_ims_file(Path("synthetic red ch_1.ims"), video, width=250, height=240)
+"""
+from datetime import datetime, timedelta
+
+import h5py
+import numpy as np
+
+
+def make_particle_video(
+    num_timesteps,
+    shape=(1, 64, 64),
+    num_particles=10,
+    sigma=1.5,
+    speed__px_per_frame=1.0,
+    brightness=1000,
+    background=100,
+    noise=10,
+    dtype=np.uint16,
+    seed=None,
+):
+    """Create a ``(T, Z, Y, X)`` video of Gaussian particles moving with constant velocity.
+
+    The particles start at random positions, move in random directions and wrap around
+    the edges of the frame. All slices along the Z-axis are equal.
+
+    Arguments
+    ---------
+    num_timesteps : int
+    shape : tuple[int]
+        Shape of each time point, ``(Z, Y, X)``.
+    num_particles : int
+    sigma : float
+        Standard deviation of the Gaussian particles, in pixels.
+    speed__px_per_frame : float
+    brightness : float
+        Peak intensity of the particles.
+    background : float
+        Constant background intensity.
+    noise : float
+        Standard deviation of the additive Gaussian noise.
+    dtype : np.dtype
+    seed : int or None
+        Seed of the random number generator.
+
+    Returns
+    -------
+    np.ndarray(shape=(T, Z, Y, X))
+    """
+    random_state = np.random.RandomState(seed)
+    depth, height, width = shape
+    start_positions = random_state.uniform(0, 1, size=(num_particles, 2)) * [height, width]
+    angles = random_state.uniform(0, 2*np.pi, size=num_particles)
+    velocities = speed__px_per_frame * np.stack([np.sin(angles), np.cos(angles)], axis=1)
+
+    y = np.arange(height)
+    x = np.arange(width)
+    video = np.empty((num_timesteps, depth, height, width), dtype=dtype)
+    for time_point in range(num_timesteps):
+        positions = (start_positions + time_point*velocities) % [height, width]
+
+        # The Gaussians are separable, so the frame is a sum of outer products
+        y_profiles = np.exp(-0.5*((y - positions[:, 0, np.newaxis]) / sigma)**2)
+        x_profiles = np.exp(-0.5*((x - positions[:, 1, np.newaxis]) / sigma)**2)
+        frame = background + brightness * (y_profiles.T @ x_profiles)
+        frame += random_state.normal(0, noise, size=frame.shape)
+
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            frame = np.clip(np.round(frame), info.min, info.max)
+        video[time_point] = frame
+    return video
+
+
+def _as_ims_attribute(value):
+    """Imaris stores attributes as arrays of single characters.
+    """
+    return np.array(list(str(value)), dtype="S1")
+
+
+def write_ims_file(
+    path,
+    video,
+    width=None,
+    height=None,
+    chunks=(1, 16, 16),
+    compression="gzip",
+    compression_opts=None,
+    shuffle=False,
+    pixel_size__µm=0.5,
+    frame_interval__s=0.1,
+):
+    """Store a ``(T, Z, Y, X)`` or ``(T, C, Z, Y, X)`` video with the same layout as Imaris IMS files.
+
+    The metadata file ``{path.stem}_metadata.txt`` is written next to the IMS file.
+
+    Arguments
+    ---------
+    path : pathlib.Path
+    video : np.ndarray
+    width : int or None
+        Width stored in the metadata file, the video is padded to ``X`` pixels.
+        Defaults to ``X``.
+    height : int or None
+        Height stored in the metadata file, defaults to ``Y``.
+    chunks : tuple[int] or None
+        HDF5 chunk shape of each ``(Z, Y, X)`` frame.
+    compression : str or None
+        HDF5 compression filter, e.g. ``"gzip"``.
+    compression_opts : int or None
+        Options for the compression filter, e.g. the gzip level.
+    shuffle : bool
+        If True, then the shuffle filter is applied before compression.
+    pixel_size__µm : float
+    frame_interval__s : float
+
+    Returns
+    -------
+    pathlib.Path
+        The path of the IMS file.
+    """
+    if video.ndim == 4:
+        video = video[:, np.newaxis]
+    if width is None:
+        width = video.shape[-1]
+    if height is None:
+        height = video.shape[-2]
+
+    with h5py.File(path, "w") as h5:
+        resolution_group = h5.create_group("DataSet/ResolutionLevel 0")
+        for time_point, frames in enumerate(video):
+            for channel, frame in enumerate(frames):
+                resolution_group.create_dataset(
+                    f"TimePoint {time_point}/Channel {channel}/Data",
+                    data=frame,
+                    chunks=chunks,
+                    compression=compression,
+                    compression_opts=compression_opts,
+                    shuffle=shuffle,
+                )
+
+        image_info = h5.create_group("DataSetInfo/Image")
+        for axis, size in zip("ZYX", video.shape[2:]):
+            image_info.attrs[axis] = _as_ims_attribute(size)
+        extents = [pixel_size__µm*width, pixel_size__µm*height, video.shape[2]]
+        for i, extent in enumerate(extents):
+            image_info.attrs[f"ExtMin{i}"] = _as_ims_attribute(0)
+            image_info.attrs[f"ExtMax{i}"] = _as_ims_attribute(extent)
+
+        custom_data = h5.create_group("DataSetInfo/CustomData")
+        custom_data.attrs["Width"] = _as_ims_attribute(width)
+        custom_data.attrs["Height"] = _as_ims_attribute(height)
+
+        time_info = h5.create_group("DataSetInfo/TimeInfo")
+        time_info.attrs["DatasetTimePoints"] = _as_ims_attribute(len(video))
+        time_info.attrs["FileTimePoints"] = _as_ims_attribute(len(video))
+        start_time = datetime(2020, 10, 1, 12)
+        for time_point in range(len(video)):
+            timestamp = start_time + timedelta(seconds=time_point*frame_interval__s)
+            time_info.attrs[f"TimePoint{time_point + 1}"] = _as_ims_attribute(
+                timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            )
+
+    metadata_path = path.parent / f"{path.stem}_metadata.txt"
+    with metadata_path.open("w") as f:
+        f.write(f"Width={width}\nHeight={height}\n")
+    return path
+
+
+def write_synthetic_ims_file(
+    path,
+    num_timesteps,
+    shape=(1, 64, 64),
+    width=None,
+    height=None,
+    chunks=(1, 16, 16),
+    compression="gzip",
+    compression_opts=None,
+    shuffle=False,
+    seed=None,
+    **particle_kwargs,
+):
+    """Write a video made with ``make_particle_video`` to an IMS file.
+
+    See ``make_particle_video`` for the particle arguments and ``write_ims_file``
+    for the file arguments.
+    """
+    video = make_particle_video(num_timesteps, shape=shape, seed=seed, **particle_kwargs)
+    return write_ims_file(
+        path,
+        video,
+        width=width,
+        height=height,
+        chunks=chunks,
+        compression=compression,
+        compression_opts=compression_opts,
+        shuffle=shuffle,
+    )
@@ -0,0 +1,237 @@
+"""Compressed storage of particle tracks.
+
+Tracks are stored in Parquet files with the fixed schema ``TRACK_SCHEMA``. The rows are
+split into row groups of ``frames_per_row_group`` consecutive frames and sorted by frame
+and particle, so the minimum and maximum frame and particle stored for each row group
+let ``read_tracks`` skip the row groups that don't match the ``frames`` and ``particles``
+filters. Only the requested columns are read. The metadata of the recording, e.g. the
+pixel size and the frame interval, is stored as JSON in the key-value metadata of the
+file, and can be updated until the file is closed, e.g. with the linking parameters.
+
+Track CSV files written by earlier versions of ``scripts/track_particles.py`` can be
+converted with ``convert_csv``.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+__all__ = [
+    "TRACK_SCHEMA",
+    "TrackWriter",
+    "write_tracks",
+    "read_tracks",
+    "read_track_metadata",
+    "get_recording_metadata",
+    "convert_csv",
+]
+
+
+TRACK_SCHEMA = pa.schema(
+    [
+        pa.field("frame", pa.int32(), nullable=False),
+        pa.field("x", pa.float32(), nullable=False),
+        pa.field("y", pa.float32(), nullable=False),
+        pa.field("mass", pa.float32(), nullable=False),
+        pa.field("size", pa.float32(), nullable=False),
+        pa.field("ecc", pa.float32(), nullable=False),
+        pa.field("signal", pa.float32(), nullable=False),
+        # Not all track files have the raw mass and the position uncertainty of trackpy
+        pa.field("raw_mass", pa.float32(), nullable=True),
+        pa.field("ep", pa.float32(), nullable=True),
+        pa.field("particle", pa.int64(), nullable=False),
+        pa.field("wavelength", pa.int32(), nullable=True),
+    ]
+)
+
+_METADATA_KEY = b"confocal_microscopy"
+# Columns of the CSV files written by earlier versions of scripts/track_particles.py
+_RENAMED_COLUMNS = {"Wavelength": "wavelength"}
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, Path):
+        return str(value)
+    raise TypeError(f"Cannot store {type(value)} in the track metadata")
+
+
+def _to_table(tracks, wavelength=None):
+    """Convert a DataFrame of tracks to a table with the track schema, ignoring other columns.
+    """
+    tracks = tracks.rename(columns=_RENAMED_COLUMNS)
+    if "wavelength" not in tracks.columns:
+        tracks = tracks.assign(wavelength=wavelength)
+    missing_nullable_columns = {
+        field.name: None for field in TRACK_SCHEMA
+        if field.nullable and field.name not in tracks.columns
+    }
+    tracks = tracks.assign(**missing_nullable_columns)
+
+    missing_columns = [name for name in TRACK_SCHEMA.names if name not in tracks.columns]
+    if missing_columns:
+        raise ValueError(f"The tracks have no {', '.join(missing_columns)} column")
+
+    columns = []
+    for field in TRACK_SCHEMA:
+        column = tracks[field.name]
+        if field.nullable:
+            columns.append(pa.array(column, type=field.type, from_pandas=True))
+        else:
+            columns.append(pa.array(column.to_numpy(dtype=field.type.to_pandas_dtype())))
+    return pa.Table.from_arrays(columns, schema=TRACK_SCHEMA)
+
+
+class TrackWriter:
+    """Write tracks to a Parquet file chunk by chunk, e.g. the chunks of ``iter_tracks``.
+
+    The rows do not have to be sorted by frame. They are kept until all rows of their
+    row group are likely to have been written, that is, until a frame two row groups later
+    is written, and then sorted by frame and particle and stored. Rows that are written
+    after their row group is stored are stored in an extra row group, so the file is still
+    correct, but reading a range of frames is slower.
+
+    Arguments
+    ---------
+    path : pathlib.Path or str
+    metadata : dict or None
+        JSON serialisable metadata of the recording, e.g. ``pixel_size__µm`` and
+        ``frame_interval__s``. NumPy arrays and scalars are converted to lists and numbers.
+        It is stored in the ``metadata`` attribute, which is written when the file is
+        closed, so it can be updated while the tracks are written.
+    wavelength : int or None
+        Wavelength of the tracks that have no ``wavelength`` column.
+    frames_per_row_group : int
+    compression : str
+        Compression codec of the Parquet file, see ``pyarrow.parquet.ParquetWriter``.
+    """
+    def __init__(
+        self,
+        path,
+        metadata=None,
+        wavelength=None,
+        frames_per_row_group=1000,
+        compression="zstd",
+    ):
+        self.path = Path(path)
+        self.wavelength = wavelength
+        self.frames_per_row_group = frames_per_row_group
+        self.metadata = {} if metadata is None else dict(metadata)
+        self._writer = pq.ParquetWriter(self.path, TRACK_SCHEMA, compression=compression)
+        self._pending_rows = {}
+        self._last_frame = None
+
+    def write(self, tracks):
+        """Add a DataFrame with the columns of ``TRACK_SCHEMA`` (other columns are ignored).
+        """
+        if len(tracks) == 0:
+            return
+        row_groups = tracks["frame"].to_numpy() // self.frames_per_row_group
+        for row_group, rows in tracks.groupby(row_groups, sort=False):
+            self._pending_rows.setdefault(row_group, []).append(rows)
+
+        last_frame = int(tracks["frame"].max())
+        if self._last_frame is None or last_frame > self._last_frame:
+            self._last_frame = last_frame
+        last_row_group = self._last_frame // self.frames_per_row_group
+        for row_group in sorted(self._pending_rows):
+            if row_group + 2 > last_row_group:
+                break
+            self._write_row_group(row_group)
+
+    def _write_row_group(self, row_group):
+        rows = pd.concat(self._pending_rows.pop(row_group), ignore_index=True)
+        rows = rows.sort_values(["frame", "particle"], ignore_index=True)
+        self._writer.write_table(_to_table(rows, self.wavelength), row_group_size=len(rows))
+
+    def close(self):
+        for row_group in sorted(self._pending_rows):
+            self._write_row_group(row_group)
+        metadata = json.dumps(self.metadata, default=_to_json)
+        self._writer.add_key_value_metadata({_METADATA_KEY: metadata.encode("utf-8")})
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def write_tracks(path, tracks, metadata=None, **kwargs):
+    """Write a DataFrame of tracks to a Parquet file, see ``TrackWriter`` for the arguments.
+    """
+    with TrackWriter(path, metadata, **kwargs) as writer:
+        writer.write(tracks)
+    return Path(path)
+
+
+def read_tracks(path, columns=None, frames=None, particles=None):
+    """Read tracks from a Parquet file, only reading the row groups that match the filters.
+
+    Arguments
+    ---------
+    path : pathlib.Path or str
+    columns : list[str] or None
+        Columns to read, all columns if None.
+    frames : tuple[int] or None
+        Read the frames from ``frames[0]`` up to, but not including, ``frames[1]``.
+    particles : Iterable[int] or None
+        Read only these particles.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    filters = []
+    if frames is not None:
+        start, stop = frames
+        filters.extend([("frame", ">=", int(start)), ("frame", "<", int(stop))])
+    if particles is not None:
+        filters.append(("particle", "in", [int(particle) for particle in particles]))
+    table = pq.read_table(path, columns=columns, filters=filters or None)
+    return table.to_pandas()
+
+
+def read_track_metadata(path):
+    """Read the metadata of the recording stored with the tracks.
+    """
+    metadata = pq.read_metadata(path).metadata or {}
+    return json.loads(metadata.get(_METADATA_KEY, b"{}").decode("utf-8"))
+
+
+def get_recording_metadata(ims_metadata):
+    """The metadata stored with the tracks of a recording, from its ``IMSMetadata``.
+    """
+    return {
+        "source": ims_metadata.path.name,
+        "pixel_size__µm": ims_metadata.pixel_size__µm,
+        "frame_interval__s": ims_metadata.frame_interval__s,
+    }
+
+
+def convert_csv(csv_path, output_path=None, metadata=None, chunk_size=1_000_000, **kwargs):
+    """Convert a track CSV file to a Parquet file, reading ``chunk_size`` rows at a time.
+
+    The ``Wavelength`` column of the CSV files written by ``scripts/track_particles.py``
+    is renamed to ``wavelength``, and columns that are not in ``TRACK_SCHEMA`` (e.g. the
+    index) are dropped. See ``TrackWriter`` for the other arguments.
+
+    Returns
+    -------
+    pathlib.Path
+        The Parquet file, by default the CSV file with the suffix ``.parquet``.
+    """
+    csv_path = Path(csv_path)
+    if output_path is None:
+        output_path = csv_path.with_suffix(".parquet")
+    with TrackWriter(output_path, metadata, **kwargs) as writer:
+        for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+            writer.write(chunk)
+    return Path(output_path)
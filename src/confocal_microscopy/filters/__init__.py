@@ -1,3 +1,6 @@
 from .anisotropic_diffusion import *
+from .background import *
 from .exposure import *
+from .morphology import *
+from .preprocessing import *
 from .threshold import *
\ No newline at end of file
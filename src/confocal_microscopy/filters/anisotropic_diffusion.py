@@ -1,6 +1,14 @@
 """Used for segmentation.
+
+The diffusion is computed with compiled stencils that update the image in place, using
+one scratch buffer for the fluxes. The stencils run in parallel over the rows of all
+slices. Volumes can also be processed in blocks of slices, with a halo of ``num_steps``
+slices on each side of the block, since each step only depends on the direct neighbours.
 """
+from collections import deque
+
 import numpy as np
+from numba import njit, prange
 from tqdm import trange
 
 __all__ = ["anisotropic_diffusion"]
@@ -11,59 +19,191 @@ def perona_malik(x, edge_scale):
 
 
 def tukey(x, edge_scale):
-    x[np.abs(x) > edge_scale] = 0
+    x = np.where(np.abs(x) > edge_scale, 0, x)
     return x*((1 - (x/edge_scale)**2)**2)
 
 
-def _make_num_borders_array(image):
-    ndim = image.ndim
-    num_borders = 2*ndim*np.ones_like(image)
-
-    for axis in range(ndim):
-        front_slices = [slice(None)]*ndim
-        front_slices[axis] = 0
-        back_slices = [slice(None)]*ndim
-        back_slices[axis] = -1
-
-        num_borders[tuple(front_slices)] -= 1
-        num_borders[tuple(back_slices)] -= 1
-    
-    return num_borders
-
+_EDGE_FUNCTIONS = {"perona_malik": 0, "tukey": 1}
+
+
+@njit(nogil=True, cache=True)
+def _edge_function(difference, edge_scale, edge_function):
+    if edge_function == 0:
+        return 2*difference/(2*(edge_scale**2) + difference**2)
+    if abs(difference) > edge_scale:
+        difference = 0*difference
+    return difference*((1 - (difference/edge_scale)**2)**2)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _compute_fluxes(image, fluxes, edge_scale, step_size, edge_function, diffuse_first_axis):
+    """Store ``step_size`` times the mean edge function of the differences to the neighbours.
+
+    The differences are summed in the same order as the NumPy implementation, forward
+    and backward along each axis.
+    """
+    depth, height, width = image.shape
+    for line in prange(depth * height):
+        z = line // height
+        y = line % height
+        for x in range(width):
+            centre = image[z, y, x]
+            flux = 0*centre
+            num_neighbours = 4
+            if diffuse_first_axis:
+                num_neighbours += 2
+                if z + 1 < depth:
+                    flux += _edge_function(image[z + 1, y, x] - centre, edge_scale, edge_function)
+                else:
+                    num_neighbours -= 1
+                if z > 0:
+                    flux += _edge_function(image[z - 1, y, x] - centre, edge_scale, edge_function)
+                else:
+                    num_neighbours -= 1
+
+            if y + 1 < height:
+                flux += _edge_function(image[z, y + 1, x] - centre, edge_scale, edge_function)
+            else:
+                num_neighbours -= 1
+            if y > 0:
+                flux += _edge_function(image[z, y - 1, x] - centre, edge_scale, edge_function)
+            else:
+                num_neighbours -= 1
+
+            if x + 1 < width:
+                flux += _edge_function(image[z, y, x + 1] - centre, edge_scale, edge_function)
+            else:
+                num_neighbours -= 1
+            if x > 0:
+                flux += _edge_function(image[z, y, x - 1] - centre, edge_scale, edge_function)
+            else:
+                num_neighbours -= 1
+
+            fluxes[z, y, x] = step_size*flux/num_neighbours
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _apply_fluxes(image, fluxes):
+    depth, height, width = image.shape
+    for line in prange(depth * height):
+        z = line // height
+        y = line % height
+        for x in range(width):
+            image[z, y, x] += fluxes[z, y, x]
+
+
+def _diffuse(image, fluxes, edge_scale, step_size, num_steps, edge_function, range_=range):
+    """Run ``num_steps`` diffusion steps on a 2D or 3D image in place.
+    """
+    diffuse_first_axis = image.ndim == 3
+    image_3d = image if diffuse_first_axis else image[np.newaxis]
+    fluxes_3d = fluxes if diffuse_first_axis else fluxes[np.newaxis]
+    edge_scale = image.dtype.type(edge_scale)
+    step_size = image.dtype.type(step_size)
+    for _ in range_(num_steps):
+        _compute_fluxes(
+            image_3d, fluxes_3d, edge_scale, step_size, edge_function, diffuse_first_axis
+        )
+        _apply_fluxes(image_3d, fluxes_3d)
+
+
+def _diffuse_blockwise(image, out, edge_scale, step_size, num_steps, edge_function, block_size,
+                       progress):
+    """Diffuse blocks of ``block_size`` slices with a halo of ``num_steps`` slices.
+
+    Each step only depends on the direct neighbours, so the slices that are more than
+    ``num_steps`` slices from the block boundaries have the same result as when the whole
+    volume is diffused. The results are only written once no later block reads the slices
+    in its halo, so ``out`` can be ``image``.
+    """
+    length = image.shape[0]
+    halo = num_steps
+    starts = range(0, length, block_size)
+    if progress:
+        starts = trange(0, length, block_size)
+
+    pending = deque()
+    fluxes = None
+    for start in starts:
+        stop = min(start + block_size, length)
+        halo_start = max(0, start - halo)
+        halo_stop = min(length, stop + halo)
+        block = np.array(image[halo_start:halo_stop])
+        if fluxes is None or fluxes.shape != block.shape:
+            fluxes = np.empty_like(block)
+        _diffuse(block, fluxes, edge_scale, step_size, num_steps, edge_function)
+        pending.append((start, block[start - halo_start:stop - halo_start]))
+
+        next_halo_start = max(0, stop - halo)
+        while pending and pending[0][0] + len(pending[0][1]) <= next_halo_start:
+            pending_start, pending_block = pending.popleft()
+            out[pending_start:pending_start + len(pending_block)] = pending_block
+    for pending_start, pending_block in pending:
+        out[pending_start:pending_start + len(pending_block)] = pending_block
+    return out
+
+
+def anisotropic_diffusion(
+    image,
+    edge_scale,
+    step_size,
+    num_steps,
+    return_copy=True,
+    progress=False,
+    edge_function="tukey",
+    block_size=None,
+):
+    """Edge preserving smoothing of 2D images or 3D volumes.
+
+    Arguments
+    ---------
+    image : np.ndarray(shape=(H, W) or (D, H, W))
+        Floating point image.
+    edge_scale : float
+        Intensity differences above this scale are treated as edges.
+    step_size : float
+    num_steps : int
+    return_copy : bool
+        If False, then ``image`` is updated in place.
+    progress : bool
+    edge_function : str
+        ``"tukey"`` or ``"perona_malik"``.
+    block_size : int or None
+        If given, then the image is diffused in blocks of ``block_size`` slices along
+        the first axis, each with ``num_steps`` extra slices on both sides. This gives the
+        same result with less scratch memory, which is useful for large volumes.
+
+    Returns
+    -------
+    np.ndarray
+        The diffused image.
+    """
+    if image.ndim not in (2, 3):
+        raise ValueError(f"The image must be 2D or 3D, not {image.ndim}D")
+    if not np.issubdtype(image.dtype, np.floating):
+        raise TypeError(f"The image must have a floating point data type, not {image.dtype}")
+    if edge_function not in _EDGE_FUNCTIONS:
+        raise ValueError(
+            f"Unknown edge function {edge_function}, choose one of {', '.join(_EDGE_FUNCTIONS)}"
+        )
+    edge_function = _EDGE_FUNCTIONS[edge_function]
+
+    if block_size is not None and block_size < image.shape[0]:
+        out = np.empty_like(image) if return_copy else image
+        return _diffuse_blockwise(
+            image, out, edge_scale, step_size, num_steps, edge_function, block_size, progress
+        )
 
-def anisotropic_diffusion(image, edge_scale, step_size, num_steps, return_copy=True, progress=False):
     if return_copy:
         denoised = image.copy()
     else:
         denoised = image
-    
+
     if progress:
         range_ = trange
     else:
         range_ = range
-    
-    num_borders = _make_num_borders_array(denoised)
-    
-    ndim = denoised.ndim
-    for i in range_(num_steps):
-        diffs = np.zeros_like(denoised)
-
-        for axis in range(ndim):
-            forward_slices = [slice(None)]*ndim
-            forward_slices[axis] = slice(None, -1, None)
-            forward_slices = tuple(forward_slices)
-
-            backward_slices = [slice(None)]*ndim
-            backward_slices[axis] = slice(1, None, None)
-            backward_slices = tuple(backward_slices)
-
-            reversed_slices = [slice(None)]*ndim
-            reversed_slices[axis] = slice(None, None, -1)
-            reversed_slices = tuple(reversed_slices)
-
-            diffs[forward_slices] += tukey(np.diff(denoised, axis=axis), edge_scale)
-            diffs[backward_slices] += tukey(np.diff(denoised[reversed_slices], axis=axis)[reversed_slices], edge_scale)
-
-        denoised += step_size*diffs/num_borders
-    
-    return denoised
\ No newline at end of file
+
+    fluxes = np.empty_like(denoised)
+    _diffuse(denoised, fluxes, edge_scale, step_size, num_steps, edge_function, range_)
+    return denoised
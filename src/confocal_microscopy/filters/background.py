@@ -0,0 +1,322 @@
+"""Streaming estimators of the background signal of videos.
+
+The estimators see the video as an iterable of ``(B, H, W)`` blocks of frames, so their
+memory usage doesn't depend on the number of frames. Estimators that need several passes
+over the video call the block iterator factory once per pass. ``fit`` returns a dictionary
+of per-pixel arrays that can be stored with ``files.statistics_cache``, and ``get_background``
+computes the background signal from it. All estimators also store the per-pixel minimum
+and maximum, which are used to find the signal limits.
+
+ * ``TemporalMean`` (``"mean"``): The temporal mean, one pass.
+ * ``TemporalPercentile`` (``"median"``, ``"percentile"``): Exact per-pixel percentiles of
+   unsigned integer videos, computed with one per-pixel histogram pass for each
+   ``bits_per_pass`` bits of the data type. Stuck or slow particles don't bias it like
+   they bias the mean.
+ * ``RunningMedian`` (``"running_median"``): Medians of sliding windows of frames,
+   linearly interpolated in time, for videos with drifting illumination.
+"""
+import numpy as np
+from numba import njit, prange
+
+__all__ = [
+    "TemporalMean",
+    "TemporalPercentile",
+    "RunningMedian",
+    "BACKGROUND_ESTIMATORS",
+    "get_background_estimator",
+]
+
+
+def _update_min_max(statistics, block):
+    block_min = block.min(axis=0)
+    block_max = block.max(axis=0)
+    if "min" not in statistics:
+        statistics["min"] = block_min
+        statistics["max"] = block_max
+        return
+    np.minimum(statistics["min"], block_min, out=statistics["min"])
+    np.maximum(statistics["max"], block_max, out=statistics["max"])
+
+
+class TemporalMean:
+    """Per-pixel mean of all frames, computed in one pass.
+    """
+    name = None
+    time_varying = False
+
+    def fit(self, iter_blocks, num_timesteps):
+        """Compute the per-pixel mean, minimum and maximum of the video.
+
+        Arguments
+        ---------
+        iter_blocks : Callable[[], Iterable[np.ndarray(shape=(B, H, W))]]
+            Function that returns an iterable over the frames of the video in blocks.
+        num_timesteps : int
+
+        Returns
+        -------
+        dict[str, np.ndarray]
+            The ``"mean"``, ``"min"`` and ``"max"`` frames.
+        """
+        statistics = {}
+        frame_sum = None
+        for block in iter_blocks():
+            if frame_sum is None:
+                frame_sum = np.zeros(block.shape[1:], dtype=float)
+            np.add(frame_sum, block.sum(axis=0, dtype=float), out=frame_sum)
+            _update_min_max(statistics, block)
+        statistics["mean"] = frame_sum / num_timesteps
+        return statistics
+
+    def get_background(self, statistics, time_points=None):
+        return statistics["mean"]
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _count_digits(block, counts, prefix, next_above, shift, num_bits):
+    """Histogram of the digit at ``shift`` of the values whose higher bits equal ``prefix``.
+
+    The smallest value with higher bits above the prefix is stored in ``next_above``.
+    """
+    num_frames, height, width = block.shape
+    mask = (1 << num_bits) - 1
+    prefix_shift = shift + num_bits
+    for y in prange(height):
+        for t in range(num_frames):
+            for x in range(width):
+                value = np.int64(block[t, y, x])
+                high_bits = value >> prefix_shift
+                if high_bits == prefix[y, x]:
+                    counts[y, x, (value >> shift) & mask] += 1
+                elif high_bits > prefix[y, x] and value < next_above[y, x]:
+                    next_above[y, x] = value
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _select_digits(counts, prefix, rank, num_bits):
+    """Append the digit of the value with the given rank to the prefix and update the rank.
+
+    The number of values with the same prefix that are larger than the selected value is
+    returned, so the next value can be found after the last pass.
+    """
+    height, width, num_bins = counts.shape
+    num_larger = np.zeros((height, width), dtype=np.int64)
+    next_digit = np.full((height, width), -1, dtype=np.int64)
+    for y in prange(height):
+        for x in range(width):
+            cumulative_count = 0
+            digit = 0
+            while cumulative_count + counts[y, x, digit] <= rank[y, x]:
+                cumulative_count += counts[y, x, digit]
+                digit += 1
+            rank[y, x] -= cumulative_count
+            prefix[y, x] = (prefix[y, x] << num_bits) | digit
+            num_larger[y, x] = counts[y, x, digit] - rank[y, x] - 1
+            for larger_digit in range(digit + 1, num_bins):
+                if counts[y, x, larger_digit] > 0:
+                    next_digit[y, x] = larger_digit
+                    break
+    return num_larger, next_digit
+
+
+class TemporalPercentile:
+    """Exact per-pixel percentile of unsigned integer videos, computed from histograms.
+
+    The percentile is found one digit of ``bits_per_pass`` bits at a time, starting with
+    the most significant digit. Each pass counts the digits of the values that match the
+    digits found so far, so a uint16 video takes two passes with the default 8 bits per
+    pass, and the histograms take ``H * W * 2**bits_per_pass * 4`` bytes. The result is
+    the same as ``np.percentile(video, percentile, axis=0)``.
+
+    Arguments
+    ---------
+    percentile : float
+        Percentile between 0 and 100, 50 gives the median.
+    bits_per_pass : int
+        Number of bits found per pass. Fewer bits use less memory but need more passes.
+    """
+    time_varying = False
+
+    def __init__(self, percentile=50, bits_per_pass=8):
+        if not 0 <= percentile <= 100:
+            raise ValueError(f"The percentile must be between 0 and 100, not {percentile}")
+        self.percentile = percentile
+        self.bits_per_pass = bits_per_pass
+
+    @property
+    def name(self):
+        return f"percentile{self.percentile:g}-bits{self.bits_per_pass}"
+
+    def fit(self, iter_blocks, num_timesteps):
+        """Compute the per-pixel percentile, minimum and maximum of the video.
+
+        See ``TemporalMean.fit`` for the arguments. The percentile is stored as ``"background"``.
+        """
+        index = self.percentile / 100 * (num_timesteps - 1)
+        lower_rank = int(np.floor(index))
+        fraction = index - lower_rank
+
+        statistics = {}
+        shift = None
+        for block in iter_blocks():
+            if shift is None:
+                if block.dtype.kind != "u":
+                    raise TypeError(
+                        f"Histogram percentiles need unsigned integer frames, not {block.dtype}"
+                    )
+                num_passes = -(-8*block.dtype.itemsize // self.bits_per_pass)
+                shift = (num_passes - 1) * self.bits_per_pass
+                shape = block.shape[1:]
+                counts = np.zeros((*shape, 2**self.bits_per_pass), dtype=np.uint32)
+                prefix = np.zeros(shape, dtype=np.int64)
+                rank = np.full(shape, lower_rank, dtype=np.int64)
+                next_above = np.full(shape, np.iinfo(np.int64).max, dtype=np.int64)
+            _count_digits(block, counts, prefix, next_above, shift, self.bits_per_pass)
+            _update_min_max(statistics, block)
+        num_larger, next_digit = _select_digits(counts, prefix, rank, self.bits_per_pass)
+
+        for shift in range(shift - self.bits_per_pass, -1, -self.bits_per_pass):
+            counts[...] = 0
+            next_above[...] = np.iinfo(np.int64).max
+            for block in iter_blocks():
+                _count_digits(block, counts, prefix, next_above, shift, self.bits_per_pass)
+            num_larger, next_digit = _select_digits(counts, prefix, rank, self.bits_per_pass)
+
+        lower_value = prefix.astype(float)
+        if fraction > 0:
+            # The next value is the same value, the next value in the last histogram
+            # or the smallest value above the last prefix
+            next_in_histogram = (prefix >> self.bits_per_pass << self.bits_per_pass) + next_digit
+            upper_value = np.where(next_digit >= 0, next_in_histogram, next_above)
+            upper_value = np.where(num_larger > 0, prefix, upper_value).astype(float)
+            statistics["background"] = lower_value + fraction*(upper_value - lower_value)
+        else:
+            statistics["background"] = lower_value
+        return statistics
+
+    def get_background(self, statistics, time_points=None):
+        return statistics["background"]
+
+
+class RunningMedian:
+    """Per-pixel medians of sliding windows of frames, for videos with drifting illumination.
+
+    The median is computed for windows of ``window`` frames centred at every ``step``-th
+    frame (and the last frame), and the background of the frames in between is linearly
+    interpolated. The windows are cropped at the start and end of the video. Only the
+    last ``window`` frames are kept in memory while fitting, and the result has one frame
+    per window centre. For long videos, the step is increased so there are at most
+    ``max_centres`` window centres, which bounds the memory use of the result.
+
+    Arguments
+    ---------
+    window : int
+        Number of frames in each window.
+    step : int or None
+        Number of frames between the window centres, ``window // 2`` if None.
+    max_centres : int or None
+        Maximum number of window centres (at least 2), no limit if None.
+    """
+    time_varying = True
+
+    def __init__(self, window=101, step=None, max_centres=256):
+        if window < 1:
+            raise ValueError(f"The window must contain at least one frame, not {window}")
+        if max_centres is not None and max_centres < 2:
+            raise ValueError(f"There must be at least two window centres, not {max_centres}")
+        self.window = window
+        self.step = max(1, window // 2) if step is None else step
+        self.max_centres = max_centres
+
+    @property
+    def name(self):
+        return f"running-median-w{self.window}-s{self.step}-c{self.max_centres}"
+
+    def _get_step(self, num_timesteps):
+        if self.max_centres is None:
+            return self.step
+        # With this step, the last frame is at most window centre number max_centres
+        return max(self.step, -(-(num_timesteps - 1) // (self.max_centres - 1)))
+
+    def _get_centres(self, num_timesteps):
+        centres = np.arange(0, num_timesteps, self._get_step(num_timesteps))
+        if centres[-1] != num_timesteps - 1:
+            centres = np.append(centres, num_timesteps - 1)
+        return centres
+
+    def fit(self, iter_blocks, num_timesteps):
+        """Compute the window medians and the per-pixel minimum and maximum of the video.
+
+        See ``TemporalMean.fit`` for the arguments. The medians are stored as
+        ``"background"`` and the window centres as ``"background_time_points"``.
+        """
+        half_window = self.window // 2
+        centres = self._get_centres(num_timesteps)
+        window_starts = np.maximum(centres - half_window, 0)
+        window_stops = np.minimum(centres + self.window - half_window, num_timesteps)
+
+        statistics = {}
+        buffer = None
+        medians = None
+        next_median = 0
+        time_point = 0
+        for block in iter_blocks():
+            if buffer is None:
+                buffer = np.empty((self.window, *block.shape[1:]), dtype=block.dtype)
+                medians = np.empty((len(centres), *block.shape[1:]), dtype=np.float32)
+            _update_min_max(statistics, block)
+            for frame in block:
+                buffer[time_point % self.window] = frame
+                time_point += 1
+                while next_median < len(centres) and window_stops[next_median] == time_point:
+                    indices = np.arange(window_starts[next_median], time_point) % self.window
+                    medians[next_median] = np.median(buffer[indices], axis=0)
+                    next_median += 1
+
+        statistics["background"] = medians
+        statistics["background_time_points"] = centres
+        return statistics
+
+    def get_background(self, statistics, time_points=None):
+        """Interpolate the background of the given time points.
+
+        Returns the mean of the window medians if ``time_points`` is None, a ``(H, W)``
+        frame for an integer time point and a ``(B, H, W)`` array for a sequence of them.
+        """
+        medians = statistics["background"]
+        centres = statistics["background_time_points"]
+        if time_points is None:
+            return medians.mean(axis=0)
+        if len(centres) == 1:
+            return medians[0] if np.isscalar(time_points) else medians[[0]*len(time_points)]
+
+        time_points = np.asarray(time_points)
+        index = np.searchsorted(centres, time_points, side="right") - 1
+        index = np.clip(index, 0, len(centres) - 2)
+        weight = (time_points - centres[index]) / (centres[index + 1] - centres[index])
+        weight = np.clip(weight, 0, 1).astype(medians.dtype)[..., np.newaxis, np.newaxis]
+        return (1 - weight)*medians[index] + weight*medians[index + 1]
+
+
+BACKGROUND_ESTIMATORS = {
+    "mean": TemporalMean,
+    "median": TemporalPercentile,
+    "percentile": TemporalPercentile,
+    "running_median": RunningMedian,
+}
+
+
+def get_background_estimator(estimator="mean", **kwargs):
+    """Create a background estimator from its name in ``BACKGROUND_ESTIMATORS``.
+
+    Estimator instances are returned as they are. The keyword arguments are passed to the
+    estimator, e.g. ``get_background_estimator("percentile", percentile=10)``.
+    """
+    if not isinstance(estimator, str):
+        return estimator
+    if estimator not in BACKGROUND_ESTIMATORS:
+        raise ValueError(
+            f"Unknown background estimator {estimator}, "
+            f"choose one of {', '.join(BACKGROUND_ESTIMATORS)}"
+        )
+    return BACKGROUND_ESTIMATORS[estimator](**kwargs)
@@ -1,42 +1,282 @@
 """Used for segmentation.
+
+Percentiles are computed from histograms, which are accumulated in one pass over an
+image or a streamed video with ``StreamingHistogram``. The histograms of 8 and 16 bit
+integers have one bin per value, so their percentiles are exact, while floating point
+percentiles are accurate to within a bin width. The clipping and scaling is then done in
+one fused pass with ``clip_and_scale``.
 """
 import numpy as np
+from numba import njit
 
-__all__ = ["reduce_dynamic_range", "normalise"]
+__all__ = [
+    "StreamingHistogram",
+    "percentiles",
+    "clip_and_scale",
+    "reduce_dynamic_range",
+    "normalise",
+]
 
 
-def reduce_dynamic_range(image, range_min, range_max, out=None):
-    """Reduce the dynamic range to lie between the `range_min` percentile and `range_max` percentile.
+@njit(nogil=True, cache=True)
+def _accumulate_integer_histogram(values, counts, offset):
+    minimum = values[0]
+    maximum = values[0]
+    for value in values:
+        counts[np.int64(value) - offset] += 1
+        if value < minimum:
+            minimum = value
+        if value > maximum:
+            maximum = value
+    return minimum, maximum
+
+
+@njit(nogil=True, cache=True)
+def _accumulate_float_histogram(values, counts, low, high):
+    num_bins = len(counts)
+    bins_per_unit = num_bins / (high - low)
+    minimum = np.inf
+    maximum = -np.inf
+    num_values = 0
+    for value in values:
+        if np.isnan(value):
+            continue
+        num_values += 1
+        index = int((value - low) * bins_per_unit)
+        counts[min(max(index, 0), num_bins - 1)] += 1
+        if value < minimum:
+            minimum = value
+        if value > maximum:
+            maximum = value
+    return minimum, maximum, num_values
+
+
+@njit(nogil=True, cache=True)
+def _clip_and_scale(values, out, low, high, offset, scale, round_output):
+    for i in range(len(values)):
+        value = values[i]
+        if value < low:
+            value = low
+        elif value > high:
+            value = high
+        if round_output:
+            out[i] = np.rint((value - offset) * scale)
+        else:
+            out[i] = (value - offset) * scale
+
+
+class StreamingHistogram:
+    """Histogram that is accumulated over several arrays, e.g. the frames of a video.
+
+    Arguments
+    ---------
+    dtype : np.dtype
+        Data type of the values. 8 and 16 bit integers are counted exactly.
+    num_bins : int
+        Number of bins for the other data types.
+    value_range : tuple[float] or None
+        Range of the bins for the other data types. Values outside the range are counted
+        in the first or last bin. If None, then the range of the first array is used.
     """
-    min_value = np.percentile(image, range_min)
-    max_value = np.percentile(image, range_max)
+    def __init__(self, dtype, num_bins=4096, value_range=None):
+        self.dtype = np.dtype(dtype)
+        self.is_exact = self.dtype.kind in "ui" and self.dtype.itemsize <= 2
+        if self.is_exact:
+            info = np.iinfo(self.dtype)
+            self._offset = int(info.min)
+            self.counts = np.zeros(int(info.max) - int(info.min) + 1, dtype=np.int64)
+        else:
+            self.counts = np.zeros(num_bins, dtype=np.int64)
+        self.value_range = value_range
+        self.num_values = 0
+        self.min = None
+        self.max = None
+
+    def update(self, values):
+        """Add the values of an array to the histogram.
+        """
+        values = np.asarray(values, dtype=self.dtype).reshape(-1)
+        if len(values) == 0:
+            return self
+
+        if self.is_exact:
+            minimum, maximum = _accumulate_integer_histogram(values, self.counts, self._offset)
+            num_values = len(values)
+        else:
+            if self.value_range is None:
+                self.value_range = (float(np.nanmin(values)), float(np.nanmax(values)))
+            low, high = self.value_range
+            if high <= low:
+                high = low + 1
+            minimum, maximum, num_values = _accumulate_float_histogram(
+                values, self.counts, low, high
+            )
+            self.value_range = low, high
+            if num_values == 0:
+                return self
 
+        self.num_values += num_values
+        self.min = minimum if self.min is None else min(self.min, minimum)
+        self.max = maximum if self.max is None else max(self.max, maximum)
+        return self
+
+    def _get_order_statistics(self, ranks):
+        """The values with the given (fractional for floats) ranks in the sorted values.
+        """
+        cumulative_counts = np.cumsum(self.counts)
+        bins = np.searchsorted(cumulative_counts, ranks, side="right")
+        if self.is_exact:
+            return (bins + self._offset).astype(float)
+
+        low, high = self.value_range
+        bin_width = (high - low) / len(self.counts)
+        num_before = np.where(bins > 0, cumulative_counts[np.maximum(bins - 1, 0)], 0)
+        fraction = (ranks - num_before + 0.5) / self.counts[bins]
+        values = low + (bins + np.clip(fraction, 0, 1)) * bin_width
+        values = np.where(ranks <= 0, self.min, values)
+        values = np.where(ranks >= self.num_values - 1, self.max, values)
+        return np.clip(values, self.min, self.max)
+
+    def percentiles(self, q):
+        """Compute percentiles with the linear interpolation of ``np.percentile``.
+
+        Arguments
+        ---------
+        q : float or sequence of float
+            Percentiles between 0 and 100.
+
+        Returns
+        -------
+        float or np.ndarray
+        """
+        if self.num_values == 0:
+            raise ValueError("Cannot compute percentiles of an empty histogram")
+        q = np.asarray(q, dtype=float)
+        if np.any((q < 0) | (q > 100)):
+            raise ValueError(f"The percentiles must be between 0 and 100, not {q}")
+
+        index = q / 100 * (self.num_values - 1)
+        if not self.is_exact:
+            return self._get_order_statistics(index)[()]
+
+        lower_rank = np.floor(index)
+        upper_rank = np.minimum(lower_rank + 1, self.num_values - 1)
+        lower = self._get_order_statistics(lower_rank)
+        upper = self._get_order_statistics(upper_rank)
+
+        # Same interpolation as np.percentile, which is exact at both ends
+        fraction = index - lower_rank
+        difference = upper - lower
+        result = np.where(
+            fraction >= 0.5, upper - difference*(1 - fraction), lower + difference*fraction
+        )
+        return result[()]
+
+
+def percentiles(image, q, num_bins=4096):
+    """Compute several percentiles of an array with one histogram pass.
+
+    Exact (the same as ``np.percentile``) for 8 and 16 bit integers, and accurate to within
+    ``(image.max() - image.min()) / num_bins`` for other data types.
+    """
+    return StreamingHistogram(image.dtype, num_bins).update(image).percentiles(q)
+
+
+def clip_and_scale(image, low, high, scale=1, out=None, dtype=np.float32):
+    """Compute ``(clip(image, low, high) - low) * scale / (high - low)`` in one pass.
+
+    Arguments
+    ---------
+    image : np.ndarray
+    low : float
+    high : float
+    scale : float
+        Value that ``high`` is mapped to.
+    out : np.ndarray or None
+        Array with the same shape as ``image`` to store the result in. Can be ``image``
+        itself if it has a floating point data type. The result is rounded for integer
+        output arrays.
+    dtype : np.dtype
+        Data type of the result if ``out`` is None.
+
+    Returns
+    -------
+    np.ndarray
+    """
     if out is None:
-        out = image.copy()
-        out[image < min_value] = min_value
-        out[image > max_value] = max_value
-    elif out is image:
-        out[image < min_value] = min_value
-        out[image > max_value] = max_value
-    else:
-        out[:] = image
-        out[image < min_value] = min_value
-        out[image > max_value] = max_value
-    
+        out = np.empty(image.shape, dtype=dtype)
+    elif out.shape != image.shape:
+        raise ValueError(
+            f"The output array has shape {out.shape}, but the image has shape {image.shape}"
+        )
+    factor = scale / (high - low) if high != low else 0
+    return _apply_clip_and_scale(image, out, low, high, low, factor)
+
+
+def _apply_clip_and_scale(image, out, low, high, offset, factor):
+    """Compute ``(clip(image, low, high) - offset) * factor``, fused if the arrays are contiguous.
+    """
+    round_output = out.dtype.kind in "ui"
+    if image.flags.c_contiguous and out.flags.c_contiguous:
+        _clip_and_scale(
+            image.reshape(-1),
+            out.reshape(-1),
+            float(low),
+            float(high),
+            float(offset),
+            float(factor),
+            round_output,
+        )
+        return out
+
+    clipped = np.clip(image, low, high).astype(float, copy=False)
+    clipped -= offset
+    clipped *= factor
+    if round_output:
+        np.rint(clipped, out=clipped)
+    np.copyto(out, clipped, casting="unsafe")
     return out
 
 
-def normalise(image, out=None):
-    if out is None:
-        out = image.astype(float) - image.min()
-        out /= image.max()
-    elif out is image:
-        out -= image.min()
-        out /= image.max()
+def reduce_dynamic_range(image, range_min, range_max, out=None):
+    """Reduce the dynamic range to lie between the `range_min` percentile and `range_max` percentile.
+
+    Both percentiles are found in one pass, from a histogram for 8 and 16 bit integer images.
+    Other images use ``np.percentile``, since histogram percentiles of floating point values
+    are only accurate to within a bin width, and the clipped image should not change.
+    """
+    if image.dtype.kind in "ui" and image.dtype.itemsize <= 2:
+        min_value, max_value = percentiles(image, [range_min, range_max])
+        # The limits are stored in the image, so they are truncated like the old assignment
+        min_value, max_value = np.array([min_value, max_value]).astype(image.dtype)
     else:
-        out[:] = image
-        out -= image.min()
-        out /= image.max()
-    return out
+        min_value, max_value = np.percentile(image, [range_min, range_max])
+
+    return np.clip(image, min_value, max_value, out=out)
+
 
-    
\ No newline at end of file
+@njit(nogil=True, cache=True)
+def _min_max(values):
+    minimum = values[0]
+    maximum = values[0]
+    for value in values:
+        if value < minimum:
+            minimum = value
+        if value > maximum:
+            maximum = value
+    return minimum, maximum
+
+
+def normalise(image, out=None, dtype=np.float32):
+    """Subtract the minimum and divide by the maximum of the image.
+
+    If ``out`` is None, then the result is stored in a new array with data type ``dtype``.
+    The minimum and maximum are found in one pass, and the result is computed in another.
+    """
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    if image.size == 0:
+        return out
+    minimum, maximum = _min_max(np.ascontiguousarray(image).reshape(-1))
+    factor = 1 / maximum if maximum != 0 else 0
+    return _apply_clip_and_scale(image, out, minimum, maximum, minimum, factor)
@@ -0,0 +1,210 @@
+"""Grey morphology with flat, rectangular structuring elements.
+
+The minimum and maximum filters are separable for rectangular structuring elements, and
+each 1D pass uses the van Herk/Gil-Werman algorithm, which needs three comparisons per
+pixel regardless of the filter size. The filters are computed for ``(H, W)`` frames or
+``(T, H, W)`` blocks of frames in parallel, and the result is the same as
+``scipy.ndimage`` with the default ``"reflect"`` boundary mode.
+
+The parallel kernels are only used when the filters are called from the main thread.
+Other threads (e.g. the worker pool of ``ims.LazyIMSVideoLoader``) use serial kernels,
+since the thread pool already uses the cores and numba's default (workqueue) threading
+layer doesn't support parallel kernels launched from several threads at once. The worker
+processes of ``tracking.locate_features_parallel`` run the filters on their main thread,
+and limit numba to one thread per process instead.
+"""
+import threading
+
+import numpy as np
+from numba import njit, prange
+
+__all__ = ["grey_erosion", "grey_dilation", "grey_opening", "grey_closing"]
+
+
+@njit(nogil=True, cache=True)
+def _reflect_index(index, length):
+    """Map an index outside ``[0, length)`` to the index ``scipy.ndimage`` uses in reflect mode.
+    """
+    period = 2*length
+    index = index % period
+    if index >= length:
+        index = period - 1 - index
+    return index
+
+
+@njit(nogil=True, cache=True)
+def _select(a, b, use_max):
+    if use_max:
+        return a if a > b else b
+    return a if a < b else b
+
+
+def _filter_width(frames, out, size, before, use_max):
+    """Minimum or maximum filter along the last axis of a ``(T, H, W)`` array.
+
+    The window of output pixel ``i`` is ``[i - before, i - before + size)``.
+    """
+    num_frames, height, width = frames.shape
+    length = width + size - 1
+    for line in prange(num_frames * height):
+        t = line // height
+        y = line % height
+        padded = np.empty(length, dtype=frames.dtype)
+        for j in range(length):
+            padded[j] = frames[t, y, _reflect_index(j - before, width)]
+
+        # Running extrema from the start (prefix) and end (suffix) of each block of size pixels
+        prefix = np.empty(length, dtype=frames.dtype)
+        suffix = np.empty(length, dtype=frames.dtype)
+        for j in range(length):
+            if j % size == 0:
+                prefix[j] = padded[j]
+            else:
+                prefix[j] = _select(prefix[j - 1], padded[j], use_max)
+        for j in range(length - 1, -1, -1):
+            if j == length - 1 or (j + 1) % size == 0:
+                suffix[j] = padded[j]
+            else:
+                suffix[j] = _select(suffix[j + 1], padded[j], use_max)
+
+        for x in range(width):
+            out[t, y, x] = _select(suffix[x], prefix[x + size - 1], use_max)
+
+
+def _filter_height(frames, out, size, before, use_max):
+    """Minimum or maximum filter along the second last axis of a ``(T, H, W)`` array.
+
+    Whole rows are processed at a time, so the inner loops are contiguous.
+    """
+    num_frames, height, width = frames.shape
+    length = height + size - 1
+    for t in prange(num_frames):
+        padded = np.empty((length, width), dtype=frames.dtype)
+        for j in range(length):
+            padded[j] = frames[t, _reflect_index(j - before, height)]
+
+        prefix = np.empty((length, width), dtype=frames.dtype)
+        suffix = np.empty((length, width), dtype=frames.dtype)
+        for j in range(length):
+            if j % size == 0:
+                prefix[j] = padded[j]
+                continue
+            for x in range(width):
+                prefix[j, x] = _select(prefix[j - 1, x], padded[j, x], use_max)
+        for j in range(length - 1, -1, -1):
+            if j == length - 1 or (j + 1) % size == 0:
+                suffix[j] = padded[j]
+                continue
+            for x in range(width):
+                suffix[j, x] = _select(suffix[j + 1, x], padded[j, x], use_max)
+
+        for y in range(height):
+            for x in range(width):
+                out[t, y, x] = _select(suffix[y, x], prefix[y + size - 1, x], use_max)
+
+
+_PARALLEL_KERNELS = (
+    njit(parallel=True, nogil=True, cache=True)(_filter_width),
+    njit(parallel=True, nogil=True, cache=True)(_filter_height),
+)
+_SERIAL_KERNELS = (
+    njit(nogil=True, cache=True)(_filter_width),
+    njit(nogil=True, cache=True)(_filter_height),
+)
+
+
+def _normalise_size(size):
+    if np.isscalar(size):
+        return int(size), int(size)
+    if len(size) != 2:
+        raise ValueError(f"The size must be an integer or a (height, width) pair, not {size}")
+    return int(size[0]), int(size[1])
+
+
+def _min_or_max_filter(frames, size, out, use_max):
+    frames = np.asarray(frames)
+    if frames.ndim not in (2, 3):
+        raise ValueError(f"The frames must have shape (H, W) or (T, H, W), not {frames.shape}")
+    if out is None:
+        out = np.empty_like(frames)
+    elif out.shape != frames.shape:
+        raise ValueError(
+            f"The output array has shape {out.shape}, but the frames have shape {frames.shape}"
+        )
+    if out.dtype != frames.dtype:
+        raise ValueError(f"The output array must have data type {frames.dtype}, not {out.dtype}")
+
+    size_y, size_x = _normalise_size(size)
+    if size_y < 1 or size_x < 1:
+        raise ValueError(f"The size must be positive, not {size}")
+
+    # scipy.ndimage centres even sized erosions at size // 2 and dilations at size // 2 - 1,
+    # so a dilation is an erosion with the mirrored structuring element
+    before_y = (size_y - 1) // 2 if use_max else size_y // 2
+    before_x = (size_x - 1) // 2 if use_max else size_x // 2
+
+    if threading.current_thread() is threading.main_thread():
+        filter_width, filter_height = _PARALLEL_KERNELS
+    else:
+        filter_width, filter_height = _SERIAL_KERNELS
+
+    frames_3d = frames if frames.ndim == 3 else frames[np.newaxis]
+    out_3d = out if out.ndim == 3 else out[np.newaxis]
+    source = frames_3d
+    if size_x > 1:
+        filter_width(source, out_3d, size_x, before_x, use_max)
+        source = out_3d
+    if size_y > 1:
+        filter_height(source, out_3d, size_y, before_y, use_max)
+        source = out_3d
+    if source is not out_3d:
+        out_3d[...] = source
+    return out
+
+
+def grey_erosion(frames, size, out=None):
+    """Minimum filter of ``(H, W)`` frames or ``(T, H, W)`` blocks of frames.
+
+    Arguments
+    ---------
+    frames : np.ndarray(shape=(H, W) or (T, H, W))
+    size : int or tuple[int]
+        Size of the rectangular structuring element, an integer or a ``(height, width)`` pair.
+        The frames are filtered independently, so the structuring element is 1 along
+        the ``T``-axis.
+    out : np.ndarray or None
+        Array with the same shape and data type as ``frames`` to store the result in.
+        Can be ``frames`` itself.
+
+    Returns
+    -------
+    np.ndarray
+        Same as ``scipy.ndimage.grey_erosion(frames, size=(1, *size))``.
+    """
+    return _min_or_max_filter(frames, size, out, use_max=False)
+
+
+def grey_dilation(frames, size, out=None):
+    """Maximum filter of ``(H, W)`` frames or ``(T, H, W)`` blocks of frames.
+
+    See ``grey_erosion`` for the arguments. Same as ``scipy.ndimage.grey_dilation``.
+    """
+    return _min_or_max_filter(frames, size, out, use_max=True)
+
+
+def grey_opening(frames, size, out=None):
+    """Erosion followed by dilation, see ``grey_erosion`` for the arguments.
+
+    The erosion is stored in ``out``, so no frame-sized temporaries are allocated if ``out`` is given.
+    """
+    out = grey_erosion(frames, size, out=out)
+    return grey_dilation(out, size, out=out)
+
+
+def grey_closing(frames, size, out=None):
+    """Dilation followed by erosion, see ``grey_erosion`` for the arguments.
+
+    The dilation is stored in ``out``, so no frame-sized temporaries are allocated if ``out`` is given.
+    """
+    out = grey_dilation(frames, size, out=out)
+    return grey_erosion(out, size, out=out)
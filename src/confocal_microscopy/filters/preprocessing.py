@@ -0,0 +1,104 @@
+"""Preprocessing of video frames before particle tracking.
+"""
+import numpy as np
+
+from . import exposure, morphology
+
+__all__ = ["FramePreprocessor"]
+
+
+class FramePreprocessor:
+    """Background subtraction, morphological denoising and contrast stretching of frames.
+
+    The frames are processed as ``(B, H, W)`` blocks with in-place operations on a
+    working buffer, so the only allocation is the buffer itself, which is reused
+    between calls with blocks of the same shape. The morphology is computed with the
+    parallel filters in ``filters.morphology``. The steps are
+
+     1. Subtract the background and set negative values to zero.
+     2. Grey opening with a ``opening_size x opening_size`` window.
+     3. Grey closing with a ``closing_size x closing_size`` window.
+     4. Compute ``(frame - limits[0]) / limits[1] * scale`` and clip to ``[0, scale]``.
+
+    which is the same as the ``IMSLoader`` in ``scripts/track_particles.py`` used to do
+    frame by frame.
+
+    Arguments
+    ---------
+    opening_size : int or None
+        Size of the grey opening window, no opening is done if None.
+    closing_size : int or None
+        Size of the grey closing window, no closing is done if None.
+    scale : float
+        Value that ``limits[1]`` is mapped to.
+    dtype : np.dtype
+        Data type of the working buffer and the default output data type.
+    """
+    def __init__(self, opening_size=3, closing_size=5, scale=255, dtype=np.float32):
+        self.opening_size = opening_size
+        self.closing_size = closing_size
+        self.scale = scale
+        self.dtype = np.dtype(dtype)
+        self._buffers = {}
+
+    def _get_buffer(self, name, shape):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=self.dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    def __call__(self, frames, background=None, limits=None, out=None):
+        """Preprocess a single ``(H, W)`` frame or a ``(B, H, W)`` block of frames.
+
+        Arguments
+        ---------
+        frames : np.ndarray(shape=(H, W) or (B, H, W))
+        background : np.ndarray(shape=(H, W)) or None
+            Background signal that is subtracted from all frames.
+        limits : tuple[float] or None
+            Lower limit and scale of the contrast stretch, no stretch is done if None.
+        out : np.ndarray or None
+            Array with the same shape as ``frames`` to store the result in, e.g. a
+            ``float32`` or ``uint8`` array. If it has the same data type as the working
+            buffer, then it is used as working buffer.
+
+        Returns
+        -------
+        np.ndarray
+            The preprocessed frames (``out`` if given).
+        """
+        if out is None:
+            out = np.empty(frames.shape, dtype=self.dtype)
+        elif out.shape != frames.shape:
+            raise ValueError(
+                f"The output array has shape {out.shape}, but the frames have shape {frames.shape}"
+            )
+
+        if out.dtype == self.dtype:
+            work = out
+        else:
+            work = self._get_buffer("work", frames.shape)
+
+        # Remove background signal
+        if background is None:
+            work[...] = frames
+        else:
+            np.subtract(frames, background, out=work, casting="unsafe")
+        np.maximum(work, 0, out=work)
+
+        # Morphological denoising
+        if self.opening_size is not None:
+            morphology.grey_opening(work, self.opening_size, out=work)
+        if self.closing_size is not None:
+            morphology.grey_closing(work, self.closing_size, out=work)
+
+        # Clip dynamic range, clipping to [limits[0], limits[0] + limits[1]] before
+        # scaling is the same as clipping to [0, scale] after scaling
+        if limits is not None:
+            low, high = limits[0], limits[0] + limits[1]
+            exposure.clip_and_scale(work, low, high, self.scale, out=work)
+
+        if work is not out:
+            np.copyto(out, work, casting="unsafe")
+        return out
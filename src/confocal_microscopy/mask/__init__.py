@@ -1 +1,2 @@
-from .filter import *
\ No newline at end of file
+from .components import *
+from .filter import *
@@ -0,0 +1,194 @@
+"""Statistics of the connected components of masks.
+
+The mask is labelled once, and the statistics of all components are computed together
+with ``np.bincount`` and ``ndimage.find_objects``. Components are then filtered with a
+lookup table from labels to the value to keep, which takes one pass over the labels.
+Large volumes can be labelled block by block, and the labels of components that cross
+the block boundaries are merged afterwards.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+__all__ = [
+    "ComponentStatistics",
+    "label_components",
+    "compute_component_statistics",
+    "filter_components",
+]
+
+
+ComponentStatistics = namedtuple(
+    "ComponentStatistics",
+    ["sizes", "bounding_boxes", "centroids", "mean_intensities"],
+)
+ComponentStatistics.__doc__ = """Statistics of the components, stored at index ``label - 1``.
+
+sizes : np.ndarray(shape=(N,))
+    Number of pixels in each component.
+bounding_boxes : np.ndarray(shape=(N, 2*ndim))
+    Start and stop index of the component along each axis, ``(start0, stop0, start1, ...)``.
+centroids : np.ndarray(shape=(N, ndim))
+mean_intensities : np.ndarray(shape=(N,)) or None
+    Mean of the intensity image in each component, None if no intensity image is given.
+"""
+
+
+def _get_boundary_pairs(previous_plane, next_plane, structure):
+    """Pairs of labels that touch across a block boundary between two planes.
+    """
+    pairs = []
+    centre = np.array(structure.shape[1:]) // 2
+    for offset in np.argwhere(structure[-1]):
+        shift = offset - centre
+        previous_slices = []
+        next_slices = []
+        for step, length in zip(shift, previous_plane.shape):
+            previous_slices.append(slice(max(0, -step), length - max(0, step)))
+            next_slices.append(slice(max(0, step), length - max(0, -step)))
+        previous_labels = previous_plane[tuple(previous_slices)].ravel()
+        next_labels = next_plane[tuple(next_slices)].ravel()
+        touching = (previous_labels > 0) & (next_labels > 0)
+        pairs.append(np.stack([previous_labels[touching], next_labels[touching]], axis=1))
+    return np.concatenate(pairs, axis=0)
+
+
+def _merge_labels(num_labels, pairs):
+    """Lookup table from block labels to consecutive labels of the merged components.
+
+    The merged components are numbered by their smallest block label, so they are in the
+    same order as the labels of ``ndimage.label``.
+    """
+    pairs = np.unique(pairs, axis=0)
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+        shape=(num_labels + 1, num_labels + 1),
+    )
+    num_components, components = connected_components(graph, directed=False)
+
+    first_labels = np.full(num_components, num_labels + 1)
+    np.minimum.at(first_labels, components, np.arange(num_labels + 1))
+    order = np.argsort(first_labels)
+    new_labels = np.empty(num_components, dtype=np.int64)
+    new_labels[order] = np.arange(num_components)
+    return new_labels[components], num_components - 1
+
+
+def label_components(mask, structure=None, block_size=None, dtype=np.int32):
+    """Label the connected components of a mask, like ``ndimage.label``.
+
+    Arguments
+    ---------
+    mask : np.ndarray or array-like
+        Mask to label. With ``block_size``, any array that can be sliced along the first
+        axis, e.g. an ``h5py`` dataset, can be used.
+    structure : np.ndarray or None
+        Connectivity, see ``ndimage.label``. Face connectivity if None.
+    block_size : int or None
+        If given, then the mask is labelled in blocks of ``block_size`` slices along the
+        first axis, and the labels of components that cross block boundaries are merged.
+    dtype : np.dtype
+        Data type of the labels.
+
+    Returns
+    -------
+    np.ndarray
+        The labels, same as ``ndimage.label(mask, structure)[0]``.
+    int
+        The number of components.
+    """
+    ndim = len(mask.shape)
+    if structure is None:
+        structure = ndimage.generate_binary_structure(ndim, 1)
+    structure = np.asarray(structure, dtype=bool)
+    if block_size is None or block_size >= mask.shape[0]:
+        labelled = np.empty(mask.shape, dtype=dtype)
+        num_labels = ndimage.label(np.asarray(mask), structure, output=labelled)
+        return labelled, num_labels
+
+    labelled = np.empty(mask.shape, dtype=dtype)
+    num_labels = 0
+    pairs = [np.empty((0, 2), dtype=labelled.dtype)]
+    for start in range(0, mask.shape[0], block_size):
+        stop = min(start + block_size, mask.shape[0])
+        block_labels = labelled[start:stop]
+        block_mask = np.asarray(mask[start:stop])
+        num_block_labels = ndimage.label(block_mask, structure, output=block_labels)
+        block_labels[block_labels > 0] += num_labels
+        num_labels += num_block_labels
+        if start > 0:
+            pairs.append(_get_boundary_pairs(labelled[start - 1], labelled[start], structure))
+
+    lookup_table, num_components = _merge_labels(num_labels, np.concatenate(pairs, axis=0))
+    np.take(lookup_table.astype(dtype), labelled, out=labelled)
+    return labelled, num_components
+
+
+def compute_component_statistics(labelled, num_labels=None, intensity=None):
+    """Compute the size, bounding box, centroid and mean intensity of all components.
+
+    Arguments
+    ---------
+    labelled : np.ndarray
+        Labels, e.g. from ``label_components``.
+    num_labels : int or None
+        Number of components, the maximum label if None.
+    intensity : np.ndarray or None
+        Image with the same shape as ``labelled`` to compute the mean intensities of.
+
+    Returns
+    -------
+    ComponentStatistics
+    """
+    if num_labels is None:
+        num_labels = int(labelled.max()) if labelled.size > 0 else 0
+    labels = labelled.ravel()
+    sizes = np.bincount(labels, minlength=num_labels + 1)[1:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroids = np.empty((num_labels, labelled.ndim))
+        for axis, length in enumerate(labelled.shape):
+            coordinate_shape = [1] * labelled.ndim
+            coordinate_shape[axis] = length
+            coordinates = np.arange(length).reshape(coordinate_shape)
+            coordinates = np.broadcast_to(coordinates, labelled.shape).ravel()
+            coordinate_sums = np.bincount(labels, coordinates, minlength=num_labels + 1)
+            centroids[:, axis] = coordinate_sums[1:] / sizes
+
+        mean_intensities = None
+        if intensity is not None:
+            intensity_sums = np.bincount(labels, intensity.ravel(), minlength=num_labels + 1)
+            mean_intensities = intensity_sums[1:] / sizes
+
+    bounding_boxes = np.zeros((num_labels, 2*labelled.ndim), dtype=np.int64)
+    for index, slices in enumerate(ndimage.find_objects(labelled, max_label=num_labels)):
+        if slices is None:
+            continue
+        for axis, axis_slice in enumerate(slices):
+            bounding_boxes[index, 2*axis] = axis_slice.start
+            bounding_boxes[index, 2*axis + 1] = axis_slice.stop
+    return ComponentStatistics(sizes, bounding_boxes, centroids, mean_intensities)
+
+
+def filter_components(labelled, keep, out=None):
+    """Keep the components where ``keep[label - 1]`` is True, with one lookup table pass.
+
+    Arguments
+    ---------
+    labelled : np.ndarray
+    keep : np.ndarray(shape=(N,), dtype=bool)
+        Whether to keep each component, e.g. ``statistics.sizes >= min_size``.
+    out : np.ndarray or None
+        Boolean array to store the mask of the kept components in.
+
+    Returns
+    -------
+    np.ndarray
+        Mask of the kept components.
+    """
+    lookup_table = np.concatenate([[False], np.asarray(keep, dtype=bool)])
+    if out is None:
+        out = np.empty(labelled.shape, dtype=bool)
+    return np.take(lookup_table, labelled, out=out, mode="clip")
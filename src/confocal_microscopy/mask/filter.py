@@ -1,19 +1,24 @@
 """Used for segmentation
 """
-from scipy import ndimage
+import numpy as np
 
+from .components import compute_component_statistics, filter_components, label_components
 
-def filter_small_regions(mask, min_size, out=None):
+
+def filter_small_regions(mask, min_size, out=None, structure=None, block_size=None):
+    """Remove the connected components with fewer than ``min_size`` pixels.
+
+    The mask is labelled once, the component sizes are counted together and the small
+    components are removed with ``components.filter_components``. See
+    ``components.label_components`` for the ``structure`` and ``block_size`` arguments.
+    """
+    labelled, num_labels = label_components(mask, structure, block_size)
+    sizes = compute_component_statistics(labelled, num_labels).sizes
     if out is None:
-        out = mask.copy()
-    elif out is not mask:
-        out[:] = mask
+        out = np.empty(mask.shape, dtype=mask.dtype)
+    if out.dtype == bool:
+        return filter_components(labelled, sizes >= min_size, out=out)
 
-    labelled, num_labels = ndimage.label(mask)
-    for label in range(num_labels):
-        label += 1
-        label_mask = (labelled == label)
-        if label_mask.sum() < min_size:
-            out[label_mask] = 0
-    
-    return out
+    # Keep the values of other masks, e.g. labels or intensities
+    kept = filter_components(labelled, sizes >= min_size)
+    return np.multiply(mask, kept, out=out)
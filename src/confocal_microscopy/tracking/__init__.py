@@ -1 +1 @@
-from . import utils
\ No newline at end of file
+from . import particle_tracking, utils
@@ -2,8 +2,6 @@
 """
 import contextlib
 
-from datetime import datetime
-
 import numpy as np
 import scipy.ndimage as ndimage
 import joblib
@@ -12,7 +10,9 @@ from joblib import Parallel, delayed
 from openpiv import tools, pyprocess, scaling, filters,validation, preprocess, piv
 from tqdm import tqdm, trange
 
-from ..files import ims
+from ..files import frame_cache, ims, statistics_cache
+from ..filters import background as background_estimators
+from ..filters.preprocessing import FramePreprocessor
 
 
 ## For joblib progressbar, credit to frenzykryger at stackexchange: https://stackoverflow.com/questions/24983493/tracking-progress-of-joblib-parallel-execution/49950707#49950707
@@ -36,33 +36,177 @@ def tqdm_joblib(tqdm_object):
         tqdm_object.close()
 
 
-def load_data(data_path, morphology=True):
-    print("Loading data...")
-    raw_data = ims.load_video_stack(data_path).squeeze().astype(float)
-    
-    print("Removing background signal...")
-    background_signal = np.mean(raw_data, axis=0)
-    raw_data -= (background_signal + 5)
-
-    print("Clipping data...")
-    raw_data[raw_data < 0] = 0
-    raw_data[raw_data > 20] = 20
-    if not morphology:
-        return raw_data
-
-    for i in trange(raw_data.shape[0], desc="Preprocessing data"):
-        raw_data[i] = ndimage.grey_closing(ndimage.grey_opening(raw_data[i], 3), 3)
-    
-    return raw_data
+DEFAULT_MEMORY_BUDGET__BYTES = 2**30
+
+
+def _get_block_size(frame_shape, raw_dtype, dtype, num_timesteps, memory_budget__bytes):
+    """Number of frames per block, so the raw block and preprocessing buffers fit the budget.
+    """
+    num_pixels = frame_shape[0] * frame_shape[1]
+    bytes_per_frame = num_pixels * (np.dtype(raw_dtype).itemsize + 3*np.dtype(dtype).itemsize)
+    return int(max(1, min(num_timesteps, memory_budget__bytes // bytes_per_frame)))
+
+
+def _iter_raw_blocks(data_path, shape, raw_dtype, block_size, num_workers):
+    """Yield the first time point and the raw ``(B, H, W)`` frames of each block.
+
+    The frames are read from the frame cache if it exists. Otherwise, they are read into
+    a buffer that is reused for all blocks.
+    """
+    num_timesteps = shape[0]
+    cached_frames = frame_cache.open_frame_cache(data_path)
+    if cached_frames is None:
+        buffer = np.empty((block_size, *shape[2:]), dtype=raw_dtype)
+
+    for start in range(0, num_timesteps, block_size):
+        stop = min(start + block_size, num_timesteps)
+        if cached_frames is not None:
+            yield start, cached_frames[start:stop]
+            continue
+
+        raw_block = buffer[:stop - start]
+        ims.load_hyperstack(
+            data_path,
+            channels=[0],
+            time_points=range(start, stop),
+            out=raw_block[:, np.newaxis, np.newaxis],
+            num_workers=num_workers,
+        )
+        yield start, raw_block
+
+
+def _load_background_statistics(data_path, shape, raw_dtype, block_size, num_workers, estimator):
+    """Load the background statistics from the statistics cache, or compute them.
+
+    The estimator makes one or more passes over the video, block by block.
+    """
+    num_timesteps = shape[0]
+    statistics = statistics_cache.load_statistics(
+        data_path, num_timesteps=num_timesteps, estimator=estimator.name
+    )
+    if statistics is not None:
+        return statistics
+
+    num_blocks = -(-num_timesteps // block_size)
+
+    def iter_blocks():
+        raw_blocks = _iter_raw_blocks(data_path, shape, raw_dtype, block_size, num_workers)
+        for _, raw_block in tqdm(raw_blocks, desc="Computing background", total=num_blocks):
+            yield raw_block
+
+    statistics = estimator.fit(iter_blocks, num_timesteps)
+    statistics_cache.save_statistics(
+        data_path, statistics, num_timesteps=num_timesteps, estimator=estimator.name
+    )
+    return statistics
+
+
+def iter_data(
+    data_path,
+    morphology=True,
+    num_workers=1,
+    dtype=np.float32,
+    out=None,
+    memory_budget__bytes=DEFAULT_MEMORY_BUDGET__BYTES,
+    background="mean",
+):
+    """Yield the preprocessed video of ``load_data`` in ``(B, H, W)`` blocks.
+
+    The background signal is computed in a first pass over the video (or loaded from the
+    statistics cache), and the blocks are preprocessed in a second pass. The block size is
+    chosen so the raw block and the preprocessing buffers fit in ``memory_budget__bytes``.
+    Background estimators that need several passes (e.g. ``"median"``) read the video
+    once per pass.
+
+    Arguments
+    ---------
+    data_path : pathlib.Path
+    morphology : bool
+        If True, then the frames are denoised with grey opening and closing.
+    num_workers : int
+        Number of threads used to decompress the video.
+    dtype : np.dtype
+    out : np.ndarray or None
+        Array of shape ``(T, H, W)``, e.g. a memory map, that the blocks are written to.
+        If None, then the blocks are written to a buffer that is reused for all blocks,
+        so copy the blocks that should be kept.
+    memory_budget__bytes : int
+    background : str or background estimator
+        Name of an estimator in ``filters.background.BACKGROUND_ESTIMATORS`` or an estimator.
+
+    Yields
+    ------
+    int
+        The first time point of the block.
+    np.ndarray(shape=(B, H, W))
+        The preprocessed frames.
+    """
+    shape, raw_dtype = ims.get_video_shape(data_path)
+    if out is not None and out.shape != (shape[0], *shape[2:]):
+        raise ValueError(
+            f"The output array has shape {out.shape}, but the video has {shape[0]} frames of "
+            f"shape {shape[2:]}"
+        )
+    block_size = _get_block_size(shape[2:], raw_dtype, dtype, shape[0], memory_budget__bytes)
+    if out is None:
+        buffer = np.empty((block_size, *shape[2:]), dtype=dtype)
+
+    estimator = background_estimators.get_background_estimator(background)
+    statistics = _load_background_statistics(
+        data_path, shape, raw_dtype, block_size, num_workers, estimator
+    )
+    offset_background_signal = estimator.get_background(statistics) + 5
+    # Clipping commutes with grey opening and closing, so the preprocessor, which clips
+    # after the morphology, gives the same result as clipping first
+    morphology_size = 3 if morphology else None
+    preprocessor = FramePreprocessor(
+        opening_size=morphology_size, closing_size=morphology_size, scale=20, dtype=dtype
+    )
+    raw_blocks = _iter_raw_blocks(data_path, shape, raw_dtype, block_size, num_workers)
+    for start, raw_block in raw_blocks:
+        if out is None:
+            block = buffer[:len(raw_block)]
+        else:
+            block = out[start:start + len(raw_block)]
+        if estimator.time_varying:
+            time_points = range(start, start + len(raw_block))
+            offset_background_signal = estimator.get_background(statistics, time_points) + 5
+        preprocessor(raw_block, offset_background_signal, limits=(0, 20), out=block)
+        yield start, block
+
+
+def load_data(
+    data_path,
+    morphology=True,
+    num_workers=1,
+    dtype=np.float32,
+    out=None,
+    memory_budget__bytes=DEFAULT_MEMORY_BUDGET__BYTES,
+    background="mean",
+):
+    """Load a video, remove the background signal, clip it to [0, 20] and denoise it.
+
+    The video is read and preprocessed block by block (see ``iter_data``), so apart from
+    the output array, the memory usage is bounded by ``memory_budget__bytes``. Give a memory
+    map as ``out`` to preprocess videos that are larger than the memory.
+    """
+    print("Loading and preprocessing data...")
+    if out is None:
+        shape, _ = ims.get_video_shape(data_path)
+        out = np.empty((shape[0], *shape[2:]), dtype=dtype)
+
+    blocks = iter_data(
+        data_path, morphology, num_workers, dtype, out, memory_budget__bytes, background
+    )
+    for _ in tqdm(blocks, desc="Preprocessing data"):
+        pass
+    return out
 
 
 def find_framerate__s_per_frame(metadata):
-    time_info = metadata['TimeInfo']
-    first_time = datetime.fromisoformat(time_info['TimePoint1'])
-    last_time = datetime.fromisoformat(time_info[f'TimePoint{len(time_info)-3}'])
-    duration = last_time - first_time
-    duration__s = duration.seconds - duration.microseconds * 1e-6
-    return duration__s / (len(time_info) - 3)
+    """Time between two frames, the same as the frame interval used for the particle tracks.
+    """
+    return metadata.frame_interval__s
 
 
 def track_between_frames__px_per_s(start_frame_idx, image_stack, dt, window_size, overlap, search_area_size):
@@ -86,11 +230,26 @@ def track_particles(
     window_size=8,
     overlap=4,
     search_area_size=8,
-    morphology=True
+    morphology=True,
+    memmap_path=None,
+    memory_budget__bytes=DEFAULT_MEMORY_BUDGET__BYTES,
+    background="mean",
 ):
-    # Load data
-    image_stack = load_data(data_path, morphology=morphology)
-    metadata = ims.load_ims_metadata(data_path)
+    # Load data, if a memmap path is given, then the preprocessed video is stored on disk
+    out = None
+    if memmap_path is not None:
+        shape, _ = ims.get_video_shape(data_path)
+        out = np.lib.format.open_memmap(
+            memmap_path, mode="w+", dtype=np.float32, shape=(shape[0], *shape[2:])
+        )
+    image_stack = load_data(
+        data_path,
+        morphology=morphology,
+        out=out,
+        memory_budget__bytes=memory_budget__bytes,
+        background=background,
+    )
+    metadata = ims.get_metadata(data_path)
     image_size = ims.find_physical_image_size(metadata)[1:]
     pixel_size = np.round(np.array(image_size) / image_stack.shape[1:], 3)
     n_velocities = image_stack.shape[0] - 1
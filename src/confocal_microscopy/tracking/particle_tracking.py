@@ -0,0 +1,662 @@
+"""Streaming particle tracking.
+
+The features are located one frame at a time and fed to trackpy's incremental linker
+by ``link_features``, which works like ``tp.link_df_iter``. Tracks with fewer than
+``min_track_length`` points are removed as soon as they cannot be extended any more,
+that is, when no point has been added for more than ``memory`` frames, and the rows of
+the other tracks are passed on as soon as their track is long enough. The memory usage
+therefore depends on the number of particles that are tracked at the same time, not on
+the length of the video.
+
+Locating the features is the slowest step, and it can be spread over a pool of worker
+processes with ``locate_features_parallel``. Each process gets a copy of the loader and
+a contiguous range of frames, and the features are returned in frame order.
+
+Long recordings can be tracked with checkpoints. ``locate_features_checkpointed`` stores
+the features of each block of frames in a checkpoint directory, so a tracking run that
+is interrupted only locates the remaining blocks when it is started again. Linking a
+dense part of a video can fail with a ``SubnetOversizeException``, and ``link_features``
+then links only the next ``retry_length`` frames again with more robust parameters,
+e.g. an adaptive search range, and records the parameters used for each segment.
+"""
+import json
+import multiprocessing
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numba
+import numpy as np
+import pandas as pd
+import trackpy as tp
+from trackpy.linking import Linker, SubnetOversizeException
+
+from ..files.tracks import TrackWriter
+
+__all__ = [
+    "locate_features",
+    "locate_features_parallel",
+    "locate_parallel",
+    "locate_features_checkpointed",
+    "LinkingSegment",
+    "get_default_retry_parameters",
+    "link_features",
+    "filter_stubs",
+    "iter_tracks",
+    "track_particles",
+]
+
+
+def locate_features(frames, diameter, minmass=50, start_frame=0, **locate_kwargs):
+    """Locate the features of each frame with ``tp.locate``.
+
+    Arguments
+    ---------
+    frames : Iterable[np.ndarray]
+        Preprocessed frames, e.g. a ``LazyIMSVideoLoader``.
+    diameter : int
+    minmass : float
+    start_frame : int
+        Frame number of the first frame.
+    **locate_kwargs
+        Passed to ``tp.locate``, ``preprocess`` is False by default since the frames are
+        preprocessed by the loader.
+
+    Yields
+    ------
+    pd.DataFrame
+        The features of one frame, with a ``frame`` column.
+    """
+    locate_kwargs.setdefault("preprocess", False)
+    for frame_number, frame in enumerate(frames, start=start_frame):
+        features = tp.locate(frame, diameter, minmass=minmass, **locate_kwargs)
+        features["frame"] = frame_number
+        yield features
+
+
+def _locate_frames(loader, start, stop, diameter, minmass, block_size, locate_kwargs):
+    """Locate the features of frames ``start`` to ``stop``, reading ``block_size`` frames at a time.
+    """
+    features = []
+    for block_start in range(start, stop, block_size):
+        frames = loader[block_start:min(block_start + block_size, stop)]
+        features.extend(
+            locate_features(frames, diameter, minmass, start_frame=block_start, **locate_kwargs)
+        )
+    return pd.concat(features, ignore_index=True)
+
+
+def _init_worker():
+    """Use one numba thread per worker process, since the processes already use the cores.
+
+    Each spawned process runs the tasks on its main thread, so the morphology filters
+    would otherwise start parallel kernels with one thread per core in every process.
+    """
+    numba.set_num_threads(1)
+
+
+def _locate_frame_range(loader, start, stop, diameter, minmass, block_size, locate_kwargs):
+    """Locate the features of frames ``start`` to ``stop``, run in the worker processes.
+    """
+    with loader:
+        return _locate_frames(loader, start, stop, diameter, minmass, block_size, locate_kwargs)
+
+
+def _iter_located_ranges(
+    loader, frame_ranges, diameter, minmass, workers, block_size, locate_kwargs
+):
+    """Yield the features of each ``(start, stop)`` frame range, in order.
+
+    The ranges are located by a pool of ``workers`` processes, with at most ``2*workers``
+    ranges in flight, or in this process if ``workers`` is one.
+    """
+    if workers <= 1:
+        for start, stop in frame_ranges:
+            yield _locate_frames(
+                loader, start, stop, diameter, minmass, block_size, locate_kwargs
+            )
+        return
+
+    frame_ranges = iter(frame_ranges)
+    # The processes are spawned, since forking after numba has started threads can deadlock
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker) as pool:
+        pending = deque()
+
+        def submit_tasks():
+            while len(pending) < 2*workers:
+                frame_range = next(frame_ranges, None)
+                if frame_range is None:
+                    return
+                start, stop = frame_range
+                future = pool.submit(
+                    _locate_frame_range,
+                    loader,
+                    start,
+                    stop,
+                    diameter,
+                    minmass,
+                    block_size,
+                    locate_kwargs,
+                )
+                pending.append(future)
+
+        submit_tasks()
+        while pending:
+            features = pending.popleft().result()
+            submit_tasks()
+            yield features
+
+
+def _split_frames(features, start, stop):
+    """Yield the features of each frame from ``start`` to ``stop``, also of empty frames.
+    """
+    frame_features = dict(tuple(features.groupby("frame", sort=False)))
+    for frame_number in range(start, stop):
+        if frame_number in frame_features:
+            yield frame_features[frame_number].reset_index(drop=True)
+        else:
+            yield features.iloc[:0]
+
+
+def _get_frame_ranges(num_frames, frames_per_range):
+    return [
+        (start, min(start + frames_per_range, num_frames))
+        for start in range(0, num_frames, frames_per_range)
+    ]
+
+
+def locate_features_parallel(
+    loader,
+    diameter,
+    minmass=50,
+    workers=None,
+    frames_per_task=None,
+    block_size=16,
+    **locate_kwargs,
+):
+    """Locate the features of each frame with a pool of worker processes.
+
+    The frames are split into contiguous ranges of ``frames_per_task`` frames, and each
+    worker process reads, preprocesses and locates the features of one range at a time
+    with its own copy of the loader. At most ``2*workers`` ranges are in flight, so the
+    memory usage doesn't grow with the length of the video.
+
+    Arguments
+    ---------
+    loader : confocal_microscopy.files.ims.LazyIMSVideoLoader
+        An open loader, so the background and limits are computed once, before the loader
+        is sent to the workers. Subclasses must be importable by the worker processes.
+    diameter : int
+    minmass : float
+    workers : int or None
+        Number of worker processes, ``os.cpu_count()`` if None.
+    frames_per_task : int or None
+        Number of frames per range. By default, each worker gets about four ranges.
+    block_size : int
+        Number of frames that are read and preprocessed together by the workers.
+    **locate_kwargs
+        Passed to ``tp.locate``.
+
+    Yields
+    ------
+    pd.DataFrame
+        The features of one frame, with a ``frame`` column, in frame order.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    num_frames = len(loader)
+    if frames_per_task is None:
+        frames_per_task = max(1, -(-num_frames // (4*workers)))
+    locate_kwargs.setdefault("preprocess", False)
+
+    frame_ranges = _get_frame_ranges(num_frames, frames_per_task)
+    located_ranges = _iter_located_ranges(
+        loader, frame_ranges, diameter, minmass, workers, block_size, locate_kwargs
+    )
+    for (start, stop), features in zip(frame_ranges, located_ranges):
+        yield from _split_frames(features, start, stop)
+
+
+def locate_parallel(loader, diameter, minmass=50, workers=None, **kwargs):
+    """Locate the features of all frames with a pool of worker processes, like ``tp.batch``.
+
+    See ``locate_features_parallel`` for the arguments.
+
+    Returns
+    -------
+    pd.DataFrame
+        The features of all frames, sorted by frame.
+    """
+    features = locate_features_parallel(loader, diameter, minmass, workers, **kwargs)
+    return pd.concat(list(features), ignore_index=True)
+
+
+def _get_checkpoint_path(checkpoint_dir, start, stop):
+    return checkpoint_dir / f"features_{start:06d}-{stop:06d}.parquet"
+
+
+def _prepare_checkpoint_dir(checkpoint_dir, key):
+    """Create the checkpoint directory, and remove its checkpoints if they have another key.
+    """
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    key_path = checkpoint_dir / "checkpoint.json"
+    if key_path.is_file():
+        with key_path.open("r") as f:
+            if json.load(f) == key:
+                return
+    for checkpoint_path in checkpoint_dir.glob("features_*.parquet"):
+        checkpoint_path.unlink()
+    with key_path.open("w") as f:
+        json.dump(key, f)
+
+
+def _write_checkpoint(features, checkpoint_path):
+    """Write the checkpoint to a temporary file first, so interrupted writes are not used.
+    """
+    partial_path = checkpoint_path.with_name(f"{checkpoint_path.name}.partial")
+    features.to_parquet(partial_path, index=False)
+    partial_path.replace(checkpoint_path)
+
+
+def locate_features_checkpointed(
+    loader,
+    checkpoint_dir,
+    diameter,
+    minmass=50,
+    frames_per_checkpoint=500,
+    workers=1,
+    block_size=16,
+    **locate_kwargs,
+):
+    """Locate the features of each frame and store them in blocks of frames in ``checkpoint_dir``.
+
+    Blocks that are already stored are read instead of located again, so an interrupted
+    run continues from the blocks that are not finished. The checkpoints are removed if
+    the video, the settings of the loader (see ``LazyIMSVideoLoader.cache_key``) or the
+    arguments change.
+
+    Arguments
+    ---------
+    loader : confocal_microscopy.files.ims.LazyIMSVideoLoader
+        An open loader.
+    checkpoint_dir : pathlib.Path or str
+    diameter : int
+    minmass : float
+    frames_per_checkpoint : int
+        Number of frames per stored block.
+    workers : int
+        If more than one, then the blocks are located by a pool of worker processes,
+        see ``locate_features_parallel``.
+    block_size : int
+        Number of frames that are read and preprocessed together.
+    **locate_kwargs
+        Passed to ``tp.locate``.
+
+    Yields
+    ------
+    pd.DataFrame
+        The features of one frame, with a ``frame`` column, in frame order.
+    """
+    locate_kwargs.setdefault("preprocess", False)
+    checkpoint_dir = Path(checkpoint_dir)
+    num_frames = len(loader)
+    key = {
+        "loader": loader.cache_key(),
+        "frames_per_checkpoint": frames_per_checkpoint,
+        "diameter": diameter,
+        "minmass": minmass,
+        "locate_kwargs": locate_kwargs,
+    }
+    # Round trip through JSON, so the key compares equal to the stored key
+    key = json.loads(json.dumps(key, default=str))
+    _prepare_checkpoint_dir(checkpoint_dir, key)
+
+    frame_ranges = _get_frame_ranges(num_frames, frames_per_checkpoint)
+    missing_ranges = [
+        (start, stop) for start, stop in frame_ranges
+        if not _get_checkpoint_path(checkpoint_dir, start, stop).is_file()
+    ]
+    located_ranges = _iter_located_ranges(
+        loader, missing_ranges, diameter, minmass, workers, block_size, locate_kwargs
+    )
+    for start, stop in frame_ranges:
+        checkpoint_path = _get_checkpoint_path(checkpoint_dir, start, stop)
+        if (start, stop) in missing_ranges:
+            features = next(located_ranges)
+            _write_checkpoint(features, checkpoint_path)
+        else:
+            features = pd.read_parquet(checkpoint_path)
+        yield from _split_frames(features, start, stop)
+
+
+LinkingSegment = namedtuple("LinkingSegment", ["start_frame", "stop_frame", "parameters"])
+LinkingSegment.__doc__ = """The frames from ``start_frame`` to ``stop_frame`` were linked with
+``parameters``.
+"""
+
+
+class _Linker(Linker):
+    """Trackpy linker where the maximum subnetwork size can be changed.
+    """
+    def __init__(self, search_range, max_subnet_size=None, **kwargs):
+        if max_subnet_size is not None:
+            self.MAX_SUB_NET_SIZE = max_subnet_size
+            self.MAX_SUB_NET_SIZE_ADAPTIVE = max_subnet_size
+        super().__init__(search_range, **kwargs)
+
+
+def get_default_retry_parameters(search_range):
+    """Linking parameters that are tried, in order, when linking fails.
+
+    First, the search range is reduced around the particles that can't be linked (the
+    adaptive search of trackpy), then the search range is halved everywhere, and finally
+    the adaptive search may solve subnetworks of up to 30 particles instead of 15, which
+    is the limit trackpy uses without the adaptive search. The time to solve a subnetwork
+    grows exponentially with its size, so dense clusters of more particles can take
+    practically forever to link.
+    """
+    adaptive_parameters = {"adaptive_stop": 0.1*search_range, "adaptive_step": 0.9}
+    return [
+        adaptive_parameters,
+        {"search_range": 0.5*search_range, **adaptive_parameters},
+        {"search_range": 0.5*search_range, **adaptive_parameters, "max_subnet_size": 30},
+    ]
+
+
+def link_features(
+    features,
+    search_range,
+    memory=0,
+    retry_parameters=None,
+    retry_length=50,
+    segments=None,
+    pos_columns=("y", "x"),
+    **link_kwargs,
+):
+    """Link features frame by frame like ``tp.link_df_iter``, retrying frames that fail.
+
+    If linking a frame raises a ``SubnetOversizeException``, then a new linker is started
+    from the previous frame with the first of ``retry_parameters`` that can link the frame.
+    The next ``retry_length`` frames are linked with these parameters, and then a linker
+    with the original parameters is started. The particles of the frame the new linker
+    starts from keep their labels, so tracks continue across the segments, but particles
+    that are not in that frame (within the ``memory``) get new labels.
+
+    Arguments
+    ---------
+    features : Iterable[pd.DataFrame]
+        The features of each frame, with a ``frame`` column, in frame order.
+    search_range : float
+    memory : int
+    retry_parameters : list[dict] or None
+        Linking parameters that replace the original parameters when linking fails, tried
+        in order. Can contain ``search_range``, ``memory``, ``max_subnet_size`` (the
+        largest subnetwork trackpy will solve) and the other arguments of ``tp.link``.
+        See ``get_default_retry_parameters`` for the default.
+    retry_length : int
+        Number of frames that are linked with the retry parameters.
+    segments : list or None
+        If given, then a ``LinkingSegment`` with the parameters of each segment is appended.
+    pos_columns : tuple[str]
+    **link_kwargs
+        Other arguments of ``tp.link``, e.g. ``adaptive_stop``.
+
+    Yields
+    ------
+    pd.DataFrame
+        The features of each frame, with a ``particle`` column.
+    """
+    if retry_parameters is None:
+        retry_parameters = get_default_retry_parameters(search_range)
+    original_parameters = {**link_kwargs, "search_range": search_range, "memory": memory}
+    parameter_list = [original_parameters] + [
+        {**original_parameters, **parameters} for parameters in retry_parameters
+    ]
+    pos_columns = list(pos_columns)
+
+    linker = None
+    parameter_index = 0
+    segment_start = None
+    retry_stop = None
+    # Labels of the first level of the current linker, and the label offset of new tracks
+    initial_labels = {}
+    label_offset = 0
+    next_label = 0
+    previous_frame = None
+
+    def start_linker(parameters, frame_number, coords, labels):
+        nonlocal initial_labels, label_offset
+        parameters = dict(parameters)
+        new_linker = _Linker(parameters.pop("search_range"), **parameters)
+        new_linker.init_level(coords, frame_number)
+        initial_labels = dict(zip(new_linker.particle_ids, labels))
+        label_offset = next_label
+        return new_linker
+
+    def end_segment(stop_frame):
+        if segments is not None and segment_start is not None and stop_frame > segment_start:
+            segments.append(
+                LinkingSegment(segment_start, stop_frame, parameter_list[parameter_index])
+            )
+
+    for frame in features:
+        if len(frame) > 0:
+            frame_number = int(frame["frame"].iloc[0])
+        else:
+            frame_number = 0 if previous_frame is None else previous_frame[0] + 1
+        coords = frame[pos_columns].to_numpy(dtype=float)
+
+        if retry_stop is not None and frame_number >= retry_stop:
+            end_segment(frame_number)
+            parameter_index = 0
+            segment_start = frame_number
+            retry_stop = None
+            linker = start_linker(original_parameters, *previous_frame)
+
+        if linker is None:
+            linker = start_linker(original_parameters, frame_number, coords, [])
+            segment_start = frame_number
+        else:
+            try:
+                linker.next_level(coords, frame_number)
+            except SubnetOversizeException:
+                end_segment(frame_number)
+                for parameter_index in range(parameter_index + 1, len(parameter_list)):
+                    linker = start_linker(parameter_list[parameter_index], *previous_frame)
+                    try:
+                        linker.next_level(coords, frame_number)
+                    except SubnetOversizeException:
+                        continue
+                    break
+                else:
+                    raise
+                segment_start = frame_number
+                retry_stop = frame_number + retry_length
+
+        labels = [
+            initial_labels.get(particle_id, label_offset + particle_id)
+            for particle_id in linker.particle_ids
+        ]
+        if labels:
+            next_label = max(next_label, max(labels) + 1)
+        previous_frame = frame_number, coords, labels
+        yield frame.assign(particle=np.array(labels, dtype=np.int64))
+
+    if previous_frame is not None:
+        end_segment(previous_frame[0] + 1)
+
+
+def filter_stubs(linked_frames, min_track_length, memory=0):
+    """Remove short tracks from a stream of linked frames, like ``tp.filter_stubs``.
+
+    Rows of tracks with at least ``min_track_length`` points are yielded when the track
+    reaches that length and directly after that. The other rows are kept until their track
+    is long enough or can't be extended any more, so the rows are not sorted by frame.
+
+    Arguments
+    ---------
+    linked_frames : Iterable[pd.DataFrame]
+        The linked features of each frame, with ``frame`` and ``particle`` columns, in frame order.
+    min_track_length : int
+    memory : int
+        The ``memory`` used for linking, the number of frames a particle can disappear for.
+
+    Yields
+    ------
+    pd.DataFrame
+        Rows of tracks that are long enough.
+    """
+    pending = None
+    long_tracks = set()
+    last_frames = {}
+    for linked_frame in linked_frames:
+        if len(linked_frame) == 0:
+            continue
+        frame_number = int(linked_frame["frame"].iloc[0])
+        particles = linked_frame["particle"].to_numpy()
+        last_frames.update(dict.fromkeys(particles.tolist(), frame_number))
+
+        is_long = np.isin(particles, list(long_tracks))
+        if np.any(is_long):
+            yield linked_frame[is_long]
+        short_rows = linked_frame[~is_long]
+        pending = short_rows if pending is None else pd.concat([pending, short_rows])
+
+        track_lengths = pending.groupby("particle")["frame"].transform("size").to_numpy()
+        is_long = track_lengths >= min_track_length
+        if np.any(is_long):
+            long_tracks.update(pending["particle"].to_numpy()[is_long].tolist())
+            yield pending[is_long]
+            pending = pending[~is_long]
+
+        # Forget tracks that can't be extended any more
+        finished = [
+            particle for particle, last_frame in last_frames.items()
+            if last_frame < frame_number - memory
+        ]
+        if finished:
+            pending = pending[~pending["particle"].isin(finished)]
+            long_tracks.difference_update(finished)
+            for particle in finished:
+                del last_frames[particle]
+
+
+def iter_tracks(
+    frames,
+    diameter=5,
+    minmass=50,
+    search_range=16,
+    memory=2,
+    min_track_length=2,
+    chunk_size=100_000,
+    link_kwargs=None,
+    workers=1,
+    frames_per_task=None,
+    checkpoint_dir=None,
+    frames_per_checkpoint=500,
+    retry_parameters=None,
+    retry_length=50,
+    segments=None,
+    **locate_kwargs,
+):
+    """Locate, link and filter particles frame by frame, and yield the tracks in chunks.
+
+    Arguments
+    ---------
+    frames : Iterable[np.ndarray]
+        Preprocessed frames, e.g. a ``LazyIMSVideoLoader``.
+    diameter : int
+    minmass : float
+    search_range : float
+    memory : int
+    min_track_length : int
+        Tracks with fewer points are removed, see ``filter_stubs``.
+    chunk_size : int
+        Number of rows per chunk.
+    link_kwargs : dict or None
+        Other arguments for ``tp.link_df_iter``, e.g. ``adaptive_step`` and ``adaptive_stop``.
+    workers : int
+        If more than one, then ``frames`` must be an open ``LazyIMSVideoLoader``, and the
+        features are located by ``workers`` processes with ``locate_features_parallel``.
+    frames_per_task : int or None
+        See ``locate_features_parallel``.
+    checkpoint_dir : pathlib.Path or str or None
+        If given, then ``frames`` must be an open ``LazyIMSVideoLoader``, and the features
+        of every ``frames_per_checkpoint`` frames are stored in this directory and reused
+        when the tracking is run again, see ``locate_features_checkpointed``.
+    frames_per_checkpoint : int
+    retry_parameters : list[dict] or None
+    retry_length : int
+    segments : list or None
+        See ``link_features``.
+    **locate_kwargs
+        Passed to ``tp.locate``.
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks of rows of the tracks, with the same columns as ``tp.link``.
+    """
+    link_kwargs = {} if link_kwargs is None else link_kwargs
+    if checkpoint_dir is not None:
+        features = locate_features_checkpointed(
+            frames,
+            checkpoint_dir,
+            diameter,
+            minmass,
+            frames_per_checkpoint,
+            workers,
+            **locate_kwargs,
+        )
+    elif workers > 1:
+        features = locate_features_parallel(
+            frames, diameter, minmass, workers, frames_per_task, **locate_kwargs
+        )
+    else:
+        features = locate_features(frames, diameter, minmass, **locate_kwargs)
+    linked_frames = link_features(
+        features,
+        search_range,
+        memory,
+        retry_parameters,
+        retry_length,
+        segments,
+        **link_kwargs,
+    )
+
+    chunk = []
+    num_rows = 0
+    for rows in filter_stubs(linked_frames, min_track_length, memory):
+        chunk.append(rows)
+        num_rows += len(rows)
+        if num_rows >= chunk_size:
+            yield pd.concat(chunk, ignore_index=True)
+            chunk = []
+            num_rows = 0
+    if chunk:
+        yield pd.concat(chunk, ignore_index=True)
+
+
+def track_particles(frames, output_path=None, metadata=None, wavelength=None, **kwargs):
+    """Track particles with ``iter_tracks`` and store or return the tracks.
+
+    If ``output_path`` is given, then the chunks are written to a Parquet file with
+    ``files.tracks.TrackWriter`` as they are found, with the recording ``metadata`` and
+    the ``wavelength``, and the path is returned. Otherwise, the tracks are returned as one
+    DataFrame, sorted by frame and particle. See ``iter_tracks`` for the other arguments.
+    """
+    chunks = iter_tracks(frames, **kwargs)
+    if output_path is None:
+        chunks = list(chunks)
+        if not chunks:
+            return pd.DataFrame(columns=["y", "x", "mass", "frame", "particle"])
+        tracks = pd.concat(chunks, ignore_index=True)
+        return tracks.sort_values(["frame", "particle"], ignore_index=True)
+
+    output_path = Path(output_path)
+    with TrackWriter(output_path, metadata, wavelength=wavelength) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return output_path
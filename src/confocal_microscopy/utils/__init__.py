@@ -1,2 +1,3 @@
 from .pipeline import *
-from .slice_tools import *
\ No newline at end of file
+from .scheduler import *
+from .slice_tools import *
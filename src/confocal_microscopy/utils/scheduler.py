@@ -0,0 +1,311 @@
+"""Run the same processing on many files, e.g. track the particles of all recordings.
+
+The jobs are run largest first, so the large jobs don't end up at the end of the run
+when most workers are idle. Jobs whose outputs are newer than all their inputs are
+skipped. The jobs can be run by a local pool of worker processes, and by several
+processes (e.g. on different nodes of a cluster) that share a lock directory. A process
+claims a job by creating its lock file, refreshes the lock file while the job runs, and
+removes the lock file when the job is done, so each job is run by one process at a time.
+
+Example
+-------
+
+>>> jobs = [
+...     Job(str(path), [path], [path.with_suffix(".csv")], path.stat().st_size, [path])
+...     for path in paths
+... ]
+>>> results = run_jobs(process_file, jobs, workers=4, summary_path=Path("summary.json"))
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+__all__ = [
+    "Job",
+    "JobResult",
+    "is_up_to_date",
+    "get_lock_path",
+    "run_jobs",
+    "write_summary",
+]
+
+
+# Lock files are refreshed at least this often while their job runs
+_MAX_HEARTBEAT_INTERVAL__S = 60
+
+
+Job = namedtuple("Job", ["name", "inputs", "outputs", "size", "arguments"])
+Job.__doc__ = """A job that calls ``function(*arguments)``.
+
+name : str
+    Unique name of the job, e.g. the path of the input file.
+inputs : list[pathlib.Path]
+outputs : list[pathlib.Path]
+    The job is skipped if all outputs exist and are newer than all inputs.
+size : int
+    The largest jobs are run first, e.g. the size of the input file in bytes.
+arguments : tuple
+"""
+
+JobResult = namedtuple("JobResult", ["name", "status", "wall_time__s", "error"])
+JobResult.__doc__ = """The result of a job.
+
+name : str
+status : str
+    ``"done"``, ``"failed"``, ``"up to date"`` or ``"locked"`` (run by another process).
+wall_time__s : float
+error : str or None
+    The traceback if the job failed.
+"""
+
+
+def is_up_to_date(job):
+    """Check if all outputs of a job exist and are newer than all its inputs.
+    """
+    try:
+        oldest_output = min(Path(path).stat().st_mtime_ns for path in job.outputs)
+    except (FileNotFoundError, ValueError):
+        return False
+    newest_input = max((Path(path).stat().st_mtime_ns for path in job.inputs), default=0)
+    return oldest_output >= newest_input
+
+
+def get_lock_path(lock_dir, job):
+    """Lock file of a job, named after the job and a hash of the job name.
+    """
+    name_hash = hashlib.sha1(job.name.encode("utf-8")).hexdigest()[:12]
+    stem = Path(job.name).stem[:64]
+    return Path(lock_dir) / f"{stem}-{name_hash}.lock"
+
+
+def _remove_lock(lock_path):
+    try:
+        lock_path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _take_over_stale_lock(lock_path, lock_timeout__s):
+    """Remove the lock file if it is stale, returns False if it is held by another process.
+
+    Several processes can find the same stale lock, so the lock file is renamed to a unique
+    name first, which only one of them can do. If the renamed file is not the stale lock
+    file, then another process took over the lock in the meantime, and its lock is restored.
+    """
+    try:
+        stat = lock_path.stat()
+    except FileNotFoundError:
+        return True
+    if lock_timeout__s is None or time.time() - stat.st_mtime < lock_timeout__s:
+        return False
+
+    unique_name = f"{lock_path.name}.{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}"
+    renamed_path = lock_path.with_name(unique_name)
+    try:
+        os.rename(lock_path, renamed_path)
+    except FileNotFoundError:
+        # Another process removed the stale lock file
+        return True
+    # Inode numbers are reused, so the modification times are compared too
+    renamed_stat = renamed_path.stat()
+    is_stale_lock = (
+        (renamed_stat.st_dev, renamed_stat.st_ino, renamed_stat.st_mtime_ns)
+        == (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+    )
+    if not is_stale_lock:
+        try:
+            os.link(renamed_path, lock_path)
+        except FileExistsError:
+            pass
+    renamed_path.unlink()
+    return is_stale_lock
+
+
+def _acquire_lock(lock_path, lock_timeout__s):
+    """Create the lock file, returns False if another process holds the lock.
+
+    Lock files that have not been refreshed for ``lock_timeout__s`` are left by processes
+    that crashed, and are taken over.
+    """
+    for _ in range(2):
+        try:
+            lock_file = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _take_over_stale_lock(lock_path, lock_timeout__s):
+                return False
+            continue
+
+        owner = {"host": socket.gethostname(), "pid": os.getpid(), "started": time.time()}
+        with os.fdopen(lock_file, "w") as f:
+            json.dump(owner, f)
+        return True
+    return False
+
+
+class _LockHeartbeat:
+    """Refresh the modification time of a lock file while its job runs, so it isn't stale.
+    """
+    def __init__(self, lock_path, interval__s):
+        self.lock_path = lock_path
+        self.interval__s = interval__s
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._refresh_lock, daemon=True)
+
+    def _refresh_lock(self):
+        while not self._stopped.wait(self.interval__s):
+            try:
+                os.utime(self.lock_path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+
+def _get_heartbeat_interval(lock_timeout__s):
+    if lock_timeout__s is None:
+        return _MAX_HEARTBEAT_INTERVAL__S
+    return min(_MAX_HEARTBEAT_INTERVAL__S, lock_timeout__s / 4)
+
+
+def _run_job(function, job, lock_dir, lock_timeout__s):
+    """Run one job, in this process or in a worker process.
+    """
+    lock_path = None
+    if lock_dir is not None:
+        lock_path = get_lock_path(lock_dir, job)
+        if not _acquire_lock(lock_path, lock_timeout__s):
+            return JobResult(job.name, "locked", 0.0, None)
+
+    start_time = time.perf_counter()
+    try:
+        # Another process may have finished the job since the job list was made
+        if lock_path is not None and is_up_to_date(job):
+            return JobResult(job.name, "up to date", 0.0, None)
+        if lock_path is None:
+            function(*job.arguments)
+        else:
+            with _LockHeartbeat(lock_path, _get_heartbeat_interval(lock_timeout__s)):
+                function(*job.arguments)
+    except Exception:
+        status, error = "failed", traceback.format_exc()
+    else:
+        status, error = "done", None
+    finally:
+        if lock_path is not None:
+            _remove_lock(lock_path)
+    return JobResult(job.name, status, time.perf_counter() - start_time, error)
+
+
+def write_summary(results, summary_path, wall_time__s=None):
+    """Store the status and wall time of each job, and the totals, as JSON.
+    """
+    statuses = [result.status for result in results]
+    summary = {
+        "host": socket.gethostname(),
+        "finished": datetime.now().isoformat(timespec="seconds"),
+        "wall_time__s": wall_time__s,
+        "work_time__s": sum(result.wall_time__s for result in results),
+        "num_jobs": {status: statuses.count(status) for status in sorted(set(statuses))},
+        "jobs": [result._asdict() for result in results],
+    }
+    partial_path = Path(f"{summary_path}.partial")
+    with partial_path.open("w") as f:
+        json.dump(summary, f, indent=2)
+    partial_path.replace(summary_path)
+
+
+def run_jobs(
+    function,
+    jobs,
+    workers=1,
+    lock_dir=None,
+    lock_timeout__s=None,
+    summary_path=None,
+    progress=True,
+):
+    """Run ``function(*job.arguments)`` for each job that is not up to date, largest first.
+
+    Arguments
+    ---------
+    function : Callable
+        With ``workers > 1``, the function must be importable by the worker processes,
+        which are spawned.
+    jobs : Iterable[Job]
+    workers : int
+        Number of worker processes. With one worker, the jobs are run in this process.
+    lock_dir : pathlib.Path or str or None
+        If given, then a lock file is created in this directory for each job that is run,
+        so several processes that use the same lock directory can run the same jobs.
+    lock_timeout__s : float or None
+        Lock files that have not been refreshed for this long are left by processes that
+        crashed, and are taken over. The lock files are refreshed every minute, or every
+        quarter of the timeout if it is shorter. If None, then lock files are never taken over.
+    summary_path : pathlib.Path or str or None
+        If given, then the summary is written to this JSON file after each job.
+    progress : bool
+        Print a line for each job that is finished.
+
+    Returns
+    -------
+    list[JobResult]
+        The results, in the order the jobs finished.
+    """
+    start_time = time.perf_counter()
+    jobs = sorted(jobs, key=lambda job: job.size, reverse=True)
+    if lock_dir is not None:
+        Path(lock_dir).mkdir(parents=True, exist_ok=True)
+
+    results = []
+    outdated_jobs = []
+    for job in jobs:
+        if is_up_to_date(job):
+            results.append(JobResult(job.name, "up to date", 0.0, None))
+        else:
+            outdated_jobs.append(job)
+    jobs = outdated_jobs
+    if progress:
+        print(f"Running {len(jobs)} jobs, {len(results)} jobs are up to date", flush=True)
+
+    def add_result(result):
+        results.append(result)
+        if progress and result.status != "locked":
+            print(f"{result.status}: {result.name} ({result.wall_time__s:.0f} s)", flush=True)
+            if result.error is not None:
+                print(result.error, flush=True)
+        if summary_path is not None:
+            write_summary(results, summary_path, time.perf_counter() - start_time)
+
+    if workers <= 1:
+        for job in jobs:
+            add_result(_run_job(function, job, lock_dir, lock_timeout__s))
+    else:
+        # Forking after numba or other libraries have started threads can deadlock
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            # The pool starts the jobs in the order they are submitted, so largest first
+            futures = [
+                pool.submit(_run_job, function, job, lock_dir, lock_timeout__s)
+                for job in jobs
+            ]
+            for future in as_completed(futures):
+                add_result(future.result())
+
+    if summary_path is not None:
+        write_summary(results, summary_path, time.perf_counter() - start_time)
+    return results
@@ -1,37 +1,156 @@
 """Used for segmentation.
 """
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from functools import wraps
 
 import numpy as np
-from tqdm import trange
+from tqdm import tqdm
 
 __all__ = ["apply_slicewise"]
 
 
-def _get_permutation_index(i, slice_axis):
-    if i < slice_axis:
-        return i+1
-    elif i == slice_axis:
-        return 0
-    else:
-        return i
+def _take_slice(image, index, axis):
+    return image[(slice(None),)*axis + (index,)]
 
 
-def apply_slicewise(f, axis=0, progress=False):
-    range_ = range
-    if progress:
-        range_ = trange
+class _WrappedFunction:
+    """Picklable reference to a function that is decorated with ``apply_slicewise``.
+
+    Pickle stores functions by module and name, which gives the decorated function instead
+    of the original function, so the worker processes look up the decorated function and
+    call the function it wraps.
+    """
+    def __init__(self, module, qualname):
+        self.module = module
+        self.qualname = qualname
+
+    def __call__(self, *args, **kwargs):
+        return _find_wrapped_function(self.module, self.qualname)(*args, **kwargs)
+
+
+def _find_wrapped_function(module, qualname, f=None):
+    """The function wrapped by the ``apply_slicewise`` decorated function ``module.qualname``.
+
+    Returns None if that function does not wrap ``f`` (or does not wrap any function).
+    """
+    function = importlib.import_module(module)
+    for name in qualname.split("."):
+        function = getattr(function, name)
+    # Follow other decorators that use functools.wraps
+    while function is not None:
+        wrapped_function = getattr(function, "_slicewise_function", None)
+        if wrapped_function is not None and (f is None or wrapped_function is f):
+            return wrapped_function
+        function = getattr(function, "__wrapped__", None)
+    return None
+
+
+def _get_picklable_function(f):
+    """``f``, or a reference to it if it is decorated with ``apply_slicewise``.
+    """
+    module = getattr(f, "__module__", None)
+    qualname = getattr(f, "__qualname__", None)
+    if module is None or qualname is None or "<locals>" in qualname:
+        return f
+    try:
+        wrapped_function = _find_wrapped_function(module, qualname, f)
+    except (ImportError, AttributeError):
+        return f
+    if wrapped_function is None:
+        return f
+    return _WrappedFunction(module, qualname)
+
+
+def _apply_to_slices(f, image_slices, args, kwargs):
+    """Apply ``f`` to the slices of a chunk, run in the worker threads or processes.
+    """
+    return [np.asarray(f(image_slice, *args, **kwargs)) for image_slice in image_slices]
+
+
+def apply_slicewise(f, axis=0, progress=False, workers=1, chunk_size=1, executor="thread"):
+    """Apply a function to each slice of an array along ``axis`` and stack the results.
+
+    The output shape and data type are found from the result of the first slice, and the
+    results are written into a preallocated C-contiguous array (or the ``slicewise_out``
+    keyword argument of the new function) with the slice axis at ``axis``. The other keyword
+    arguments, including ``out``, are passed on to ``f``.
+
+    Arguments
+    ---------
+    f : Callable
+        Function that is called as ``f(image_slice, *args, **kwargs)``.
+    axis : int
+    progress : bool
+    workers : int
+        If more than one, then the slices are processed by a pool of ``workers`` threads or
+        processes. Threads are enough for functions that release the GIL (e.g. most numpy,
+        scipy and numba code). The processes are spawned, so ``f`` must be importable
+        (also when ``apply_slicewise`` is used as a decorator) and its arguments picklable.
+    chunk_size : int
+        Number of slices per pool task.
+    executor : str
+        ``"thread"`` or ``"process"``.
+
+    Returns
+    -------
+    Callable
+        Function that is called as ``new_f(image, *args, slicewise_out=None, **kwargs)``.
+    """
+    if executor not in ("thread", "process"):
+        raise ValueError(f"The executor must be 'thread' or 'process', not {executor}")
+
     @wraps(f)
-    def new_f(image, *args, **kwargs):
-        slices = [slice(None)]*image.ndim
-        out = [None]*image.shape[axis]
-        for i in range_(image.shape[axis]):
-            slices[axis] = i
-            out[i] = f(image[tuple(slices)], *args, **kwargs)
-
-        permutation = [_get_permutation_index(i, axis) for i in range(out[0].ndim + 1)]
-        out = np.stack(out, axis=0).transpose(permutation)
+    def new_f(image, *args, slicewise_out=None, **kwargs):
+        num_slices = image.shape[axis]
+        if num_slices == 0:
+            raise ValueError(f"Cannot apply a function slicewise along an empty axis {axis}")
+
+        first_result = np.asarray(f(_take_slice(image, 0, axis), *args, **kwargs))
+        out_shape = (*first_result.shape[:axis], num_slices, *first_result.shape[axis:])
+        out = slicewise_out
+        if out is None:
+            out = np.empty(out_shape, dtype=first_result.dtype)
+        elif out.shape != out_shape:
+            raise ValueError(f"The output array has shape {out.shape}, but should be {out_shape}")
+        _take_slice(out, 0, axis)[...] = first_result
+
+        chunk_starts = range(1, num_slices, chunk_size)
+        progress_bar = tqdm(total=num_slices, disable=not progress)
+        progress_bar.update(1)
+        if workers <= 1:
+            for index in range(1, num_slices):
+                _take_slice(out, index, axis)[...] = f(
+                    _take_slice(image, index, axis), *args, **kwargs
+                )
+                progress_bar.update(1)
+            progress_bar.close()
+            return out
+
+        function = f
+        if executor == "thread":
+            pool = ThreadPoolExecutor(workers)
+        else:
+            function = _get_picklable_function(f)
+            # Forking after numba or other libraries have started threads can deadlock
+            pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        with pool:
+            futures = {}
+            for start in chunk_starts:
+                stop = min(start + chunk_size, num_slices)
+                image_slices = [_take_slice(image, index, axis) for index in range(start, stop)]
+                future = pool.submit(_apply_to_slices, function, image_slices, args, kwargs)
+                futures[future] = start
+
+            for future in as_completed(futures):
+                start = futures[future]
+                results = future.result()
+                for index, result in enumerate(results, start=start):
+                    _take_slice(out, index, axis)[...] = result
+                progress_bar.update(len(results))
+        progress_bar.close()
         return out
 
+    new_f._slicewise_function = f
     return new_f
-
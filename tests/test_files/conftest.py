@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from confocal_microscopy.files.synthetic import write_ims_file
+
+
+@pytest.fixture()
+def video():
+    random_state = np.random.RandomState(0)
+    return random_state.randint(0, 2**12, size=(6, 1, 40, 50)).astype(np.uint16)
+
+
+@pytest.fixture(params=[False, True], ids=["gzip", "gzip+shuffle"])
+def ims_path(tmp_path, video, request):
+    path = tmp_path / "video red ch_1.ims"
+    return write_ims_file(path, video, width=45, height=35, shuffle=request.param)
@@ -0,0 +1,107 @@
+import json
+
+import numpy as np
+import pytest
+
+from confocal_microscopy.files.catalogue import Catalogue, find_wavelength
+from confocal_microscopy.files.synthetic import write_ims_file
+
+
+@pytest.fixture()
+def dataset(tmp_path, video):
+    root = tmp_path / "dataset"
+    fish = root / "Fish 1"
+    vessel = fish / "Vessel 1000"
+    vessel.mkdir(parents=True)
+    write_ims_file(vessel / "video 12.00.00 red ch_1.ims", video, width=45, height=35)
+    write_ims_file(fish / "Snap 12.00.00.ims", video[:1], width=45, height=35)
+    with (fish / "Snap 12.00.00_vertices.json").open("w") as f:
+        json.dump({"vertices": [{"x": [0, 1], "y": [1, 0]}]}, f)
+    with (vessel / "video 12.00.00 red ch_1.csv").open("w") as f:
+        f.write("")
+    return root
+
+
+@pytest.fixture()
+def catalogue(tmp_path):
+    with Catalogue(tmp_path / "catalogue.sqlite") as catalogue:
+        yield catalogue
+
+
+def test_refresh_finds_recordings_snapshots_and_rois(dataset, catalogue, video):
+    catalogue.refresh(dataset)
+    recording, = catalogue.recordings()
+    snapshot, = catalogue.snapshots()
+
+    assert recording.path == dataset / "Fish 1" / "Vessel 1000" / "video 12.00.00 red ch_1.ims"
+    assert recording.wavelength == 1000
+    assert recording.snapshot == snapshot.path == dataset / "Fish 1" / "Snap 12.00.00.ims"
+    assert recording.vertices == snapshot.vertices == {"vertices": [{"x": [0, 1], "y": [1, 0]}]}
+    assert list(recording.outputs) == ["video 12.00.00 red ch_1.csv"]
+    assert recording.metadata["shape"] == [len(video), 1, 35, 45]
+    assert recording.metadata["frame_interval__s"] == pytest.approx(0.1)
+    assert recording.error is None
+
+
+def test_refresh_only_lists_modified_directories(dataset, catalogue, video):
+    assert len(catalogue.refresh(dataset)) == 3
+    assert catalogue.refresh(dataset) == []
+
+    vessel = dataset / "Fish 1" / "Vessel 400"
+    vessel.mkdir()
+    write_ims_file(vessel / "video 12.30.00 red ch_1.ims", video, width=45, height=35)
+    assert catalogue.refresh(dataset) == [dataset / "Fish 1", vessel]
+    assert [recording.wavelength for recording in catalogue.recordings()] == [1000, 400]
+    assert len(catalogue.recordings(wavelength=400)) == 1
+    assert len(catalogue.recordings(root=vessel)) == 1
+
+    assert len(catalogue.refresh(dataset, full=True)) == 4
+
+
+def test_refresh_removes_deleted_files(dataset, catalogue):
+    catalogue.refresh(dataset)
+    (dataset / "Fish 1" / "Snap 12.00.00_vertices.json").unlink()
+    catalogue.refresh(dataset)
+    assert catalogue.recordings(with_vertices=True) == []
+    assert len(catalogue.recordings(with_vertices=False)) == 1
+
+    vessel = dataset / "Fish 1" / "Vessel 1000"
+    for path in vessel.iterdir():
+        path.unlink()
+    vessel.rmdir()
+    catalogue.refresh(dataset)
+    assert catalogue.recordings() == []
+    assert len(catalogue.snapshots()) == 1
+
+
+def test_refresh_keeps_catalogue_between_sessions(dataset, tmp_path):
+    with Catalogue(tmp_path / "catalogue.sqlite") as catalogue:
+        catalogue.refresh(dataset)
+    with Catalogue(tmp_path / "catalogue.sqlite") as catalogue:
+        assert catalogue.refresh(dataset) == []
+        assert catalogue.find_recording(
+            dataset / "Fish 1" / "Vessel 1000" / "video 12.00.00 red ch_1.ims"
+        ).wavelength == 1000
+
+
+def test_corrupt_recordings_are_catalogued_with_error(dataset, catalogue):
+    with (dataset / "Fish 1" / "Vessel 1000" / "corrupt red ch_1.ims").open("wb") as f:
+        f.write(np.zeros(10, dtype=np.uint8).tobytes())
+    catalogue.refresh(dataset)
+    corrupt, _ = catalogue.recordings()
+    assert corrupt.metadata is None
+    assert corrupt.error is not None
+
+
+def test_find_wavelength_from_legend(tmp_path):
+    docx = pytest.importorskip("docx")
+    document = docx.Document()
+    document.add_paragraph("Recordings of fish 1")
+    document.add_paragraph("12.00.00: 400 nm")
+    document.add_paragraph("12.30.00: 1000 nm")
+    document.save(tmp_path / "legend.docx")
+
+    assert find_wavelength(tmp_path / "video 12.30.00 red ch_1.ims") == 1000
+    assert find_wavelength(tmp_path / "video 12.00.00 red ch_1.ims") == 400
+    with pytest.warns(UserWarning):
+        assert find_wavelength(tmp_path / "video 13.00.00 red ch_1.ims") is None
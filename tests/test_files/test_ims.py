@@ -0,0 +1,387 @@
+import os
+import pickle
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from confocal_microscopy.files import frame_cache, ims, statistics_cache
+from confocal_microscopy.files.synthetic import write_ims_file
+from confocal_microscopy.filters import FramePreprocessor, background
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_load_video_stack_crops_to_metadata_size(ims_path, video, num_workers):
+    loaded = ims.load_video_stack(ims_path, num_workers=num_workers)
+
+    assert loaded.dtype == video.dtype
+    np.testing.assert_array_equal(loaded, video[:, :, :35, :45])
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_load_video_stack_fills_out_array(ims_path, video, num_workers, tmp_path):
+    out = np.lib.format.open_memmap(
+        tmp_path / "out.npy", mode="w+", dtype=video.dtype, shape=(4, 1, 35, 45)
+    )
+    loaded = ims.load_video_stack(ims_path, num_timesteps=4, out=out, num_workers=num_workers)
+
+    assert loaded is out
+    np.testing.assert_array_equal(out, video[:4, :, :35, :45])
+
+
+def test_load_video_stack_raises_for_wrong_out_shape(ims_path):
+    with pytest.raises(ValueError):
+        ims.load_video_stack(ims_path, out=np.empty((6, 1, 40, 50), dtype=np.uint16))
+
+
+@pytest.fixture()
+def multichannel_ims_path(tmp_path, video):
+    multichannel_video = np.stack([video, video + 1, video + 2], axis=1)
+    return write_ims_file(tmp_path / "video red ch_1.ims", multichannel_video, width=45, height=35)
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_load_hyperstack_reads_channels_and_time_points(
+    multichannel_ims_path, video, num_workers
+):
+    loaded = ims.load_hyperstack(
+        multichannel_ims_path, channels=[2, 0], time_points=[4, 1, 5], num_workers=num_workers
+    )
+
+    assert loaded.shape == (3, 2, 1, 35, 45)
+    np.testing.assert_array_equal(loaded[:, 0], video[[4, 1, 5], :, :35, :45] + 2)
+    np.testing.assert_array_equal(loaded[:, 1], video[[4, 1, 5], :, :35, :45])
+
+
+def test_load_hyperstack_reads_all_channels_into_out(multichannel_ims_path, video):
+    out = np.empty((6, 3, 1, 16, 16), dtype=video.dtype)
+    loaded, bounding_box = ims.load_hyperstack(
+        multichannel_ims_path, out=out, roi=(0, 10, 16, 20), return_bounding_box=True
+    )
+
+    assert loaded is out
+    assert bounding_box == (0, 16, 16, 32)
+    for channel in range(3):
+        np.testing.assert_array_equal(out[:, channel], video[:, :, :16, 16:32] + channel)
+
+
+class NoPreprocessingLoader(ims.LazyIMSVideoLoader):
+    def _preprocess(self, frame):
+        return frame
+
+
+def test_frame_cache_is_used_by_loaders(ims_path, video):
+    cached_frames = ims.convert_to_frame_cache(ims_path)
+    np.testing.assert_array_equal(cached_frames, video[:, 0, :35, :45])
+
+    loaded = ims.load_video_stack(ims_path, num_timesteps=4)
+    assert isinstance(loaded, np.memmap)
+    np.testing.assert_array_equal(loaded, video[:4, :, :35, :45])
+
+    with NoPreprocessingLoader(ims_path, limits=(0, 1), progress=False) as loader:
+        assert loader.h5 is None
+        assert len(loader) == len(video)
+        np.testing.assert_array_equal(np.stack(list(loader)), video[:, 0, :35, :45])
+
+
+def test_frame_cache_is_ignored_after_ims_file_changes(ims_path, video):
+    ims.convert_to_frame_cache(ims_path)
+    with h5py.File(ims_path, "a") as h5:
+        h5["DataSet/ResolutionLevel 0/TimePoint 0/Channel 0/Data"][0, 0, 0] += 1
+
+    assert frame_cache.open_frame_cache(ims_path) is None
+    assert not isinstance(ims.load_video_stack(ims_path), np.memmap)
+
+
+def test_frame_cache_is_ignored_after_metadata_file_changes(ims_path, video):
+    ims.convert_to_frame_cache(ims_path)
+    metadata_path = ims_path.parent / f"{ims_path.stem}_metadata.txt"
+    metadata_stat = metadata_path.stat()
+    metadata_path.write_text(metadata_path.read_text() + "\n")
+    os.utime(metadata_path, ns=(metadata_stat.st_atime_ns, metadata_stat.st_mtime_ns))
+
+    assert frame_cache.open_frame_cache(ims_path) is None
+
+
+@pytest.mark.parametrize("use_frame_cache", [False, True])
+def test_load_video_stack_raises_for_too_many_time_points(ims_path, video, use_frame_cache):
+    if use_frame_cache:
+        ims.convert_to_frame_cache(ims_path)
+    with pytest.raises(ValueError):
+        ims.load_video_stack(ims_path, num_timesteps=len(video) + 1)
+
+
+def test_loader_statistics_match_two_pass_computation(ims_path, video):
+    frames = video[:, 0, :35, :45]
+    background = frames.astype(float).mean(axis=0)
+    differences = frames - background
+
+    with NoPreprocessingLoader(ims_path, progress=False) as loader:
+        np.testing.assert_allclose(loader.background_signal, background)
+        assert loader._limits == (max(0, differences.min()), differences.max())
+
+
+def test_loader_statistics_are_reused(ims_path, video, monkeypatch):
+    with NoPreprocessingLoader(ims_path, progress=False) as loader:
+        background, limits = loader.background_signal, loader._limits
+
+    def fail(self):
+        raise AssertionError("The statistics should be loaded from the sidecar")
+
+    monkeypatch.setattr(NoPreprocessingLoader, "_compute_statistics", fail)
+    with NoPreprocessingLoader(ims_path, progress=False) as loader:
+        np.testing.assert_array_equal(loader.background_signal, background)
+        assert loader._limits == limits
+
+    monkeypatch.undo()
+    with NoPreprocessingLoader(ims_path, progress=False, num_timesteps=3) as loader:
+        np.testing.assert_allclose(loader.background_signal, video[:3, 0, :35, :45].mean(axis=0))
+
+
+def test_interrupted_statistics_are_not_stored(ims_path, monkeypatch):
+    def interrupt(f, **arrays):
+        f.write(b"PK")
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(statistics_cache.np, "savez", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        statistics_cache.save_statistics(ims_path, {"mean": np.zeros((2, 2))})
+    assert not statistics_cache.get_statistics_path(ims_path).exists()
+    assert statistics_cache.load_statistics(ims_path) is None
+
+
+@pytest.mark.parametrize("use_frame_cache", [False, True])
+def test_prefetching_loader_returns_frames_in_order(ims_path, video, use_frame_cache):
+    if use_frame_cache:
+        ims.convert_to_frame_cache(ims_path)
+
+    with NoPreprocessingLoader(ims_path, limits=(0, 1), progress=False, prefetch=2) as loader:
+        np.testing.assert_array_equal(np.stack(list(loader)), video[:, 0, :35, :45])
+
+        for frame, true_frame in zip(loader, video[:, 0, :35, :45]):
+            np.testing.assert_array_equal(frame, true_frame)
+            break
+        prefetcher = loader._prefetcher
+    assert not prefetcher._thread.is_alive()
+
+
+@pytest.mark.parametrize("use_frame_cache", [False, True])
+def test_loader_supports_slices_and_lists(ims_path, video, use_frame_cache):
+    if use_frame_cache:
+        ims.convert_to_frame_cache(ims_path)
+    frames = video[:, 0, :35, :45]
+
+    with NoPreprocessingLoader(ims_path, limits=(0, 1), progress=False) as loader:
+        np.testing.assert_array_equal(loader[-1], frames[-1])
+        np.testing.assert_array_equal(loader[1:5:2], frames[1:5:2])
+        np.testing.assert_array_equal(loader[::-1], frames[::-1])
+        np.testing.assert_array_equal(loader[[3, -6, 3]], frames[[3, -6, 3]])
+        with pytest.raises(IndexError):
+            loader[len(frames)]
+
+
+def test_loader_lru_cache_reuses_preprocessed_frames(ims_path, video):
+    frame_bytes = video[0, 0, :35, :45].nbytes
+    loader = NoPreprocessingLoader(ims_path, limits=(0, 1), progress=False, lru_cache_bytes=2*frame_bytes)
+    with loader:
+        loader[0:2]
+        loader[1]
+        assert loader.cache_info().hits == 1
+        assert loader.cache_info().misses == 2
+
+        loader[2]
+        loader[0]
+        info = loader.cache_info()
+        assert (info.hits, info.misses, info.num_frames, info.num_bytes) == (1, 4, 2, 2*frame_bytes)
+
+
+def test_get_bounding_box_expands_to_chunks():
+    roi = {'x': [20.5, 30.2, 25], 'y': [3.7, 3.7, 12]}
+    assert ims.get_bounding_box(roi, (35, 45)) == (3, 13, 20, 31)
+    assert ims.get_bounding_box(roi, (35, 45), chunk_shape=(16, 16)) == (0, 16, 16, 32)
+    assert ims.get_bounding_box((30, 50, -5, 10), (35, 45), chunk_shape=(16, 16)) == (16, 35, 0, 16)
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+@pytest.mark.parametrize("use_frame_cache", [False, True])
+def test_load_video_stack_reads_roi(ims_path, video, num_workers, use_frame_cache):
+    if use_frame_cache:
+        ims.convert_to_frame_cache(ims_path)
+
+    roi = {'x': [20.5, 30.2, 25], 'y': [17.7, 17.7, 30]}
+    loaded, bounding_box = ims.load_video_stack(
+        ims_path, num_workers=num_workers, roi=roi, return_bounding_box=True
+    )
+
+    assert bounding_box == (16, 32, 16, 32)
+    np.testing.assert_array_equal(loaded, video[:, :, 16:32, 16:32])
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+@pytest.mark.parametrize("use_frame_cache", [False, True])
+def test_loader_reads_roi(ims_path, video, prefetch, use_frame_cache):
+    if use_frame_cache:
+        ims.convert_to_frame_cache(ims_path)
+    frames = video[:, 0, 16:35, 0:16]
+
+    loader = NoPreprocessingLoader(ims_path, progress=False, prefetch=prefetch, roi=(20, 40, 3, 10))
+    with loader:
+        assert loader.bounding_box == (16, 35, 0, 16)
+        np.testing.assert_array_equal(np.stack(list(loader)), frames)
+        np.testing.assert_array_equal(loader[[1, 2]], frames[[1, 2]])
+        assert loader[2:2].shape == (0, *frames.shape[1:])
+        np.testing.assert_allclose(loader.background_signal, frames.mean(axis=0))
+
+        features = pd.DataFrame({"x": [1.5], "y": [2.5]})
+        full_frame_features = loader.to_full_frame(features)
+        assert (full_frame_features["x"][0], full_frame_features["y"][0]) == (1.5, 18.5)
+
+
+def test_loader_crops_full_frame_statistics_to_roi(ims_path, video):
+    with NoPreprocessingLoader(ims_path, progress=False):
+        pass
+
+    with NoPreprocessingLoader(ims_path, progress=False, roi=(20, 40, 3, 10)) as loader:
+        np.testing.assert_allclose(loader.background_signal, video[:, 0, 16:35, 0:16].mean(axis=0))
+    roi_statistics_path = statistics_cache.get_statistics_path(ims_path, bounding_box=loader.bounding_box)
+    assert not roi_statistics_path.exists()
+
+
+@pytest.mark.parametrize("use_frame_cache", [False, True])
+def test_loader_preprocessor_is_applied_to_frames_and_blocks(ims_path, video, use_frame_cache):
+    if use_frame_cache:
+        ims.convert_to_frame_cache(ims_path)
+    preprocessor = FramePreprocessor()
+    loader = ims.LazyIMSVideoLoader(ims_path, progress=False, preprocessor=preprocessor)
+    with loader:
+        limits = loader._limits
+        expected = preprocessor(video[:, 0, :35, :45], loader.background_signal, limits)
+        np.testing.assert_allclose(np.stack(list(loader)), expected)
+        np.testing.assert_allclose(loader[1:5], expected[1:5])
+        np.testing.assert_allclose(loader[[5, 0]], expected[[5, 0]])
+
+
+def test_loader_background_uses_working_dtype(ims_path, video):
+    with NoPreprocessingLoader(ims_path, progress=False, use_cache=False) as loader:
+        assert loader.background_signal.dtype == np.float32
+        np.testing.assert_allclose(
+            loader.background_signal, video[:, 0, :35, :45].mean(axis=0), rtol=1e-6
+        )
+        assert (loader[0] - loader.background_signal).dtype == np.float32
+        assert loader[[]].dtype == np.float32
+
+
+class ScalingLoader(ims.LazyIMSVideoLoader):
+    def _preprocess(self, frame):
+        return 2.0*frame
+
+
+@pytest.mark.parametrize("use_frame_cache", [False, True])
+def test_loader_workers_return_frames_in_order(ims_path, video, use_frame_cache):
+    if use_frame_cache:
+        ims.convert_to_frame_cache(ims_path)
+    expected = 2.0*video[:, 0, :35, :45]
+
+    with ScalingLoader(ims_path, limits=(0, 1), progress=False, workers=3) as loader:
+        np.testing.assert_array_equal(np.stack(list(loader)), expected)
+        np.testing.assert_array_equal(np.stack(list(loader)), expected)
+        np.testing.assert_array_equal(loader[[5, 0, 2]], expected[[5, 0, 2]])
+
+        for frame in loader:
+            break
+        executor = loader._executor
+    assert executor._shutdown
+    assert loader._executor is None
+
+
+def test_loader_workers_match_serial_preprocessor(ims_path, video):
+    serial_loader = ims.LazyIMSVideoLoader(
+        ims_path, progress=False, preprocessor=FramePreprocessor()
+    )
+    parallel_loader = ims.LazyIMSVideoLoader(
+        ims_path, progress=False, preprocessor=FramePreprocessor(), workers=2
+    )
+    with serial_loader, parallel_loader:
+        np.testing.assert_array_equal(
+            np.stack(list(parallel_loader)), np.stack(list(serial_loader))
+        )
+
+
+def test_loader_reports_stage_timings(ims_path, video):
+    with ScalingLoader(ims_path, limits=(0, 1), progress=False, workers=2) as loader:
+        list(loader)
+        timings = loader.stage_timings()
+        assert timings.read__s > 0
+        assert timings.preprocess__s > 0
+        assert timings.wait__s >= 0
+
+    with ScalingLoader(ims_path, limits=(0, 1), progress=False) as loader:
+        assert loader.stage_timings() == (0, 0, 0)
+
+
+def test_loader_median_background_is_cached_separately(ims_path, video, monkeypatch):
+    frames = video[:, 0, :35, :45]
+    with NoPreprocessingLoader(ims_path, progress=False, background="median") as loader:
+        np.testing.assert_allclose(loader.background_signal, np.median(frames, axis=0))
+        assert loader._limits[1] == pytest.approx(np.max(frames - np.median(frames, axis=0)))
+    with NoPreprocessingLoader(ims_path, progress=False) as loader:
+        np.testing.assert_allclose(loader.background_signal, frames.mean(axis=0), rtol=1e-6)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The statistics should be loaded from the statistics cache")
+
+    monkeypatch.setattr(ims.statistics_cache, "save_statistics", fail)
+    with NoPreprocessingLoader(ims_path, progress=False, background="median") as loader:
+        np.testing.assert_allclose(loader.background_signal, np.median(frames, axis=0))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_loader_subtracts_running_median_per_frame(ims_path, video, workers):
+    frames = video[:, 0, :35, :45]
+    estimator = background.RunningMedian(window=3, step=2)
+    statistics = estimator.fit(lambda: [frames], len(frames))
+    expected = frames - estimator.get_background(statistics, range(len(frames)))
+
+    preprocessor = FramePreprocessor(opening_size=None, closing_size=None)
+    loader = ims.LazyIMSVideoLoader(
+        ims_path,
+        limits=None,
+        progress=False,
+        preprocessor=preprocessor,
+        background=estimator,
+        workers=workers,
+    )
+    with loader:
+        limits = loader._limits
+        expected = np.clip((np.maximum(expected, 0) - limits[0]) * 255 / limits[1], 0, 255)
+        np.testing.assert_allclose(np.stack(list(loader)), expected, rtol=1e-4, atol=1e-3)
+        np.testing.assert_allclose(loader[[4, 1]], expected[[4, 1]], rtol=1e-4, atol=1e-3)
+        np.testing.assert_allclose(loader[3], expected[3], rtol=1e-4, atol=1e-3)
+
+
+def test_loader_percentile_limits(ims_path, video):
+    frames = video[:, 0, :35, :45]
+    with NoPreprocessingLoader(ims_path, progress=False, limit_percentiles=(1, 99)) as loader:
+        differences = frames - loader.background_signal
+        bin_width = (differences.max() - differences.min()) / 4096
+        expected = np.percentile(differences, [1, 99])
+        expected = [max(0, expected[0]), expected[1]]
+        np.testing.assert_allclose(loader._limits, expected, atol=bin_width)
+
+
+def test_unpickled_loader_reopens_file(ims_path, video):
+    loader = ims.LazyIMSVideoLoader(
+        ims_path, progress=False, preprocessor=FramePreprocessor(), workers=2, prefetch=2
+    )
+    with loader:
+        expected = np.stack(list(loader))
+        copied_loader = pickle.loads(pickle.dumps(loader))
+
+    assert copied_loader.h5 is None
+    assert copied_loader._workers == 1
+    np.testing.assert_array_equal(copied_loader.background_signal, loader.background_signal)
+    np.testing.assert_array_equal(copied_loader[[3, 1]], expected[[3, 1]])
+    with copied_loader:
+        np.testing.assert_array_equal(np.stack(list(copied_loader)), expected)
+    assert copied_loader.h5 is None
@@ -0,0 +1,37 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+from confocal_microscopy.files import ims, metadata
+
+
+def test_metadata_properties(ims_path, video):
+    ims_metadata = metadata.get_metadata(ims_path)
+
+    assert ims_metadata.shape == (len(video), 1, 35, 45)
+    np.testing.assert_allclose(ims_metadata.extents__µm, [1, 0.5*35, 0.5*45])
+    np.testing.assert_allclose(ims_metadata.pixel_size__µm, [0.5, 0.5])
+    np.testing.assert_allclose(ims_metadata.relative_timestamps__s, 0.1*np.arange(len(video)))
+    np.testing.assert_allclose(ims_metadata.frame_interval__s, 0.1)
+
+
+def test_metadata_matches_attribute_walk(ims_path):
+    ims_metadata = metadata.get_metadata(ims_path)
+    attributes = ims.load_ims_metadata(ims_path)
+
+    assert {group: dict(ims_metadata[group]) for group in ims_metadata} == attributes
+    timestamps = [
+        np.datetime64(datetime.fromisoformat(attributes["TimeInfo"][f"TimePoint{i + 1}"]))
+        for i in range(len(ims_metadata.timestamps))
+    ]
+    np.testing.assert_array_equal(ims_metadata.timestamps, timestamps)
+
+
+def test_metadata_is_cached_until_file_changes(ims_path):
+    ims_metadata = metadata.get_metadata(ims_path)
+    assert metadata.get_metadata(ims_path) is ims_metadata
+
+    stat = ims_path.stat()
+    os.utime(ims_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert metadata.get_metadata(ims_path) is not ims_metadata
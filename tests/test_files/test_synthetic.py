@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from confocal_microscopy.files import ims, metadata, synthetic
+
+
+def test_particles_move_with_constant_speed():
+    video = synthetic.make_particle_video(
+        3, shape=(1, 64, 64), num_particles=1, speed__px_per_frame=2, noise=0, seed=0
+    )
+    peaks = [np.array(np.unravel_index(np.argmax(frame[0]), frame[0].shape)) for frame in video]
+
+    assert video.dtype == np.uint16
+    assert np.linalg.norm(peaks[1] - peaks[0]) == pytest.approx(2, abs=1.5)
+    np.testing.assert_allclose(peaks[2] - peaks[1], peaks[1] - peaks[0], atol=1)
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "lzf"])
+def test_synthetic_ims_file_can_be_read(tmp_path, compression):
+    path = synthetic.write_synthetic_ims_file(
+        tmp_path / "synthetic red ch_1.ims",
+        5,
+        shape=(1, 40, 40),
+        width=30,
+        height=35,
+        compression=compression,
+        seed=0,
+    )
+    video = synthetic.make_particle_video(5, shape=(1, 40, 40), seed=0)
+
+    np.testing.assert_array_equal(ims.load_video_stack(path, num_workers=2), video[..., :35, :30])
+    assert metadata.get_metadata(path).shape == (5, 1, 35, 30)
+    assert metadata.get_metadata(path).frame_interval__s == pytest.approx(0.1)
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from confocal_microscopy.files import tracks as track_store
+from confocal_microscopy.files.metadata import get_metadata
+
+
+@pytest.fixture()
+def tracks():
+    random_state = np.random.RandomState(0)
+    num_frames, particles_per_frame = 100, 20
+    num_rows = num_frames*particles_per_frame
+    particles = [
+        random_state.choice(200, particles_per_frame, replace=False) for _ in range(num_frames)
+    ]
+    return pd.DataFrame(
+        {
+            "y": random_state.uniform(0, 512, num_rows),
+            "x": random_state.uniform(0, 512, num_rows),
+            "mass": random_state.uniform(50, 500, num_rows),
+            "size": random_state.uniform(1, 3, num_rows),
+            "ecc": random_state.uniform(0, 1, num_rows),
+            "signal": random_state.uniform(0, 50, num_rows),
+            "raw_mass": random_state.uniform(0, 1000, num_rows),
+            "ep": random_state.uniform(0, 1, num_rows),
+            "frame": np.repeat(np.arange(num_frames), particles_per_frame),
+            "particle": np.concatenate(particles),
+        }
+    )
+
+
+def assert_tracks_equal(stored, expected):
+    expected = expected.sort_values(["frame", "particle"], ignore_index=True)
+    assert list(stored.columns) == track_store.TRACK_SCHEMA.names
+    for column in ["frame", "particle"]:
+        np.testing.assert_array_equal(stored[column], expected[column])
+    for column in ["x", "y", "mass", "size", "ecc", "signal", "raw_mass", "ep"]:
+        np.testing.assert_allclose(stored[column], expected[column], rtol=1e-6)
+
+
+def test_tracks_are_stored_in_frame_row_groups(tracks, tmp_path):
+    metadata = {"pixel_size__µm": np.array([0.5, 0.25]), "frame_interval__s": 0.1}
+    path = tmp_path / "tracks.parquet"
+    shuffled = tracks.sample(frac=1, random_state=0)
+    with track_store.TrackWriter(
+        path, metadata, wavelength=400, frames_per_row_group=10
+    ) as writer:
+        for start in range(0, len(shuffled), 300):
+            writer.write(shuffled.iloc[start:start + 300])
+        writer.metadata["num_chunks"] = 7
+
+    stored = track_store.read_tracks(path)
+    assert_tracks_equal(stored.sort_values(["frame", "particle"], ignore_index=True), tracks)
+    assert (stored["wavelength"] == 400).all()
+    assert track_store.read_track_metadata(path) == {
+        "pixel_size__µm": [0.5, 0.25], "frame_interval__s": 0.1, "num_chunks": 7
+    }
+
+    # Late rows are stored in extra row groups, but each row group covers few frames
+    metadata = pq.ParquetFile(path).metadata
+    assert metadata.num_row_groups >= 10
+    for index in range(metadata.num_row_groups):
+        statistics = metadata.row_group(index).column(0).statistics
+        assert statistics.max - statistics.min < 10
+
+
+def test_read_tracks_filters_frames_and_particles(tracks, tmp_path):
+    path = track_store.write_tracks(tmp_path / "tracks.parquet", tracks, frames_per_row_group=10)
+
+    stored = track_store.read_tracks(
+        path, columns=["frame", "particle", "x"], frames=(15, 42), particles=[3, 7, 150]
+    )
+    is_selected = tracks["frame"].between(15, 41) & tracks["particle"].isin([3, 7, 150])
+    expected = tracks[is_selected].sort_values(["frame", "particle"])
+    assert list(stored.columns) == ["frame", "particle", "x"]
+    np.testing.assert_array_equal(stored[["frame", "particle"]], expected[["frame", "particle"]])
+    np.testing.assert_allclose(stored["x"], expected["x"], rtol=1e-6)
+
+
+def test_write_tracks_requires_schema_columns(tracks, tmp_path):
+    with pytest.raises(ValueError, match="ecc"):
+        track_store.write_tracks(tmp_path / "tracks.parquet", tracks.drop(columns="ecc"))
+
+    path = track_store.write_tracks(
+        tmp_path / "tracks.parquet", tracks.drop(columns=["raw_mass", "ep"])
+    )
+    stored = track_store.read_tracks(path)
+    assert stored["raw_mass"].isna().all() and stored["ep"].isna().all()
+
+
+def test_convert_csv(tracks, tmp_path):
+    csv_path = tmp_path / "tracks.csv"
+    tracks.assign(Wavelength=1000).to_csv(csv_path)
+
+    path = track_store.convert_csv(csv_path, metadata={"frame_interval__s": 0.1}, chunk_size=150)
+
+    assert path == tmp_path / "tracks.parquet"
+    stored = track_store.read_tracks(path)
+    assert_tracks_equal(stored, tracks)
+    assert (stored["wavelength"] == 1000).all()
+    assert path.stat().st_size < csv_path.stat().st_size / 2
+
+
+def test_recording_metadata_is_stored_with_tracks(ims_path, tracks, tmp_path):
+    metadata = track_store.get_recording_metadata(get_metadata(ims_path))
+    path = track_store.write_tracks(tmp_path / "tracks.parquet", tracks, metadata)
+
+    stored_metadata = track_store.read_track_metadata(path)
+    assert stored_metadata["source"] == ims_path.name
+    np.testing.assert_allclose(stored_metadata["pixel_size__µm"], [0.5, 0.5])
+    np.testing.assert_allclose(stored_metadata["frame_interval__s"], 0.1)
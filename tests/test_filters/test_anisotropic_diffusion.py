@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from confocal_microscopy.filters.anisotropic_diffusion import (
+    anisotropic_diffusion,
+    perona_malik,
+    tukey,
+)
+
+EDGE_FUNCTIONS = {"perona_malik": perona_malik, "tukey": tukey}
+
+
+def anisotropic_diffusion_numpy(image, edge_scale, step_size, num_steps, edge_function):
+    """The NumPy implementation that the compiled stencils replace.
+    """
+    denoised = image.copy()
+    ndim = denoised.ndim
+    num_borders = 2*ndim*np.ones_like(denoised)
+    for axis in range(ndim):
+        num_borders[(slice(None),)*axis + (0,)] -= 1
+        num_borders[(slice(None),)*axis + (-1,)] -= 1
+
+    for _ in range(num_steps):
+        diffs = np.zeros_like(denoised)
+        for axis in range(ndim):
+            forward_slices = (slice(None),)*axis + (slice(None, -1),)
+            backward_slices = (slice(None),)*axis + (slice(1, None),)
+            reversed_slices = (slice(None),)*axis + (slice(None, None, -1),)
+
+            diffs[forward_slices] += edge_function(np.diff(denoised, axis=axis), edge_scale)
+            reversed_diffs = np.diff(denoised[reversed_slices], axis=axis)[reversed_slices]
+            diffs[backward_slices] += edge_function(reversed_diffs, edge_scale)
+        denoised += step_size*diffs/num_borders
+    return denoised
+
+
+@pytest.fixture()
+def volume():
+    rng = np.random.RandomState(0)
+    volume = rng.standard_normal((9, 12, 11))
+    volume[:, 4:8, 3:9] += 3
+    return volume
+
+
+@pytest.mark.parametrize("edge_function", ["tukey", "perona_malik"])
+@pytest.mark.parametrize("ndim", [2, 3])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_anisotropic_diffusion_matches_numpy(volume, edge_function, ndim, dtype):
+    image = volume[0] if ndim == 2 else volume
+    image = image.astype(dtype)
+    expected = anisotropic_diffusion_numpy(
+        image, 1.5, 0.2, 10, EDGE_FUNCTIONS[edge_function]
+    )
+
+    denoised = anisotropic_diffusion(image, 1.5, 0.2, 10, edge_function=edge_function)
+    rtol = 1e-5 if dtype == np.float32 else 1e-12
+    np.testing.assert_allclose(denoised, expected, rtol=rtol, atol=rtol)
+    assert denoised.dtype == dtype
+
+
+def test_anisotropic_diffusion_in_place(volume):
+    expected = anisotropic_diffusion(volume, 1.5, 0.2, 5)
+    result = anisotropic_diffusion(volume, 1.5, 0.2, 5, return_copy=False)
+
+    assert result is volume
+    np.testing.assert_array_equal(volume, expected)
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 4, 8])
+@pytest.mark.parametrize("return_copy", [True, False])
+def test_blockwise_anisotropic_diffusion_matches_whole_volume(volume, block_size, return_copy):
+    expected = anisotropic_diffusion(volume, 1.5, 0.2, 3)
+
+    result = anisotropic_diffusion(
+        volume, 1.5, 0.2, 3, return_copy=return_copy, block_size=block_size
+    )
+    assert (result is volume) != return_copy
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_anisotropic_diffusion_rejects_integer_images():
+    with pytest.raises(TypeError):
+        anisotropic_diffusion(np.zeros((4, 4), dtype=int), 1, 0.1, 1)
+    with pytest.raises(ValueError):
+        anisotropic_diffusion(np.zeros((4, 4)), 1, 0.1, 1, edge_function="huber")
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from confocal_microscopy.filters import background
+
+
+def iter_blocks_of(video, block_size):
+    def iter_blocks():
+        for start in range(0, len(video), block_size):
+            yield video[start:start + block_size]
+    return iter_blocks
+
+
+@pytest.fixture()
+def video():
+    rng = np.random.RandomState(0)
+    video = rng.randint(0, 3000, size=(23, 6, 7)).astype(np.uint16)
+    video[:, 0, 0] = 5
+    video[:, 0, 1] = 65535
+    video[::2, 0, 2] = 256
+    return video
+
+
+def test_temporal_mean_matches_numpy(video):
+    statistics = background.TemporalMean().fit(iter_blocks_of(video, 4), len(video))
+
+    np.testing.assert_allclose(background.TemporalMean().get_background(statistics), video.mean(0))
+    np.testing.assert_array_equal(statistics["min"], video.min(0))
+    np.testing.assert_array_equal(statistics["max"], video.max(0))
+
+
+@pytest.mark.parametrize("percentile", [0, 10, 50, 73.3, 100])
+@pytest.mark.parametrize("bits_per_pass", [3, 8])
+@pytest.mark.parametrize("block_size", [1, 5])
+def test_temporal_percentile_matches_numpy(video, percentile, bits_per_pass, block_size):
+    estimator = background.TemporalPercentile(percentile, bits_per_pass=bits_per_pass)
+    statistics = estimator.fit(iter_blocks_of(video, block_size), len(video))
+
+    np.testing.assert_allclose(
+        estimator.get_background(statistics), np.percentile(video, percentile, axis=0)
+    )
+    np.testing.assert_array_equal(statistics["min"], video.min(0))
+
+
+def test_temporal_percentile_supports_uint8_and_rejects_floats(video):
+    video = (video % 256).astype(np.uint8)
+    estimator = background.TemporalPercentile()
+    statistics = estimator.fit(iter_blocks_of(video, 4), len(video))
+    np.testing.assert_allclose(statistics["background"], np.median(video, axis=0))
+
+    with pytest.raises(TypeError):
+        estimator.fit(iter_blocks_of(video.astype(float), 4), len(video))
+
+
+@pytest.mark.parametrize("block_size", [1, 4])
+def test_running_median_interpolates_window_medians(video, block_size):
+    estimator = background.RunningMedian(window=5, step=3)
+    statistics = estimator.fit(iter_blocks_of(video, block_size), len(video))
+
+    centres = statistics["background_time_points"]
+    np.testing.assert_array_equal(centres, [0, 3, 6, 9, 12, 15, 18, 21, 22])
+    for centre, median in zip(centres, statistics["background"]):
+        window = video[max(0, centre - 2):centre + 3]
+        np.testing.assert_allclose(median, np.median(window, axis=0))
+
+    medians = statistics["background"]
+    np.testing.assert_allclose(estimator.get_background(statistics, 6), medians[2])
+    np.testing.assert_allclose(
+        estimator.get_background(statistics, [7, 22]),
+        [medians[2] + (medians[3] - medians[2]) / 3, medians[-1]],
+        rtol=1e-6,
+    )
+    np.testing.assert_allclose(estimator.get_background(statistics), medians.mean(0))
+
+
+@pytest.mark.parametrize("max_centres", [2, 4, 5, 8])
+def test_running_median_limits_the_number_of_centres(video, max_centres):
+    estimator = background.RunningMedian(window=3, step=1, max_centres=max_centres)
+    statistics = estimator.fit(iter_blocks_of(video, 4), len(video))
+
+    centres = statistics["background_time_points"]
+    assert 2 <= len(centres) <= max_centres
+    assert centres[0] == 0 and centres[-1] == len(video) - 1
+    assert len(statistics["background"]) == len(centres)
+
+
+def test_running_median_reads_the_video_once(video):
+    class CountingIterator:
+        def __init__(self):
+            self.num_passes = 0
+
+        def __call__(self):
+            self.num_passes += 1
+            return iter_blocks_of(video, 1)()
+
+    iter_blocks = CountingIterator()
+    background.RunningMedian(window=3).fit(iter_blocks, len(video))
+    assert iter_blocks.num_passes == 1
+
+
+def test_get_background_estimator_by_name():
+    assert isinstance(background.get_background_estimator("mean"), background.TemporalMean)
+    estimator = background.get_background_estimator("percentile", percentile=10)
+    assert estimator.percentile == 10
+    assert background.get_background_estimator(estimator) is estimator
+    with pytest.raises(ValueError):
+        background.get_background_estimator("mode")
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from confocal_microscopy.filters import (
+    StreamingHistogram,
+    clip_and_scale,
+    normalise,
+    percentiles,
+    reduce_dynamic_range,
+)
+
+
+@pytest.fixture()
+def image():
+    return np.random.RandomState(0).randint(10, 1000, size=(20, 30)).astype(np.uint16)
+
+
+def test_normalise_uses_working_dtype(image):
+    expected = (image.astype(float) - image.min()) / image.max()
+
+    normalised = normalise(image)
+    assert normalised.dtype == np.float32
+    np.testing.assert_allclose(normalised, expected, rtol=1e-6)
+    assert normalise(image, dtype=np.float64).dtype == np.float64
+
+
+def test_normalise_in_place_and_non_contiguous(image):
+    expected = (image.astype(float) - image.min()) / image.max()
+    float_image = image.astype(float)
+    assert normalise(float_image, out=float_image) is float_image
+    np.testing.assert_allclose(float_image, expected)
+
+    np.testing.assert_allclose(normalise(image.T), expected.T, rtol=1e-6)
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_normalise_all_zero_image(dtype):
+    np.testing.assert_array_equal(normalise(np.zeros((4, 5), dtype=dtype)), 0)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16])
+def test_integer_percentiles_match_numpy(image, dtype):
+    image = (image % 200 - (100 if dtype == np.int16 else 0)).astype(dtype)
+    q = [0, 0.5, 10, 33.3, 50, 99.9, 100]
+
+    np.testing.assert_allclose(percentiles(image, q), np.percentile(image, q))
+    assert percentiles(image, 50) == np.percentile(image, 50)
+
+
+def test_float_percentiles_are_accurate_to_a_bin_width():
+    image = np.random.RandomState(0).standard_normal((100, 100))
+    q = [0, 1, 50, 99, 100]
+    bin_width = (image.max() - image.min()) / 1000
+
+    np.testing.assert_allclose(
+        percentiles(image, q, num_bins=1000), np.percentile(image, q), atol=bin_width
+    )
+    assert percentiles(image, 0) == image.min()
+    assert percentiles(image, 100) == image.max()
+
+
+def test_streaming_histogram_matches_percentiles_of_the_whole_video():
+    video = np.random.RandomState(0).randint(0, 3000, size=(10, 8, 9)).astype(np.uint16)
+    histogram = StreamingHistogram(video.dtype)
+    for frame in video:
+        histogram.update(frame)
+
+    assert (histogram.num_values, histogram.min, histogram.max) == (720, video.min(), video.max())
+    np.testing.assert_allclose(histogram.percentiles([1, 99]), np.percentile(video, [1, 99]))
+    with pytest.raises(ValueError):
+        StreamingHistogram(np.uint16).percentiles(50)
+
+
+def test_clip_and_scale_fuses_clip_and_scale(image):
+    expected = (np.clip(image.astype(float), 100, 500) - 100) * 255 / 400
+
+    np.testing.assert_allclose(clip_and_scale(image, 100, 500, scale=255), expected, rtol=1e-6)
+    out = np.empty(image.shape, dtype=np.uint8)
+    clip_and_scale(image, 100, 500, scale=255, out=out)
+    rounded = np.rint((np.clip(image, 100, 500) - 100.0) * (255 / 400)).astype(np.uint8)
+    np.testing.assert_array_equal(out, rounded)
+
+    float_image = image.astype(np.float32)
+    assert clip_and_scale(float_image, 100, 500, out=float_image) is float_image
+    np.testing.assert_allclose(float_image, expected / 255, rtol=1e-6)
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float64])
+def test_reduce_dynamic_range_matches_percentile_clipping(image, dtype):
+    image = image.astype(dtype)
+    min_value, max_value = np.percentile(image, [5, 95])
+    expected = image.copy()
+    expected[image < min_value] = min_value
+    expected[image > max_value] = max_value
+
+    np.testing.assert_array_equal(reduce_dynamic_range(image, 5, 95), expected)
+    out = np.empty_like(image)
+    assert reduce_dynamic_range(image, 5, 95, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+    reduce_dynamic_range(image, 5, 95, out=image)
+    np.testing.assert_array_equal(image, expected)
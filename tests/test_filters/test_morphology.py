@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from confocal_microscopy.filters import morphology
+
+OPERATIONS = ["grey_erosion", "grey_dilation", "grey_opening", "grey_closing"]
+
+
+@pytest.fixture(params=[np.uint8, np.uint16, np.float32, np.float64])
+def frames(request):
+    random_state = np.random.RandomState(0)
+    return random_state.randint(0, 200, size=(3, 17, 23)).astype(request.param)
+
+
+@pytest.mark.parametrize("operation", OPERATIONS)
+@pytest.mark.parametrize("size", [1, 2, 3, 4, 5, 8, (3, 5), (4, 1), (1, 6), 20, 40])
+def test_morphology_matches_ndimage(frames, operation, size):
+    sizes = (size, size) if np.isscalar(size) else size
+    expected = getattr(ndimage, operation)(frames, size=(1, *sizes))
+
+    filtered = getattr(morphology, operation)(frames, size)
+    assert filtered.dtype == frames.dtype
+    np.testing.assert_array_equal(filtered, expected)
+    np.testing.assert_array_equal(getattr(morphology, operation)(frames[1], size), expected[1])
+
+
+@pytest.mark.parametrize("operation", OPERATIONS)
+def test_morphology_writes_into_out(frames, operation):
+    expected = getattr(ndimage, operation)(frames, size=(1, 3, 5))
+
+    out = np.empty_like(frames)
+    assert getattr(morphology, operation)(frames, (3, 5), out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+    in_place = frames.copy()
+    getattr(morphology, operation)(in_place, (3, 5), out=in_place)
+    np.testing.assert_array_equal(in_place, expected)
+
+
+def test_morphology_supports_strided_frames(frames):
+    strided = frames[:, ::2, 1:]
+    np.testing.assert_array_equal(
+        morphology.grey_opening(strided, 3), ndimage.grey_opening(strided, size=(1, 3, 3))
+    )
+
+
+def test_morphology_raises_for_invalid_arguments(frames):
+    with pytest.raises(ValueError):
+        morphology.grey_erosion(frames, 0)
+    with pytest.raises(ValueError):
+        morphology.grey_erosion(frames, 3, out=np.empty(frames.shape, dtype=np.int64))
+    with pytest.raises(ValueError):
+        morphology.grey_erosion(frames[0, 0], 3)
+
+
+def test_morphology_in_worker_threads_matches_ndimage(frames):
+    expected = ndimage.grey_closing(frames, size=(1, 3, 3))
+    with ThreadPoolExecutor(2) as executor:
+        closed = list(executor.map(lambda frame: morphology.grey_closing(frame, 3), frames))
+    np.testing.assert_array_equal(np.stack(closed), expected)
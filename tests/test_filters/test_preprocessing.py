@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from confocal_microscopy.filters import FramePreprocessor
+
+
+def preprocess_frame(frame, background, limits):
+    """The frame by frame preprocessing the IMSLoader in scripts/track_particles.py used.
+    """
+    frame = frame.astype(float)
+    frame = frame - background
+    frame[frame < 0] = 0
+    frame = ndimage.grey_opening(frame, 3)
+    frame = ndimage.grey_closing(frame, 5)
+    frame -= limits[0]
+    frame /= limits[1]
+    frame *= 255
+    frame[frame > 255] = 255
+    frame[frame < 0] = 0
+    return frame
+
+
+@pytest.fixture()
+def frames():
+    random_state = np.random.RandomState(0)
+    return random_state.randint(0, 100, size=(4, 30, 40)).astype(np.uint16)
+
+
+@pytest.fixture()
+def background(frames):
+    return frames.mean(axis=0)
+
+
+def test_preprocessing_matches_frame_by_frame_implementation(frames, background):
+    preprocessor = FramePreprocessor(opening_size=3, closing_size=5)
+    preprocessed = preprocessor(frames, background, (2, 50))
+    expected = np.stack([preprocess_frame(frame, background, (2, 50)) for frame in frames])
+
+    assert preprocessed.dtype == np.float32
+    np.testing.assert_allclose(preprocessed, expected, atol=1e-3)
+    np.testing.assert_allclose(preprocessor(frames[1], background, (2, 50)), expected[1], atol=1e-3)
+
+
+def test_preprocessing_writes_into_out(frames, background):
+    preprocessor = FramePreprocessor()
+    expected = preprocessor(frames, background, (2, 50))
+
+    out = np.empty(frames.shape, dtype=np.float32)
+    assert preprocessor(frames, background, (2, 50), out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+    out = np.empty(frames.shape, dtype=np.uint8)
+    assert preprocessor(frames, background, (2, 50), out=out) is out
+    np.testing.assert_array_equal(out, expected.astype(np.uint8))
+
+    with pytest.raises(ValueError):
+        preprocessor(frames, background, (2, 50), out=out[:2])
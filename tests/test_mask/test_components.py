@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from confocal_microscopy.mask import components
+
+
+@pytest.fixture()
+def volume_mask():
+    return np.random.RandomState(0).random_sample((12, 20, 20)) > 0.6
+
+
+@pytest.mark.parametrize("connectivity", [1, 3])
+@pytest.mark.parametrize("block_size", [None, 1, 3, 5])
+def test_label_components_matches_ndimage(volume_mask, connectivity, block_size):
+    structure = ndimage.generate_binary_structure(3, connectivity)
+    expected, num_expected = ndimage.label(volume_mask, structure)
+
+    labelled, num_labels = components.label_components(volume_mask, structure, block_size)
+    assert num_labels == num_expected
+    np.testing.assert_array_equal(labelled, expected)
+
+
+def test_label_components_merges_components_across_blocks():
+    mask = np.zeros((6, 5, 5), dtype=bool)
+    mask[:, 2, 2] = True
+    mask[0, 0, 0] = True
+    mask[5, 4, 4] = True
+
+    labelled, num_labels = components.label_components(mask, block_size=1)
+    assert num_labels == 3
+    assert np.all(labelled[:, 2, 2] == 2)
+    assert (labelled[0, 0, 0], labelled[5, 4, 4]) == (1, 3)
+
+
+def test_component_statistics_match_per_label_computation(volume_mask):
+    intensity = np.random.RandomState(1).random_sample(volume_mask.shape)
+    labelled, num_labels = ndimage.label(volume_mask)
+
+    statistics = components.compute_component_statistics(labelled, num_labels, intensity)
+    for label in [1, num_labels // 2, num_labels]:
+        label_mask = labelled == label
+        slices = ndimage.find_objects(label_mask.astype(int))[0]
+
+        assert statistics.sizes[label - 1] == label_mask.sum()
+        np.testing.assert_array_equal(
+            statistics.bounding_boxes[label - 1],
+            [bound for axis_slice in slices for bound in (axis_slice.start, axis_slice.stop)],
+        )
+        np.testing.assert_allclose(
+            statistics.centroids[label - 1], np.argwhere(label_mask).mean(axis=0)
+        )
+        np.testing.assert_allclose(
+            statistics.mean_intensities[label - 1], intensity[label_mask].mean()
+        )
+
+
+def test_filter_components_uses_lookup_table(volume_mask):
+    labelled, num_labels = ndimage.label(volume_mask)
+    statistics = components.compute_component_statistics(labelled, num_labels)
+    keep = statistics.centroids[:, 0] < 6
+
+    expected = np.isin(labelled, np.flatnonzero(keep) + 1)
+    np.testing.assert_array_equal(components.filter_components(labelled, keep), expected)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from confocal_microscopy.mask import filter_small_regions
+
+
+def filter_small_regions_per_label(mask, min_size):
+    out = mask.copy()
+    labelled, num_labels = ndimage.label(mask)
+    for label in range(1, num_labels + 1):
+        label_mask = labelled == label
+        if label_mask.sum() < min_size:
+            out[label_mask] = 0
+    return out
+
+
+@pytest.mark.parametrize("block_size", [None, 2])
+def test_filter_small_regions_matches_per_label_filtering(block_size):
+    mask = np.random.RandomState(0).random_sample((8, 30, 30)) > 0.6
+    expected = filter_small_regions_per_label(mask, 5)
+
+    np.testing.assert_array_equal(filter_small_regions(mask, 5, block_size=block_size), expected)
+    out = mask.astype(np.uint8)
+    assert filter_small_regions(out, 5, out=out) is out
+    np.testing.assert_array_equal(out, expected)
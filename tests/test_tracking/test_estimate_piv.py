@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from confocal_microscopy.files import ims, synthetic
+
+estimate_piv = pytest.importorskip("confocal_microscopy.tracking.estimate_piv")
+
+
+def load_data_float64(data_path, morphology=True):
+    """The float64 implementation of ``estimate_piv.load_data``.
+    """
+    raw_data = ims.load_video_stack(data_path).squeeze().astype(float)
+    background_signal = np.mean(raw_data, axis=0)
+    raw_data -= (background_signal + 5)
+    raw_data[raw_data < 0] = 0
+    raw_data[raw_data > 20] = 20
+    if not morphology:
+        return raw_data
+    for i in range(raw_data.shape[0]):
+        raw_data[i] = ndimage.grey_closing(ndimage.grey_opening(raw_data[i], 3), 3)
+    return raw_data
+
+
+@pytest.fixture()
+def ims_path(tmp_path):
+    return synthetic.write_synthetic_ims_file(
+        tmp_path / "video red ch_1.ims", 8, shape=(1, 48, 48), num_particles=20, noise=5, seed=0
+    )
+
+
+@pytest.mark.parametrize("morphology", [False, True])
+def test_load_data_matches_float64_computation(ims_path, morphology):
+    data = estimate_piv.load_data(ims_path, morphology=morphology)
+
+    assert data.dtype == np.float32
+    np.testing.assert_allclose(data, load_data_float64(ims_path, morphology), atol=1e-4)
+    assert estimate_piv.load_data(ims_path, morphology, dtype=np.float64).dtype == np.float64
+
+
+@pytest.mark.parametrize("use_frame_cache", [False, True])
+def test_streamed_data_matches_in_memory_computation(ims_path, tmp_path, use_frame_cache):
+    if use_frame_cache:
+        ims.convert_to_frame_cache(ims_path)
+    expected = load_data_float64(ims_path)
+    frame_bytes = 48 * 48 * (2 + 3*4)
+
+    out = np.lib.format.open_memmap(
+        tmp_path / "preprocessed.npy", mode="w+", dtype=np.float32, shape=expected.shape
+    )
+    loaded = estimate_piv.load_data(ims_path, out=out, memory_budget__bytes=3*frame_bytes)
+    assert loaded is out
+    np.testing.assert_allclose(out, expected, atol=1e-4)
+
+    blocks = list(estimate_piv.iter_data(ims_path, memory_budget__bytes=3*frame_bytes))
+    assert [start for start, _ in blocks] == [0, 3, 6]
+    assert [len(block) for _, block in blocks] == [3, 3, 2]
+    np.testing.assert_allclose(blocks[-1][1], expected[6:], atol=1e-4)
+
+
+def test_background_is_computed_once(ims_path, monkeypatch):
+    estimate_piv.load_data(ims_path)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The background should be loaded from the statistics cache")
+
+    monkeypatch.setattr(estimate_piv.statistics_cache, "save_statistics", fail)
+    estimate_piv.load_data(ims_path, morphology=False)
+
+
+def test_load_data_with_median_background(ims_path):
+    raw_data = ims.load_video_stack(ims_path).squeeze().astype(float)
+    expected = np.clip(raw_data - np.median(raw_data, axis=0) - 5, 0, 20)
+
+    data = estimate_piv.load_data(
+        ims_path, morphology=False, background="median", memory_budget__bytes=3 * 48 * 48 * 14
+    )
+    np.testing.assert_allclose(data, expected, atol=1e-4)
+
+
+def test_framerate_is_the_frame_interval(ims_path):
+    metadata = ims.get_metadata(ims_path)
+    frame_interval__s = metadata.relative_timestamps__s[-1] / (metadata.num_timesteps - 1)
+    assert estimate_piv.find_framerate__s_per_frame(metadata) == pytest.approx(frame_interval__s)
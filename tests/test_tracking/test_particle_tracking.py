@@ -0,0 +1,297 @@
+import numpy as np
+import pandas as pd
+import pytest
+import trackpy as tp
+
+from confocal_microscopy.files import ims, synthetic
+from confocal_microscopy.files import tracks as track_store
+from confocal_microscopy.filters import FramePreprocessor
+from confocal_microscopy.tracking import particle_tracking
+
+tp.quiet()
+
+
+@pytest.fixture(scope="module")
+def frames():
+    video = synthetic.make_particle_video(
+        40,
+        shape=(1, 64, 64),
+        num_particles=15,
+        speed__px_per_frame=1.5,
+        noise=5,
+        seed=0,
+    )
+    frames = video[:, 0].astype(np.float32)
+    frames -= frames.min()
+    return frames / frames.max() * 255
+
+
+def batch_tracks(frames, min_track_length, memory):
+    features = tp.batch(frames, 5, minmass=50, preprocess=False, processes=1)
+    tracks = tp.link(features, 4, memory=memory)
+    tracks = tp.filter_stubs(tracks, min_track_length).reset_index(drop=True)
+    return tracks.sort_values(["frame", "particle"], ignore_index=True)
+
+
+@pytest.mark.parametrize("min_track_length, memory", [(2, 0), (5, 2), (30, 1)])
+def test_streamed_tracks_match_batch_tracking(frames, min_track_length, memory):
+    expected = batch_tracks(frames, min_track_length, memory)
+
+    tracks = particle_tracking.track_particles(
+        frames,
+        search_range=4,
+        memory=memory,
+        min_track_length=min_track_length,
+        chunk_size=10,
+    )
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(
+        tracks[expected.columns], expected, check_dtype=False, check_like=True
+    )
+
+
+def test_streamed_tracks_are_written_in_chunks(frames, tmp_path):
+    expected = batch_tracks(frames, 3, 2)
+
+    chunks = list(
+        particle_tracking.iter_tracks(
+            frames, search_range=4, memory=2, min_track_length=3, chunk_size=50
+        )
+    )
+    assert len(chunks) > 1
+    assert all(len(chunk) >= 50 for chunk in chunks[:-1])
+
+    path = particle_tracking.track_particles(
+        frames,
+        tmp_path / "tracks.parquet",
+        metadata={"frame_interval__s": 0.5},
+        search_range=4,
+        memory=2,
+        min_track_length=3,
+        chunk_size=50,
+    )
+    tracks = track_store.read_tracks(path).sort_values(["frame", "particle"], ignore_index=True)
+    np.testing.assert_allclose(
+        tracks[["frame", "x", "y"]], expected[["frame", "x", "y"]], rtol=1e-6
+    )
+    assert track_store.read_track_metadata(path) == {"frame_interval__s": 0.5}
+
+
+def test_filter_stubs_forgets_finished_short_tracks():
+    linked_frames = [
+        pd.DataFrame({"frame": [0, 0], "particle": [0, 1]}),
+        pd.DataFrame({"frame": [1], "particle": [0]}),
+        pd.DataFrame({"frame": [2], "particle": [0]}),
+        pd.DataFrame({"frame": [3, 3], "particle": [0, 1]}),
+    ]
+
+    rows = pd.concat(list(particle_tracking.filter_stubs(linked_frames, 2, memory=0)))
+    assert rows["particle"].tolist() == [0, 0, 0, 0]
+    rows = pd.concat(list(particle_tracking.filter_stubs(linked_frames, 2, memory=2)))
+    assert sorted(rows["particle"].tolist()) == [0, 0, 0, 0, 1, 1]
+
+
+@pytest.fixture()
+def particle_loader(tmp_path):
+    video = synthetic.make_particle_video(
+        12, shape=(1, 48, 48), num_particles=8, speed__px_per_frame=1.0, seed=1
+    )
+    path = synthetic.write_ims_file(tmp_path / "particles.ims", video)
+    loader = ims.LazyIMSVideoLoader(
+        path, progress=False, preprocessor=FramePreprocessor(scale=255), use_cache=False
+    )
+    with loader:
+        yield loader
+
+
+def test_parallel_locate_matches_batch(particle_loader):
+    expected = tp.batch(list(particle_loader), 5, minmass=50, preprocess=False, processes=1)
+    expected = expected.reset_index(drop=True)
+
+    features = particle_tracking.locate_parallel(
+        particle_loader, 5, minmass=50, workers=2, frames_per_task=5, block_size=2
+    )
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(features[expected.columns], expected, check_dtype=False)
+
+
+def test_parallel_tracks_match_serial_tracks(particle_loader):
+    expected = particle_tracking.track_particles(particle_loader, search_range=4)
+    tracks = particle_tracking.track_particles(
+        particle_loader, search_range=4, workers=2, frames_per_task=4
+    )
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(tracks, expected)
+
+
+def make_features_with_dense_cluster(num_frames=30, cluster_frames=(10, 13), seed=0):
+    """Five particles moving to the right, and a dense cluster that trackpy can't link.
+    """
+    random_state = np.random.RandomState(seed)
+    frames = []
+    for frame_number in range(num_frames):
+        y = np.array([20.0, 60, 100, 140, 180])
+        x = 10 + 2.0*frame_number + np.zeros(5)
+        if cluster_frames[0] <= frame_number < cluster_frames[1]:
+            y = np.concatenate([y, 300 + random_state.uniform(0, 12, 40)])
+            x = np.concatenate([x, 300 + random_state.uniform(0, 12, 40)])
+        frames.append(pd.DataFrame({"y": y, "x": x, "frame": frame_number}))
+    return frames
+
+
+def test_link_features_retries_oversize_subnets():
+    frames = make_features_with_dense_cluster()
+    with pytest.raises(tp.linking.SubnetOversizeException):
+        tp.link(pd.concat(frames, ignore_index=True), 16, memory=2)
+
+    segments = []
+    linked = list(
+        particle_tracking.link_features(
+            frames, 16, memory=2, retry_length=5, segments=segments
+        )
+    )
+
+    # The cluster is linked with stronger and stronger retry parameters
+    assert segments[0] == (0, 11, {"search_range": 16, "memory": 2})
+    assert segments[-1].stop_frame == 30
+    assert segments[-1].parameters == segments[0].parameters
+    assert segments[-1].start_frame == segments[-2].start_frame + 5
+    for segment, next_segment in zip(segments[:-1], segments[1:]):
+        assert segment.stop_frame == next_segment.start_frame
+    for segment in segments[1:-1]:
+        assert segment.parameters["adaptive_stop"] == pytest.approx(1.6)
+
+    # The five particles keep their labels across the segments
+    tracks = pd.concat(linked, ignore_index=True)
+    moving = tracks[tracks["y"] < 200]
+    assert moving.groupby("particle")["frame"].count().tolist() == [30]*5
+    assert tracks.groupby("frame")["particle"].nunique().tolist() == [
+        len(frame) for frame in frames
+    ]
+
+
+def test_link_features_retries_with_larger_subnets():
+    # A 5 x 5 grid of particles is one subnetwork of 25 particles at the adaptive search stop
+    frames = make_features_with_dense_cluster(cluster_frames=(0, 0))
+    grid_y, grid_x = 300 + 1.2*np.mgrid[:5, :5].reshape(2, -1)
+    jitter = np.random.RandomState(0).uniform(-0.05, 0.05, (3, 2, 25))
+    for frame_number, (jitter_y, jitter_x) in zip(range(10, 13), jitter):
+        grid = pd.DataFrame(
+            {"y": grid_y + jitter_y, "x": grid_x + jitter_x, "frame": frame_number}
+        )
+        frames[frame_number] = pd.concat([frames[frame_number], grid], ignore_index=True)
+    retry_parameters = particle_tracking.get_default_retry_parameters(16)
+    with pytest.raises(tp.linking.SubnetOversizeException):
+        list(particle_tracking.link_features(frames, 16, retry_parameters=retry_parameters[:2]))
+
+    segments = []
+    linked = list(
+        particle_tracking.link_features(frames, 16, retry_length=5, segments=segments)
+    )
+
+    assert [segment.parameters.get("max_subnet_size") for segment in segments] == [None, 30, None]
+    grid_tracks = pd.concat(linked, ignore_index=True).query("y >= 200")
+    assert grid_tracks.groupby("particle")["frame"].count().tolist() == [3]*25
+
+
+def test_link_features_raises_if_all_retries_fail():
+    frames = make_features_with_dense_cluster()
+    with pytest.raises(tp.linking.SubnetOversizeException):
+        list(particle_tracking.link_features(frames, 16, retry_parameters=[{"memory": 1}]))
+
+
+def test_link_features_handles_empty_frames():
+    frames = make_features_with_dense_cluster(cluster_frames=(0, 0))
+    frames[0] = frames[0].iloc[:0]
+    frames[5] = frames[5].iloc[:0]
+    expected = list(tp.link_df_iter(frames, 16, memory=1))
+
+    linked = list(particle_tracking.link_features(frames, 16, memory=1))
+    for linked_frame, expected_frame in zip(linked, expected):
+        pd.testing.assert_frame_equal(linked_frame, expected_frame, check_dtype=False)
+
+
+def test_checkpointed_features_are_reused(particle_loader, tmp_path, monkeypatch):
+    checkpoint_dir = tmp_path / "checkpoints"
+    expected = list(particle_tracking.locate_features(particle_loader, 5))
+    features = list(
+        particle_tracking.locate_features_checkpointed(
+            particle_loader, checkpoint_dir, 5, frames_per_checkpoint=5
+        )
+    )
+    checkpoint_paths = sorted(checkpoint_dir.glob("features_*.parquet"))
+    assert [path.name for path in checkpoint_paths] == [
+        "features_000000-000005.parquet",
+        "features_000005-000010.parquet",
+        "features_000010-000012.parquet",
+    ]
+
+    located_ranges = []
+    locate_frames = particle_tracking._locate_frames
+
+    def record_located_range(loader, start, stop, *args):
+        located_ranges.append((start, stop))
+        return locate_frames(loader, start, stop, *args)
+
+    monkeypatch.setattr(particle_tracking, "_locate_frames", record_located_range)
+    checkpoint_paths[1].unlink()
+    resumed_features = list(
+        particle_tracking.locate_features_checkpointed(
+            particle_loader, checkpoint_dir, 5, frames_per_checkpoint=5
+        )
+    )
+    assert located_ranges == [(5, 10)]
+    for frame_features in [features, resumed_features]:
+        assert len(frame_features) == len(expected)
+        for located, expected_features in zip(frame_features, expected):
+            pd.testing.assert_frame_equal(located, expected_features, check_dtype=False)
+
+    # Other arguments don't use the old checkpoints
+    list(
+        particle_tracking.locate_features_checkpointed(
+            particle_loader, checkpoint_dir, 5, minmass=100, frames_per_checkpoint=5
+        )
+    )
+    assert located_ranges == [(5, 10), (0, 5), (5, 10), (10, 12)]
+
+
+def test_checkpoints_are_removed_when_the_loader_settings_change(
+    particle_loader, tmp_path, monkeypatch
+):
+    checkpoint_dir = tmp_path / "checkpoints"
+    list(
+        particle_tracking.locate_features_checkpointed(
+            particle_loader, checkpoint_dir, 5, frames_per_checkpoint=5
+        )
+    )
+
+    located_ranges = []
+    locate_frames = particle_tracking._locate_frames
+
+    def record_located_range(loader, start, stop, *args):
+        located_ranges.append((start, stop))
+        return locate_frames(loader, start, stop, *args)
+
+    monkeypatch.setattr(particle_tracking, "_locate_frames", record_located_range)
+
+    def locate_with_new_loader(**loader_kwargs):
+        loader = ims.LazyIMSVideoLoader(
+            particle_loader.path,
+            progress=False,
+            preprocessor=FramePreprocessor(scale=255),
+            use_cache=False,
+            **loader_kwargs,
+        )
+        with loader:
+            list(
+                particle_tracking.locate_features_checkpointed(
+                    loader, checkpoint_dir, 5, frames_per_checkpoint=5
+                )
+            )
+
+    # A new loader with the same settings uses the checkpoints
+    locate_with_new_loader()
+    assert located_ranges == []
+
+    locate_with_new_loader(limit_percentiles=(1, 99))
+    assert located_ranges == [(0, 5), (5, 10), (10, 12)]
@@ -0,0 +1,161 @@
+import json
+import os
+import time
+
+import pytest
+
+from confocal_microscopy.utils import scheduler
+
+
+def write_output(input_path, output_path):
+    output_path.write_text(input_path.read_text().upper())
+
+
+def fail(input_path, output_path):
+    raise RuntimeError(f"Could not process {input_path}")
+
+
+@pytest.fixture()
+def jobs(tmp_path):
+    jobs = []
+    for name, size in [("small", 1), ("large", 3), ("medium", 2)]:
+        input_path = tmp_path / f"{name}.txt"
+        input_path.write_text(name*size)
+        output_path = tmp_path / f"{name}.out"
+        arguments = (input_path, output_path)
+        jobs.append(scheduler.Job(str(input_path), [input_path], [output_path], size, arguments))
+    return jobs
+
+
+def set_mtime(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+def test_jobs_are_run_largest_first(jobs, tmp_path):
+    order = []
+
+    def record_order(input_path, output_path):
+        order.append(input_path.stem)
+        write_output(input_path, output_path)
+
+    summary_path = tmp_path / "summary.json"
+    results = scheduler.run_jobs(record_order, jobs, summary_path=summary_path, progress=False)
+
+    assert order == ["large", "medium", "small"]
+    assert [result.status for result in results] == ["done"]*3
+    assert (tmp_path / "large.out").read_text() == "LARGELARGELARGE"
+
+    with summary_path.open() as f:
+        summary = json.load(f)
+    assert summary["num_jobs"] == {"done": 3}
+    expected_names = [str(tmp_path / f"{name}.txt") for name in order]
+    assert [job["name"] for job in summary["jobs"]] == expected_names
+    assert summary["work_time__s"] <= summary["wall_time__s"]
+
+
+def test_jobs_with_newer_outputs_are_skipped(jobs, tmp_path):
+    now = time.time()
+    for name in ["small", "large", "medium"]:
+        (tmp_path / f"{name}.out").write_text("")
+        set_mtime(tmp_path / f"{name}.txt", now - 100)
+        set_mtime(tmp_path / f"{name}.out", now - 50)
+    set_mtime(tmp_path / "medium.txt", now)
+
+    results = scheduler.run_jobs(write_output, jobs, progress=False)
+
+    statuses = {result.name: result.status for result in results}
+    assert statuses == {
+        str(tmp_path / "small.txt"): "up to date",
+        str(tmp_path / "large.txt"): "up to date",
+        str(tmp_path / "medium.txt"): "done",
+    }
+    assert (tmp_path / "medium.out").read_text() == "MEDIUMMEDIUM"
+    assert (tmp_path / "small.out").read_text() == ""
+
+
+def test_locked_jobs_are_left_to_other_processes(jobs, tmp_path):
+    lock_dir = tmp_path / "locks"
+    lock_dir.mkdir()
+    large_job, stale_job = jobs[1], jobs[2]
+    scheduler.get_lock_path(lock_dir, large_job).write_text("")
+    stale_lock_path = scheduler.get_lock_path(lock_dir, stale_job)
+    stale_lock_path.write_text("")
+    set_mtime(stale_lock_path, time.time() - 1000)
+
+    results = scheduler.run_jobs(
+        write_output, jobs, lock_dir=lock_dir, lock_timeout__s=100, progress=False
+    )
+
+    statuses = {result.name: result.status for result in results}
+    assert statuses[large_job.name] == "locked"
+    assert statuses[stale_job.name] == "done"
+    assert not (tmp_path / "large.out").exists()
+    assert [path.name for path in lock_dir.iterdir()] == [
+        scheduler.get_lock_path(lock_dir, large_job).name
+    ]
+
+
+def test_failed_jobs_are_reported(jobs, tmp_path):
+    summary_path = tmp_path / "summary.json"
+    results = scheduler.run_jobs(
+        fail, jobs, lock_dir=tmp_path / "locks", summary_path=summary_path, progress=False
+    )
+
+    assert [result.status for result in results] == ["failed"]*3
+    assert "Could not process" in results[0].error
+    assert list((tmp_path / "locks").iterdir()) == []
+    with summary_path.open() as f:
+        assert json.load(f)["num_jobs"] == {"failed": 3}
+
+
+def test_jobs_are_run_by_worker_processes(jobs, tmp_path):
+    results = scheduler.run_jobs(
+        write_output, jobs, workers=2, lock_dir=tmp_path / "locks", progress=False
+    )
+
+    assert sorted(result.status for result in results) == ["done"]*3
+    for name, size in [("small", 1), ("large", 3), ("medium", 2)]:
+        assert (tmp_path / f"{name}.out").read_text() == name.upper()*size
+
+
+def test_locks_are_refreshed_while_jobs_run(jobs, tmp_path):
+    lock_dir = tmp_path / "locks"
+    lock_timeout__s = 0.4
+    lock_path = scheduler.get_lock_path(lock_dir, jobs[0])
+    taken_over = []
+
+    def slow_write_output(input_path, output_path):
+        time.sleep(3*lock_timeout__s)
+        # Another process can't take over the lock of a running job
+        taken_over.append(scheduler._acquire_lock(lock_path, lock_timeout__s))
+        write_output(input_path, output_path)
+
+    results = scheduler.run_jobs(
+        slow_write_output,
+        jobs[:1],
+        lock_dir=lock_dir,
+        lock_timeout__s=lock_timeout__s,
+        progress=False,
+    )
+
+    assert [result.status for result in results] == ["done"]
+    assert taken_over == [False]
+
+
+def test_stale_locks_are_taken_over_by_one_process(tmp_path, monkeypatch):
+    lock_path = tmp_path / "job.lock"
+    lock_path.write_text("crashed")
+    set_mtime(lock_path, time.time() - 1000)
+    rename = os.rename
+
+    def take_over_before_rename(source, destination):
+        # Another process takes over the stale lock after this process found it stale
+        monkeypatch.setattr(os, "rename", rename)
+        assert scheduler._acquire_lock(lock_path, 100)
+        rename(source, destination)
+
+    monkeypatch.setattr(os, "rename", take_over_before_rename)
+    assert not scheduler._acquire_lock(lock_path, 100)
+
+    assert json.loads(lock_path.read_text())["pid"] == os.getpid()
+    assert [path.name for path in tmp_path.iterdir()] == ["job.lock"]
@@ -0,0 +1,69 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from confocal_microscopy.utils import apply_slicewise
+
+
+def apply_slicewise_with_stack(f, image, axis):
+    """The list, stack and transpose implementation that ``apply_slicewise`` replaces.
+    """
+    results = [f(np.take(image, index, axis=axis)) for index in range(image.shape[axis])]
+    return np.moveaxis(np.stack(results, axis=0), 0, axis)
+
+
+@partial(apply_slicewise, workers=2, executor="process")
+def double(image_slice):
+    return 2*image_slice
+
+
+@pytest.fixture()
+def image():
+    return np.random.RandomState(0).random_sample((4, 5, 6))
+
+
+@pytest.mark.parametrize("axis", [0, 1, 2])
+@pytest.mark.parametrize("workers, executor", [(1, "thread"), (3, "thread"), (2, "process")])
+def test_apply_slicewise_matches_stacking(image, axis, workers, executor):
+    slicewise_sort = apply_slicewise(
+        np.sort, axis=axis, workers=workers, chunk_size=2, executor=executor
+    )
+
+    result = slicewise_sort(image)
+    np.testing.assert_allclose(result, apply_slicewise_with_stack(np.sort, image, axis))
+    assert result.flags.c_contiguous
+
+
+def test_apply_slicewise_writes_to_out_and_passes_arguments(image):
+    @apply_slicewise
+    def scale(image_slice, factor, offset=0):
+        return image_slice * factor + offset
+
+    out = np.empty_like(image)
+    assert scale(image, 2, offset=1, slicewise_out=out) is out
+    np.testing.assert_allclose(out, image*2 + 1)
+    assert scale.__name__ == "scale"
+
+    with pytest.raises(ValueError):
+        scale(image, 2, slicewise_out=np.empty((3, 5, 6)))
+
+
+def test_apply_slicewise_passes_out_to_the_function(image):
+    slicewise_negative = apply_slicewise(np.negative, axis=2)
+    out = np.empty(image.shape[:2])
+
+    # Each slice is written into the same out array, so the result is the last slice
+    result = slicewise_negative(image, out=out)
+    np.testing.assert_allclose(result, -image)
+    np.testing.assert_allclose(out, -image[..., -1])
+
+
+def test_apply_slicewise_infers_dtype_from_first_slice(image):
+    result = apply_slicewise(lambda image_slice: image_slice > 0.5, axis=1)(image)
+    assert result.dtype == bool
+    np.testing.assert_array_equal(result, image > 0.5)
+
+
+def test_apply_slicewise_decorator_with_process_executor(image):
+    np.testing.assert_allclose(double(image), 2*image)